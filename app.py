@@ -4,21 +4,22 @@ from os import path
 import requests
 from streamlit_modal import Modal
 
-from PIL import Image
 import pydicom
 import tempfile
 import os
-from xray_classifier import classify_xray
-from grad_cam import run_gradcam_on_xray
-from xray_find_similar import find_similar_xrays
 from xray_dicom_deidentify import de_id_dcm
+from xray_inference_client import get_inference_client, start_background_warmup
+from xray_labels import CLASSIFICATION_THRESHOLD
+from xray_settings import get_setting
+from xray_study import XrayStudy
+from xray_tracing import configure_tracing, span, start_metrics_server
 
 def show_classification_result():
     st.success("✅ Classification Complete")
     # Print results
     n_diagnosis = 0
     dct_classification_result = st.session_state['dct_classification_result'] # get values from session_state
-    classification_threshold = 0.55
+    classification_threshold = CLASSIFICATION_THRESHOLD
     for label, prob in dct_classification_result.items():
 
         if prob >= classification_threshold: # Only show those with confidence >= classification_threshold
@@ -45,24 +46,33 @@ def show_classification_result():
     st.write(f"**{n_diagnosis} labels / possible diagnosis** with confidence >= {classification_threshold} captured by the AI model.")
 
 
+EXAMPLE_DICOMS = {
+    "Cardiomegaly": path.join("example_dicoms","cardiomegaly_00004606_000.dcm"),
+    "Hernia": path.join("example_dicoms","hernia_00007712_002.dcm"),
+    "Nodule": path.join("example_dicoms","nodules_00004995_000.dcm"),
+    "Infiltration": path.join("example_dicoms","infiltration_00018734_000.dcm")
+}
+
+@st.cache_resource
+def load_example_thumbnails():
+    # Read and decode the example DICOMs once per process, not on every rerun
+    return {label: XrayStudy.from_file(img_path).thumbnail for label, img_path in EXAMPLE_DICOMS.items()}
+
+def get_xray_study(dicom_data):
+    # One lazy study per session: pixels are decoded once and derived images are memoized
+    if st.session_state.get('xray_study') is None or st.session_state['xray_study'].ds is not dicom_data:
+        st.session_state['xray_study'] = XrayStudy(dicom_data)
+    return st.session_state['xray_study']
+
 def show_example_dicoms():
-    imgs = {
-        "Cardiomegaly": path.join("example_dicoms","cardiomegaly_00004606_000.dcm"),
-        "Hernia": path.join("example_dicoms","hernia_00007712_002.dcm"),
-        "Nodule": path.join("example_dicoms","nodules_00004995_000.dcm"),
-        "Infiltration": path.join("example_dicoms","infiltration_00018734_000.dcm")
-    }
+    thumbnails = load_example_thumbnails()
 
     with st.expander("**Example Chest X-Ray DICOMs**"):
-        for label, img_path in imgs.items():
+        for label, img_path in EXAMPLE_DICOMS.items():
             col_img, col_operations = st.columns(2)
 
             with col_img:
-                dicom_data = pydicom.dcmread(img_path)
-                img = Image.fromarray(dicom_data.pixel_array)
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                st.image(img, caption=label)
+                st.image(thumbnails[label], caption=label)
                 
 
             with col_operations:
@@ -80,6 +90,22 @@ st.set_page_config(page_title="Radiology AI Assistant", layout="centered")
 # Title
 st.title("🩻 RAISO - Radiology AI Second Opinion App")
 
+@st.cache_resource
+def start_model_warmup():
+    # Once per process: load the models in the background while the key form is shown
+    return start_background_warmup()
+
+start_model_warmup()
+
+@st.cache_resource
+def start_metrics():
+    # Once per process: stage latency histograms on http://<host>:RAISO_METRICS_PORT/metrics (off by default)
+    configure_tracing()
+    port = get_setting("RAISO_METRICS_PORT")
+    return start_metrics_server(int(port)) if port else None
+
+start_metrics()
+
 def show_apim_form():
 
     st.write("🔐 Secure API Access")
@@ -98,9 +124,6 @@ def show_apim_form():
             if submitted:
                 
                 st.session_state.sub_key = key_input
-                
-                # Debugging
-                print("> key input:", key_input)
 
                 st.success("Key saved. Will now call the API and check if it's valid.")
                 st.experimental_rerun()
@@ -110,7 +133,7 @@ def show_apim_form():
 
             if 'apim_key_valid' not in st.session_state:
                 # Check if key is valid
-                print("> Validating key:", st.session_state.sub_key)
+                print("> Validating API key")
                 headers = {
                     "Ocp-Apim-Subscription-Key": st.session_state.sub_key
                 }
@@ -192,17 +215,17 @@ else: # Drive logic to show the main app
                 try:
 
                     if 'deidentified_dicom' not in st.session_state:
-                        dicom_data = pydicom.dcmread(tmp_path)
+                        with span("dcmread"):
+                            dicom_data = pydicom.dcmread(tmp_path)
                         st.success("✅ File loaded successfully.")
                         dicom_data = de_id_dcm(dicom_data) # De-identify DICOM
                         if not dicom_data is None:
-                            st.session_state['deidentified_dicom'] = de_id_dcm(dicom_data)
+                            st.session_state['deidentified_dicom'] = dicom_data
 
                             # Display DICOM image with metadata after de-identification
-                            img = Image.fromarray(dicom_data.pixel_array)
-                            if img.mode != "RGB":
-                                img = img.convert("RGB")
-                            st.image(img)
+                            st.image(get_xray_study(dicom_data).image)
+                            if get_xray_study(dicom_data).n_frames > 1:
+                                st.info(f"🎞️ This DICOM has {get_xray_study(dicom_data).n_frames} frames: the first frame is shown and analyzed.")
                             
                             st.write("**Patient ID:**", dicom_data.get("PatientID", "N/A"))
                             st.write("**Modality:**", dicom_data.get("Modality", "N/A"))
@@ -221,17 +244,15 @@ else: # Drive logic to show the main app
                 #dicom_data = pydicom.dcmread(example_dicom_path)
 
                 if 'deidentified_dicom' not in st.session_state:
-                        dicom_data = pydicom.dcmread(example_dicom_path)
+                        with span("dcmread"):
+                            dicom_data = pydicom.dcmread(example_dicom_path)
                         st.success("✅ File loaded successfully.")
                         st.write("💡 No De-identification will be applied on example DICOMs. To test De-identification feature, please upload your DICOM file (.dcm).")
                         st.session_state['deidentified_dicom'] = dicom_data # No need to de-identify example DICOMs
                 else :
                     dicom_data = st.session_state['deidentified_dicom']
 
-                img = Image.fromarray(dicom_data.pixel_array)
-                if img.mode != "RGB":
-                    img = img.convert("RGB")
-                st.image(img)
+                st.image(get_xray_study(dicom_data).image)
 
                 st.success("✅ Example file read successfully.")
                 st.write("**Patient ID:**", "N/A")
@@ -243,13 +264,21 @@ else: # Drive logic to show the main app
 
 
         if 'deidentified_dicom' in st.session_state:
+            # Decode and preprocess once: classification, Grad-CAM and similarity search reuse the same study
+            xray_study = get_xray_study(dicom_data)
+            # Inference runs in the inference server (RAISO_INFERENCE_URL) or in-process; results are cached there
+            inference_client = get_inference_client()
+
             if 'xray_classified' not in st.session_state:
+                use_tta = st.checkbox("🎯 Higher-accuracy mode (test-time augmentation)", key="use_tta",
+                                      help="Also classifies flipped, cropped and contrast-adjusted copies of the X-ray and averages the results. Slower.")
                 # Button to classify
                 if st.button("Run AI Classification"):
                     # Placeholder for backend response
                     with st.spinner("Processing with AI model..."):
                         # Simulated classification result
-                        dct_classification_result = classify_xray(dicom_data.pixel_array)
+                        with span("app:classify"):
+                            dct_classification_result = inference_client.classify(xray_study, tta=use_tta)
                         st.session_state['dct_classification_result'] = dct_classification_result
                         show_classification_result()
 
@@ -270,7 +299,9 @@ else: # Drive logic to show the main app
                                 with modal.container():
                                     with st.spinner("Generating explanation using Grad-CAM..."):
                                         # Generate Grad-CAM image
-                                        heatmap = run_gradcam_on_xray(dicom_data.pixel_array, label=st.session_state['explain_opinion_label'])
+                                        label = st.session_state['explain_opinion_label']
+                                        with span("app:explain"):
+                                            heatmap = inference_client.explain(xray_study, label)
                                         st.success("✅ Explanation generated")
                                         st.write("Grad-CAM Heatmap sets highlights on the part(s) of the image on which the model had the highest focus while making the classification dicision.")
                                         st.image(heatmap, caption=f"Grad-CAM Heatmap - {st.session_state['explain_opinion_label']}", use_column_width=True)
@@ -280,12 +311,9 @@ else: # Drive logic to show the main app
                         if modal.is_open():
                             with modal.container():
                                 with st.spinner("🔍 Fetching similar X-rays from NIH Chest X-ray Dataset..."):
-                                    # Get the image from the DICOM file as PiL Image
-                                    img = Image.fromarray(dicom_data.pixel_array)
-                                    if img.mode != "RGB":
-                                        img = img.convert("RGB")
                                     # Get filenames of similar X-rays using Azure Search AI
-                                    filenames = find_similar_xrays(st.session_state['explain_opinion_label'], img)
+                                    with span("app:similar"):
+                                        filenames = inference_client.similar(xray_study, st.session_state['explain_opinion_label'])
                                     st.success("✅ Top similar X-rays Found")
                                     for i in range(len(filenames)):
                                         filename = filenames[i]
@@ -1,83 +1,203 @@
 import numpy as np
 import torch
-from torchvision import transforms#models
-from PIL import Image
-import cv2
+import threading
+import numbers
 
-from xray_classifier import load_model, CLASS_NAMES
+from xray_classifier import get_model, classify_xray_explainable, CLASS_NAMES
+from xray_preprocessing import to_input_tensor
+from xray_tracing import span
 
 # ===== 1. Preprocessing function for ndarray =====
-def preprocess_xray_image(ndarray_img):
-    if len(ndarray_img.shape) == 2:
-        ndarray_img = np.stack([ndarray_img] * 3, axis=-1)  # Grayscale to RGB
-    pil_img = Image.fromarray(np.uint8(ndarray_img)).convert("RGB")
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406],  # ImageNet stats
-                             std=[0.229, 0.224, 0.225]),
-    ])
-    return transform(pil_img).unsqueeze(0)  # Shape: (1, 3, 224, 224)
+def preprocess_xray_image(ndarray_img, ds=None):
+    return to_input_tensor(ndarray_img, ds).unsqueeze(0)  # Shape: (1, 3, 224, 224)
 
 
 # ===== 2. Grad-CAM Setup =====
+CAM_METHODS = ('gradcam', 'gradcam++')
+
+def class_gradients(outputs, activations, class_indices):
+    """
+    Gradients of several class scores w.r.t. the target activations in one batched backward pass.
+
+    Returns:
+        torch.Tensor: Shape (K, N, C, H, W), one slice per class in class_indices.
+    """
+    # One-hot selectors, one row per requested class: (K, N, num_classes)
+    selectors = torch.zeros((len(class_indices),) + tuple(outputs.shape), dtype=outputs.dtype)
+    selectors[torch.arange(len(class_indices)), :, torch.as_tensor(class_indices)] = 1.0
+    try:
+        gradients, = torch.autograd.grad(outputs, activations, grad_outputs=selectors, is_grads_batched=True)
+    except RuntimeError:
+        # Fallback for ops without batching rules: one backward per class
+        gradients = torch.stack([
+            torch.autograd.grad(outputs, activations, grad_outputs=selector, retain_graph=True)[0]
+            for selector in selectors
+        ])
+    return gradients
+
+def compute_cams(activations, gradients, method='gradcam'):
+    """
+    Weight the activations by their gradients (Grad-CAM or Grad-CAM++) and build normalized heatmaps.
+
+    Args:
+        activations (torch.Tensor): Target layer output, shape (N, C, H, W).
+        gradients (torch.Tensor): Output of class_gradients, shape (K, N, C, H, W).
+        method (str): 'gradcam' or 'gradcam++'.
+
+    Returns:
+        np.ndarray: Heatmaps of shape (N, K, H, W), each scaled to [0, 1].
+    """
+    if method not in CAM_METHODS:
+        raise ValueError(f"Unknown CAM method '{method}'. Use one of {CAM_METHODS}.")
+    activations = activations.detach()
+    gradients = gradients.detach()
+
+    if method == 'gradcam':
+        weights = gradients.mean(dim=(3, 4))  # (K, N, C)
+    else:
+        # Grad-CAM++: pixel-wise alpha coefficients from 2nd/3rd order gradient terms
+        grads_2 = gradients.pow(2)
+        grads_3 = gradients.pow(3)
+        sum_activations = activations.sum(dim=(2, 3), keepdim=True)  # (N, C, 1, 1)
+        denominator = 2 * grads_2 + sum_activations * grads_3
+        denominator = torch.where(denominator != 0, denominator, torch.ones_like(denominator))
+        alphas = grads_2 / denominator
+        weights = (alphas * torch.relu(gradients)).sum(dim=(3, 4))  # (K, N, C)
+
+    # Channel weighting as a single contraction over C
+    heatmaps = torch.relu(torch.einsum('knc,nchw->nkhw', weights, activations))
+    max_values = heatmaps.amax(dim=(2, 3), keepdim=True)
+    heatmaps = heatmaps / torch.where(max_values > 0, max_values, torch.ones_like(max_values))
+    return heatmaps.numpy()
+
 class GradCAM:
+    """
+    Grad-CAM / Grad-CAM++ engine for a target layer.
+
+    The forward hook is registered once at construction and stays until remove() is called
+    (or the `with` block ends). Heatmaps for a list of classes and a batch of images come
+    from one forward pass and one batched backward pass.
+    """
+
     def __init__(self, model, target_layer):
         self.model = model
         self.target_layer = target_layer
-        self.gradients = None
         self.activations = None
+        self._lock = threading.Lock()
+
+        # Register hook once
+        self._hook = self.target_layer.register_forward_hook(self._save_activation)
+
+    def remove(self):
+        if self._hook is not None:
+            self._hook.remove()
+            self._hook = None
+
+    def __enter__(self):
+        return self
 
-        # Register hooks
-        self.target_layer.register_forward_hook(self._save_activation)
-        self.target_layer.register_full_backward_hook(self._save_gradient)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.remove()
 
     def _save_activation(self, module, input, output):
-        self.activations = output.detach()
-
-    def _save_gradient(self, module, grad_input, grad_output):
-        self.gradients = grad_output[0].detach()
-
-    def generate(self, input_tensor, class_idx):
-        output = self.model(input_tensor)
-
-        self.model.zero_grad()
-        output[:, class_idx].backward()
-
-        # Grad-CAM calculation
-        pooled_gradients = torch.mean(self.gradients, dim=[0, 2, 3])
-        activations = self.activations.squeeze(0)
-
-        for i in range(activations.shape[0]):
-            activations[i, :, :] *= pooled_gradients[i]
-
-        heatmap = torch.mean(activations, dim=0).cpu().numpy()
-        heatmap = np.maximum(heatmap, 0)
-        heatmap /= heatmap.max()
-        return heatmap#, class_idx.item()
-
-# ===== 3. Overlay CAM on Original Image =====
-def overlay_heatmap_on_image(heatmap, original_ndarray, alpha=0.4):
-    original_resized = cv2.resize(original_ndarray, (224, 224))
-    if len(original_resized.shape) == 2:
-        original_resized = cv2.cvtColor(original_resized, cv2.COLOR_GRAY2BGR)
-
-    heatmap_resized = cv2.resize(heatmap, (224, 224))
-    heatmap_color = cv2.applyColorMap(np.uint8(255 * heatmap_resized), cv2.COLORMAP_JET)
-    overlay = cv2.addWeighted(np.uint8(original_resized), 1 - alpha, heatmap_color, alpha, 0)
-    return overlay
-
-# ===== 4. Example Usage =====
-def run_gradcam_on_xray(ndarray_img, label):
-    input_tensor = preprocess_xray_image(ndarray_img)
-    # Load model
-    model = load_model()
-    # Use last conv block as target layer
-    target_layer = model.conv_head  # ✅ this is the final conv block before pooling
-    grad_cam = GradCAM(model, target_layer)
-    # Get index of label (class name)
-    class_idx = CLASS_NAMES.index(label)
-    heatmap = grad_cam.generate(input_tensor, class_idx)
-
-    result_img = overlay_heatmap_on_image(heatmap, ndarray_img)
+        # Ignore no_grad forward passes (e.g. concurrent classifications on the shared model).
+        # The activations keep their graph so gradients can be taken w.r.t. them.
+        if output.requires_grad:
+            self.activations = output
+
+    def generate(self, input_tensor, class_idx, method='gradcam'):
+        """
+        Args:
+            input_tensor (torch.Tensor): Batch of preprocessed images, shape (N, 3, 224, 224).
+            class_idx (int or list): One class index, or a list of class indices.
+            method (str): 'gradcam' or 'gradcam++'.
+
+        Returns:
+            np.ndarray: (H, W) heatmap for a single class index and a single image,
+            otherwise heatmaps of shape (N, K, H, W).
+        """
+        if self._hook is None:
+            raise RuntimeError("GradCAM hooks have been removed.")
+        single_class = isinstance(class_idx, numbers.Integral)
+        class_indices = [class_idx] if single_class else list(class_idx)
+
+        with self._lock, torch.enable_grad(), span("gradcam_forward_backward"):
+            self.activations = None
+            output = self.model(input_tensor)
+            activations = self.activations
+            self.activations = None
+            if activations is None:
+                raise RuntimeError("Target layer was not reached during the forward pass.")
+            gradients = class_gradients(output, activations, class_indices)
+
+        heatmaps = compute_cams(activations, gradients, method)
+        if single_class and heatmaps.shape[0] == 1:
+            return heatmaps[0, 0]
+        return heatmaps
+
+# Shared GradCAM on the shared classifier's conv_head (hook registered once per process)
+_gradcam = None
+_gradcam_lock = threading.Lock()
+
+def get_gradcam():
+    global _gradcam
+    with _gradcam_lock:
+        if _gradcam is None:
+            model = get_model()
+            _gradcam = GradCAM(model, model.conv_head)  # ✅ this is the final conv block before pooling
+        return _gradcam
+
+# ===== 3. Grad-CAM from cached activations =====
+def gradcam_from_activations(activations, labels=None, model=None, method='gradcam'):
+    """
+    Compute Grad-CAM heatmaps from conv_head activations captured during classification.
+
+    Only the head (bn2 -> pooling -> classifier) is re-run, and the gradients of all selected
+    classes are computed in one batched backward pass (vector-Jacobian product per class).
+
+    Args:
+        activations (torch.Tensor): conv_head output of shape (N, C, H, W) from classify_xray_explainable.
+        labels (list): Class names to explain. Defaults to all CLASS_NAMES.
+        model (torch.nn.Module): Model that produced the activations. Defaults to the shared classifier.
+        method (str): 'gradcam' or 'gradcam++'.
+
+    Returns:
+        np.ndarray: Heatmaps of shape (N, len(labels), H, W), each scaled to [0, 1].
+    """
+    if labels is None:
+        labels = CLASS_NAMES
+    if model is None:
+        model = get_model()
+    class_indices = [CLASS_NAMES.index(label) for label in labels]
+
+    activations = activations.detach().requires_grad_(True)
+    with torch.enable_grad(), span("gradcam_backward"):
+        outputs = model.forward_head(model.bn2(activations))
+        gradients = class_gradients(outputs, activations, class_indices)
+    return compute_cams(activations, gradients, method)
+
+# ===== 4. Overlay CAM on Original Image =====
+def overlay_heatmap_on_image(heatmap, original_ndarray, alpha=0.4, ds=None, max_size=None):
+    """
+    RGB overlay of a heatmap on the X-ray at the X-ray's resolution (see xray_heatmap_render.render_overlays).
+
+    Args:
+        heatmap (np.ndarray): (h, w) heatmap in [0, 1].
+        original_ndarray (np.ndarray): Windowed uint8 image, or raw pixels with their dataset ds.
+        alpha (float): Heatmap opacity.
+        ds (pydicom.Dataset): Dataset of raw DICOM pixels, for the windowing.
+        max_size (int): Longest side of the overlay (None: native resolution).
+    """
+    from xray_heatmap_render import render_overlays
+    return render_overlays(heatmap, original_ndarray, ds, alpha=alpha, max_size=max_size)
+
+# ===== 5. Example Usage =====
+def run_gradcam_on_xray(ndarray_img, label, activations=None, method='gradcam', ds=None, max_size=None):
+    # Reuse the conv_head activations of the classification pass when available,
+    # otherwise capture them with a single forward pass
+    if activations is None:
+        _, activations = classify_xray_explainable(to_input_tensor(ndarray_img, ds))
+    heatmap = gradcam_from_activations(activations, [label], method=method)[0, 0]
+
+    result_img = overlay_heatmap_on_image(heatmap, ndarray_img, ds=ds, max_size=max_size)
     return result_img
@@ -1,76 +1,117 @@
 import os
 from os import path
+import sys
 from glob import glob
-import json
+import csv
+import time
+import argparse
 
-import torch
+import numpy as np
 from PIL import Image
-from torchvision import transforms
-from transformers import AutoTokenizer
-from timm import create_model
+import torch
+from torch.utils.data import Dataset, DataLoader
 
-import pandas as pd
-import numpy as np
+# Reuse the app's preprocessing and vision encoder (ViT-base used in MedCLIP), so indexed
+# vectors match the query vectors computed by xray_embedder
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from xray_preprocessing import to_input_tensor
+from xray_embedder import embed_xray_batch, embedding_model_version, EMBEDDING_BACKBONES
+from xray_vector_store import VectorStoreWriter, export_jsonl
+
+
+class XrayPngDataset(Dataset):
+    """Decodes and preprocesses PNGs in DataLoader worker processes."""
+
+    def __init__(self, image_paths):
+        self.image_paths = image_paths
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        img_path = self.image_paths[idx]
+        image = np.asarray(Image.open(img_path).convert('L'))
+        return to_input_tensor(image), os.path.basename(img_path)
+
+
+def load_labels(labels_csv):
+    # Filename -> labels lookup, built once (no per-file scan of the CSV)
+    labels = {}
+    with open(labels_csv, newline="") as f:
+        for row in csv.DictReader(f):
+            labels[row['Image Index']] = row['Finding Labels'].split("|") # convert to list
+    return labels
+
+
+def embed_images(images_dir, labels_csv, store_dir, batch_size=32, workers=4, dtype="float16",
+                 checkpoint_every=10, backbone="vit"):
+    """
+    Embed every PNG of images_dir into the binary vector store at store_dir.
+
+    Decoding runs in DataLoader workers, embedding in batches, and rows are streamed to the
+    store with a checkpoint every checkpoint_every batches. Re-running with the same store_dir
+    skips images that are already committed.
+
+    backbone selects the embedding network ('vit', or 'classifier' for the pooled EfficientNet
+    features). The store manifest records it, and the app must query with the same
+    RAISO_EMBEDDING_BACKBONE; re-indexing for another backbone needs a new store_dir.
+    """
+    labels_by_filename = load_labels(labels_csv)
+    image_paths = sorted(glob(f'{images_dir}/*.png'))  # or .jpg, .jpeg
+
+    # Embedding dimension from a dummy forward pass
+    dim = embed_xray_batch([torch.zeros(3, 224, 224)], backbone).shape[1]
+    writer = VectorStoreWriter(store_dir, dim, dtype=dtype,
+                               extra_manifest={"model": embedding_model_version(backbone), "backbone": backbone})
+    todo = [p for p in image_paths if os.path.basename(p) not in writer.done_filenames]
+    print(f"> {len(image_paths)} images, {len(image_paths) - len(todo)} already embedded, {len(todo)} to go")
+
+    loader = DataLoader(XrayPngDataset(todo), batch_size=batch_size, num_workers=workers,
+                        persistent_workers=False, pin_memory=False)
+    start = time.perf_counter()
+    n_done = 0
+    with writer:
+        for batch_idx, (tensors, filenames) in enumerate(loader):
+            vectors = embed_xray_batch(tensors, backbone)
+            labels = [labels_by_filename.get(filename, []) for filename in filenames]
+            writer.append(vectors, list(filenames), labels)
+            n_done += len(filenames)
+
+            if (batch_idx + 1) % checkpoint_every == 0:
+                writer.checkpoint()
+                elapsed = time.perf_counter() - start
+                print(f"> {n_done}/{len(todo)} embedded ({n_done / elapsed:.1f} images/s)")
+
+    elapsed = time.perf_counter() - start
+    if n_done:
+        print(f"> Embedded {n_done} images in {elapsed:.1f}s ({n_done / elapsed:.1f} images/s)")
+    return writer.count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed the NIH X-ray PNGs into a binary vector store.")
+    parser.add_argument("--images-dir", default=path.join("XRay-Chest-NIH-Random-dataset", "as_png"))
+    parser.add_argument("--labels-csv", default=path.join("XRay-Chest-NIH-Random-dataset", "sample_lables_minimized.csv"))
+    parser.add_argument("--store", default="medclip_xray_vectors")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--dtype", default="float16", choices=["float16", "float32"])
+    parser.add_argument("--checkpoint-every", type=int, default=10, help="Checkpoint every N batches.")
+    parser.add_argument("--backbone", default="vit", choices=EMBEDDING_BACKBONES,
+                        help="Embedding network: the ViT encoder, or the pooled features of the classifier.")
+    parser.add_argument("--export-jsonl", default="medclip_xray_vectors.jsonl",
+                        help="Also write the .jsonl file for Azure AI Search ingestion ('' to skip).")
+    args = parser.parse_args()
+
+    count = embed_images(args.images_dir, args.labels_csv, args.store, batch_size=args.batch_size,
+                         workers=args.workers, dtype=args.dtype, checkpoint_every=args.checkpoint_every,
+                         backbone=args.backbone)
+    print(f"> Vector store {args.store} holds {count} embeddings")
+
+    if args.export_jsonl:
+        print("> Writing records to .jsonl file for Azure AI Search ingestion..")
+        export_jsonl(args.store, args.export_jsonl)
+        print(".JSONL file created for Azure AI Search ingestion")
+    print("======================================")
 
-# Load vision encoder (ViT-base used in MedCLIP)
-vision_model = create_model('vit_base_patch16_224', pretrained=True, num_classes=0)
-vision_model.eval()
-
-# Preprocessing for MedCLIP (224x224, normalization)
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize(
-        mean=[0.485, 0.456, 0.406],  # ImageNet
-        std=[0.229, 0.224, 0.225]
-    )
-])
-
-def embed_xray(image_path):
-    image = Image.open(image_path).convert('RGB')
-    tensor = transform(image).unsqueeze(0)  # Add batch dimension
-    with torch.no_grad():
-        embedding = vision_model(tensor).squeeze().numpy()
-    return embedding
-    
-
-# Store embedding records to write to one document later for Azure AI Search ingestion
-records = []
-images_dir = path.join("XRay-Chest-NIH-Random-dataset", "as_png")
-
-# Load sample labels file to label each file record
-df_labels = pd.read_csv(path.join("XRay-Chest-NIH-Random-dataset", "sample_lables_minimized.csv"))
-
-image_paths = glob(f'{images_dir}/*.png')  # or .jpg, .jpeg
-
-iterator = 1
-for img_path in image_paths:
-
-    print(f"> Embedding:", str(img_path))
-    filename = os.path.basename(img_path)
-    labels = df_labels.query("`Image Index`==@filename").iloc[0]['Finding Labels']
-    labels = labels.split("|") if "|" in labels else [labels] # convert to list
-    vec = embed_xray(img_path)
-    records.append({
-        "id": str(iterator),
-        "filename": os.path.basename(img_path),
-        "labels": labels,
-        "embedding": vec.tolist()
-    })
-    
-    iterator += 1
-    
-print("> Created records in RAM..")
-print("> Writing records to .jsonl file for Azure AI Search ingestion..")
-
-
-# Save for Azure AI Search ingestion
-with open("medclip_xray_vectors.jsonl", "w") as f:
-    for record in records:
-        json.dump(record, f)
-        f.write("\n")
-        
-print(".JSONL file crearted for Azure AI Search ingestion")
-print("======================================")
-
-print("\nDone!")
+    print("\nDone!")
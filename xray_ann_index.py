@@ -0,0 +1,392 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from xray_search_backends import SimilaritySearchBackend, LocalVectorIndex
+from xray_vector_store import labels_to_mask, mask_dtype, default_class_names
+
+
+INDEX_FORMAT_VERSION = 1
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _sample(vectors, n, rng):
+    if len(vectors) <= n:
+        return np.asarray(vectors, dtype=np.float32)
+    return np.asarray(vectors[np.sort(rng.choice(len(vectors), n, replace=False))], dtype=np.float32)
+
+
+def _assign(vectors, centroids, spherical, chunk_size=8192):
+    # Nearest centroid per row (max inner product if spherical, min L2 otherwise), chunked to bound memory
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    centroid_sq_norms = None if spherical else (centroids ** 2).sum(axis=1)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+        scores = chunk @ centroids.T
+        if spherical:
+            assignments[start:start + chunk_size] = scores.argmax(axis=1)
+        else:
+            assignments[start:start + chunk_size] = (centroid_sq_norms - 2 * scores).argmin(axis=1)
+    return assignments
+
+
+def kmeans(vectors, n_clusters, n_iter=20, spherical=True, seed=0):
+    """
+    Plain Lloyd k-means in NumPy.
+
+    Args:
+        vectors (np.ndarray): Training vectors of shape (N, D).
+        n_clusters (int): Number of centroids.
+        n_iter (int): Number of iterations.
+        spherical (bool): Use cosine similarity with unit-norm centroids instead of L2.
+        seed (int): Random seed of the initialization.
+
+    Returns:
+        np.ndarray: Centroids of shape (n_clusters, D).
+    """
+    rng = np.random.default_rng(seed)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = _assign(vectors, centroids, spherical)
+        # Per-cluster sums with one sorted reduceat (much faster than np.add.at)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        order = np.argsort(assignments, kind="stable")
+        non_empty = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[non_empty]
+        sums = np.zeros_like(centroids)
+        sums[non_empty] = np.add.reduceat(vectors[order], starts, axis=0)
+        empty = counts == 0
+        # Re-seed empty clusters with random points
+        if empty.any():
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+            counts[empty] = 1
+        centroids = sums / counts[:, None]
+        if spherical:
+            centroids = _normalize(centroids)
+    return centroids.astype(np.float32)
+
+
+class IVFIndex(SimilaritySearchBackend):
+    """
+    Inverted-file (IVF) index with optional product quantization (IVF-PQ) for cosine search.
+
+    Vectors are L2-normalized and clustered with spherical k-means; each inverted list is a
+    contiguous row range of the on-disk arrays, so a query scans only the nprobe closest lists.
+    With PQ, the residual to the list centroid is encoded in pq_m bytes and scored with per-query
+    lookup tables; the best candidates are then re-ranked with the exact vectors.
+
+    All arrays are stored as .npy files in one directory and loaded with mmap, so several
+    worker processes share one copy in the page cache.
+    """
+
+    def __init__(self, index_dir, nprobe=8, rerank_factor=4, mmap=True):
+        """
+        Args:
+            index_dir (str): Directory written by IVFIndex.build.
+            nprobe (int): Number of inverted lists scanned per query.
+            rerank_factor (int): With PQ, re-rank k * rerank_factor candidates with exact vectors.
+            mmap (bool): Memory-map the arrays instead of reading them into RAM.
+        """
+        with open(os.path.join(index_dir, "manifest.json"), "r") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format_version") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format version {self.manifest.get('format_version')}.")
+        mmap_mode = "r" if mmap else None
+
+        def load(name):
+            return np.load(os.path.join(index_dir, name), mmap_mode=mmap_mode)
+
+        self.class_names = self.manifest["class_names"]
+        self.centroids = np.load(os.path.join(index_dir, "centroids.npy"))
+        self.list_offsets = np.load(os.path.join(index_dir, "list_offsets.npy"))
+        self.vectors = load("vectors.npy")
+        self.label_masks = load("label_masks.npy")
+        self.row_ids = load("row_ids.npy")
+        self.pq_m = self.manifest["pq_m"]
+        if self.pq_m:
+            self.codes = load("pq_codes.npy")
+            self.codebooks = np.load(os.path.join(index_dir, "pq_codebooks.npy"))
+        with open(os.path.join(index_dir, "filenames.json"), "r") as f:
+            self.filenames = json.load(f)
+        self.nprobe = nprobe
+        self.rerank_factor = rerank_factor
+
+    @staticmethod
+    def build(index_dir, vectors, filenames, labels, class_names=None, n_lists=None, pq_m=0,
+              vector_dtype="float16", n_iter=20, train_size=65536, seed=0):
+        """
+        Build an index and write it to index_dir.
+
+        Args:
+            index_dir (str): Output directory.
+            vectors (np.ndarray): Embeddings of shape (N, D) (may be a memmap).
+            filenames (list): N filenames, row-aligned with vectors.
+            labels (list): N lists of labels, row-aligned with vectors.
+            class_names (list): Labels encoded in the filter bitmask. Defaults to xray_labels.CLASS_NAMES.
+            n_lists (int): Number of inverted lists. Defaults to about 4 * sqrt(N).
+            pq_m (int): Number of PQ sub-quantizers (bytes per vector); 0 keeps exact vectors only.
+            vector_dtype (str): Storage type of the exact vectors ('float16' or 'float32').
+            n_iter (int): k-means iterations.
+            train_size (int): Number of vectors sampled to train k-means.
+            seed (int): Random seed.
+        """
+        if class_names is None:
+            class_names = default_class_names()
+        n, dim = vectors.shape
+        if pq_m and dim % pq_m != 0:
+            raise ValueError(f"pq_m ({pq_m}) must divide the vector dimension ({dim}).")
+        if n_lists is None:
+            n_lists = max(1, int(4 * np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        os.makedirs(index_dir, exist_ok=True)
+
+        vectors = _normalize(vectors)
+        centroids = kmeans(_sample(vectors, train_size, rng), n_lists, n_iter=n_iter, spherical=True, seed=seed)
+        n_lists = len(centroids)
+        assignments = _assign(vectors, centroids, spherical=True)
+
+        # Lay out every inverted list as a contiguous row range
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=list_offsets[1:])
+        sorted_vectors = vectors[order]
+        label_masks = np.array([labels_to_mask(labels[i], class_names) for i in order], dtype=mask_dtype(class_names))
+
+        np.save(os.path.join(index_dir, "centroids.npy"), centroids)
+        np.save(os.path.join(index_dir, "list_offsets.npy"), list_offsets)
+        np.save(os.path.join(index_dir, "vectors.npy"), sorted_vectors.astype(vector_dtype))
+        np.save(os.path.join(index_dir, "label_masks.npy"), label_masks)
+        np.save(os.path.join(index_dir, "row_ids.npy"), order.astype(np.int64))
+
+        if pq_m:
+            # Product quantization of the residuals to the list centroids
+            residuals = sorted_vectors - centroids[assignments[order]]
+            sub_dim = dim // pq_m
+            train = _sample(residuals, train_size, rng)
+            codebooks = np.stack([
+                kmeans(train[:, j * sub_dim:(j + 1) * sub_dim], 256, n_iter=n_iter, spherical=False, seed=seed + j)
+                for j in range(pq_m)
+            ])
+            if codebooks.shape[1] < 256:
+                raise ValueError("PQ training needs at least 256 vectors.")
+            codes = np.stack([
+                _assign(residuals[:, j * sub_dim:(j + 1) * sub_dim], codebooks[j], spherical=False)
+                for j in range(pq_m)
+            ], axis=1).astype(np.uint8)
+            np.save(os.path.join(index_dir, "pq_codebooks.npy"), codebooks)
+            np.save(os.path.join(index_dir, "pq_codes.npy"), codes)
+
+        with open(os.path.join(index_dir, "filenames.json"), "w") as f:
+            json.dump(list(filenames), f)
+        with open(os.path.join(index_dir, "manifest.json"), "w") as f:
+            json.dump({
+                "format_version": INDEX_FORMAT_VERSION,
+                "metric": "cosine",
+                "count": int(n),
+                "dim": int(dim),
+                "n_lists": int(n_lists),
+                "pq_m": int(pq_m),
+                "vector_dtype": vector_dtype,
+                "class_names": list(class_names),
+            }, f, indent=2)
+
+    def _candidate_rows(self, probe_lists, bit):
+        rows = np.concatenate([
+            np.arange(self.list_offsets[l], self.list_offsets[l + 1]) for l in probe_lists
+        ]) if len(probe_lists) else np.empty(0, dtype=np.int64)
+        if bit is not None and len(rows):
+            rows = rows[(self.label_masks[rows] & bit) != 0]
+        return rows
+
+    def _score_pq(self, query, rows, lists_of_rows):
+        # Inner product with (centroid + decoded residual): q.c + sum_j table[j, code_j]
+        sub_dim = query.shape[0] // self.pq_m
+        tables = np.einsum("mkd,md->mk", self.codebooks, query.reshape(self.pq_m, sub_dim))
+        codes = np.asarray(self.codes[rows])
+        return (self.centroids[lists_of_rows] @ query) + tables[np.arange(self.pq_m), codes].sum(axis=1)
+
+    def query(self, vector, label=None, k=3, nprobe=None):
+        """
+        Approximate top-k search.
+
+        Args:
+            vector (list | np.ndarray): Query embedding.
+            label (str): Only rows carrying this label are returned. None disables the filter.
+            k (int): Number of results.
+            nprobe (int): Lists to scan. Defaults to self.nprobe; widened automatically when
+                the label filter leaves fewer than k candidates.
+
+        Returns:
+            list: (original row id, score) pairs, best first.
+        """
+        if label is not None and label not in self.class_names:
+            return []
+        bit = None if label is None else np.asarray(1 << self.class_names.index(label), dtype=self.label_masks.dtype)
+        query = _normalize(vector)
+        n_lists = len(self.centroids)
+        nprobe = min(nprobe or self.nprobe, n_lists)
+        list_order = np.argsort(-(self.centroids @ query))
+
+        # Probe more lists while a selective label filter leaves too few candidates
+        rows = self._candidate_rows(list_order[:nprobe], bit)
+        while len(rows) < k and nprobe < n_lists:
+            nprobe = min(nprobe * 2, n_lists)
+            rows = self._candidate_rows(list_order[:nprobe], bit)
+        if len(rows) == 0:
+            return []
+
+        if self.pq_m:
+            lists_of_rows = np.searchsorted(self.list_offsets, rows, side="right") - 1
+            scores = self._score_pq(query, rows, lists_of_rows)
+            n_rerank = min(len(rows), k * self.rerank_factor)
+            if n_rerank < len(scores):
+                keep = np.argpartition(-scores, n_rerank - 1)[:n_rerank]
+                rows = rows[keep]
+            scores = np.asarray(self.vectors[rows], dtype=np.float32) @ query
+        else:
+            scores = np.asarray(self.vectors[rows], dtype=np.float32) @ query
+
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self.row_ids[rows[i]]), float(scores[i])) for i in top]
+
+    def search(self, vector, label, k=3):
+        return [self.filenames[row_id] for row_id, _ in self.query(vector, label, k)]
+
+
+def benchmark_recall(index, exact_index, queries, labels, k=3, nprobes=(1, 2, 4, 8, 16, 32)):
+    """
+    Recall@k and latency of an IVF index against exact search, for several nprobe values.
+
+    Args:
+        index (IVFIndex): Index under test.
+        exact_index (LocalVectorIndex): Exact search over the same vectors.
+        queries (np.ndarray): Query vectors of shape (Q, D).
+        labels (list): Q label filters (or None entries).
+        k (int): Number of neighbours.
+        nprobes (tuple): nprobe values to evaluate.
+
+    Returns:
+        list: One dict per nprobe with recall, p50_ms and p95_ms.
+    """
+    exact_results = [set(exact_index.search(q, label, k)) for q, label in zip(queries, labels)]
+    exact_latencies = []
+    for q, label in zip(queries, labels):
+        start = time.perf_counter()
+        exact_index.search(q, label, k)
+        exact_latencies.append((time.perf_counter() - start) * 1000)
+
+    report = []
+    for nprobe in nprobes:
+        hits, total, latencies = 0, 0, []
+        for q, label, expected in zip(queries, labels, exact_results):
+            start = time.perf_counter()
+            found = [index.filenames[row_id] for row_id, _ in index.query(q, label, k, nprobe=nprobe)]
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += len(expected.intersection(found))
+            total += len(expected)
+        report.append({
+            "nprobe": nprobe,
+            "recall": hits / total if total else 1.0,
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "exact_p50_ms": float(np.percentile(exact_latencies, 50)),
+        })
+    return report
+
+
+def benchmark_holdout_recall(vectors, filenames, labels, n_queries=200, k=3, nprobes=(1, 2, 4, 8, 16, 32),
+                             seed=0, **build_options):
+    """
+    Recall@k of IVF search for queries that are not in the index.
+
+    n_queries vectors are held out of the corpus, an index is built on the remaining vectors
+    (with build_options, e.g. n_lists, pq_m, vector_dtype) and every held-out vector is searched,
+    filtered by one of its own labels, against exact search over the same remaining vectors.
+    Unlike corpus vectors used as queries, whose own row is trivially found, this measures the
+    recall new studies get.
+
+    Returns:
+        list: benchmark_recall report, one dict per nprobe.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(filenames)
+    if n_queries >= n:
+        raise ValueError(f"Cannot hold out {n_queries} of {n} vectors.")
+    held_out = np.zeros(n, dtype=bool)
+    held_out[rng.choice(n, n_queries, replace=False)] = True
+    corpus_rows = np.flatnonzero(~held_out)
+    query_rows = np.flatnonzero(held_out)
+
+    corpus_vectors = np.asarray(vectors[corpus_rows], dtype=np.float32)
+    corpus_filenames = [filenames[row] for row in corpus_rows]
+    corpus_labels = [labels[row] for row in corpus_rows]
+    exact = LocalVectorIndex(corpus_vectors, corpus_filenames, corpus_labels)
+    with tempfile.TemporaryDirectory(prefix="xray_ann_holdout_") as index_dir:
+        IVFIndex.build(index_dir, corpus_vectors, corpus_filenames, corpus_labels, seed=seed, **build_options)
+        index = IVFIndex(index_dir, mmap=False)
+        queries = np.asarray(vectors[query_rows], dtype=np.float32)
+        query_labels = [next((label for label in labels[row] if label in index.class_names), None) for row in query_rows]
+        return benchmark_recall(index, exact, queries, query_labels, k=k, nprobes=nprobes)
+
+
+def _load_corpus(vectors_path):
+    exact = LocalVectorIndex.load(vectors_path)
+    labels = [[] for _ in exact.filenames]
+    for label, rows in exact.label_rows.items():
+        for row in rows:
+            labels[row].append(label)
+    return exact, labels
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and benchmark the IVF(-PQ) index of X-ray embeddings.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build an index from a vector store or JSONL file.")
+    build_parser.add_argument("--vectors", default="medclip_xray_vectors", help="Vector store directory or .jsonl file.")
+    build_parser.add_argument("--out", default="xray_ann_index")
+    build_parser.add_argument("--lists", type=int, default=None)
+    build_parser.add_argument("--pq-m", type=int, default=0)
+    build_parser.add_argument("--dtype", default="float16", choices=["float16", "float32"])
+
+    bench_parser = subparsers.add_parser("bench", help="Recall vs latency against exact search, on held-out queries.")
+    bench_parser.add_argument("--vectors", default="medclip_xray_vectors", help="Vector store directory or .jsonl file.")
+    bench_parser.add_argument("--index", default=None,
+                              help="Evaluate the build parameters (lists, PQ, dtype) of this index instead of --lists/--pq-m/--dtype.")
+    bench_parser.add_argument("--queries", type=int, default=200, help="Vectors held out of the index as queries.")
+    bench_parser.add_argument("--k", type=int, default=3)
+    bench_parser.add_argument("--lists", type=int, default=None)
+    bench_parser.add_argument("--pq-m", type=int, default=0)
+    bench_parser.add_argument("--dtype", default="float16", choices=["float16", "float32"])
+
+    args = parser.parse_args()
+    exact, labels = _load_corpus(args.vectors)
+
+    if args.command == "build":
+        start = time.perf_counter()
+        IVFIndex.build(args.out, exact.vectors, exact.filenames, labels, n_lists=args.lists,
+                       pq_m=args.pq_m, vector_dtype=args.dtype)
+        print(f"> Built index in {time.perf_counter() - start:.1f}s: {args.out}")
+    else:
+        build_options = {"n_lists": args.lists, "pq_m": args.pq_m, "vector_dtype": args.dtype}
+        if args.index:
+            with open(os.path.join(args.index, "manifest.json"), "r") as f:
+                manifest = json.load(f)
+            build_options = {"n_lists": manifest["n_lists"], "pq_m": manifest["pq_m"], "vector_dtype": manifest["vector_dtype"]}
+        print(f"> Held-out recall@{args.k} of {args.queries} queries, index built with {build_options}")
+        print(json.dumps(benchmark_holdout_recall(exact.vectors, exact.filenames, labels, n_queries=args.queries,
+                                                  k=args.k, **build_options), indent=2))
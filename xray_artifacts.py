@@ -0,0 +1,236 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import torch
+
+from xray_settings import get_setting
+
+
+BUNDLE_FORMAT_VERSION = 1
+DEFAULT_STORE_DIR = "model_store"
+
+# File of the store directory naming the bundle loaded by default
+CURRENT_FILE = "CURRENT"
+
+
+def file_sha256(path, chunk_size=4 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_dir():
+    return get_setting("RAISO_MODEL_STORE", DEFAULT_STORE_DIR)
+
+
+def bundle_dir(store=None, version=None):
+    """
+    Directory of a bundle: the RAISO_MODEL_BUNDLE_VERSION setting, else the version named in
+    the store's CURRENT file. None if the store holds no bundle.
+    """
+    store = store or store_dir()
+    version = version or get_setting("RAISO_MODEL_BUNDLE_VERSION")
+    if not version:
+        try:
+            with open(os.path.join(store, CURRENT_FILE), "r") as f:
+                version = f.read().strip()
+        except OSError:
+            return None
+    path = os.path.join(store, version)
+    return path if os.path.exists(os.path.join(path, "manifest.json")) else None
+
+
+def write_bundle(models, store=None, make_current=True):
+    """
+    Write model weights as a content-addressed bundle.
+
+    Each state dict is saved with torch.save (zip format, which torch.load can memory-map) and
+    listed in manifest.json with its SHA-256. The bundle version is derived from the entries,
+    so bundling the same weights twice yields the same directory and writes nothing new.
+
+    Args:
+        models (dict): name -> (state_dict, info dict recorded in the manifest, e.g. checkpoint_path).
+        store (str): Store directory. Defaults to the RAISO_MODEL_STORE setting ('model_store').
+        make_current (bool): Point the store's CURRENT file to this bundle.
+
+    Returns:
+        str: The bundle directory.
+    """
+    store = store or store_dir()
+    os.makedirs(store, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".bundle-", dir=store)
+    os.chmod(tmp_dir, 0o755)  # readable by worker processes of other users
+    try:
+        entries = {}
+        for name, (state_dict, info) in sorted(models.items()):
+            file_name = f"{name}.pt"
+            path = os.path.join(tmp_dir, file_name)
+            torch.save({key: tensor.detach().contiguous() for key, tensor in state_dict.items()}, path)
+            entries[name] = dict(info, file=file_name, sha256=file_sha256(path), bytes=os.path.getsize(path))
+
+        version = hashlib.sha256(json.dumps(entries, sort_keys=True).encode()).hexdigest()[:16]
+        manifest = {"format_version": BUNDLE_FORMAT_VERSION, "version": version, "torch_version": torch.__version__,
+                    "models": entries}
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+        path = os.path.join(store, version)
+        if os.path.exists(path):
+            shutil.rmtree(tmp_dir)
+        else:
+            os.replace(tmp_dir, path)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    if make_current:
+        tmp_current = os.path.join(store, CURRENT_FILE + ".tmp")
+        with open(tmp_current, "w") as f:
+            f.write(version + "\n")
+        os.replace(tmp_current, os.path.join(store, CURRENT_FILE))
+    return path
+
+
+def read_manifest(path):
+    with open(os.path.join(path, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != BUNDLE_FORMAT_VERSION:
+        raise ValueError(f"Bundle {path} has format version {manifest.get('format_version')}.")
+    return manifest
+
+
+def verify_bundle(path):
+    """
+    Recompute the checksum of every file of a bundle.
+
+    Returns:
+        dict: name -> True if the file matches its manifest checksum.
+    """
+    manifest = read_manifest(path)
+    return {name: file_sha256(os.path.join(path, entry["file"])) == entry["sha256"]
+            for name, entry in manifest["models"].items()}
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def _bundle_entry(name, checkpoint_path):
+    # (bundle directory, manifest entry) of a model in the current bundle, entry None if it is not bundled
+    path = bundle_dir()
+    if path is None:
+        return None, None
+    with _manifests_lock:
+        if path not in _manifests:
+            _manifests[path] = read_manifest(path)
+        manifest = _manifests[path]
+    entry = manifest["models"].get(name)
+    if entry is None or entry.get("checkpoint_path") != checkpoint_path:
+        return path, None
+    return path, entry
+
+
+def load_bundled_state_dict(name, checkpoint_path=None):
+    """
+    Memory-map the bundled weights of a model.
+
+    The tensors are views of the file pages (torch.load(mmap=True)), so every process loading
+    the same bundle shares them through the page cache instead of holding its own copy.
+    Use them with model.load_state_dict(state_dict, assign=True) to keep them mapped.
+
+    Args:
+        name (str): Model name (e.g. 'efficientnet_b0').
+        checkpoint_path (str): Fine-tuned checkpoint the weights must come from (None for the hub weights).
+
+    Returns:
+        dict: The state dict, or None if the current bundle has no such model.
+    """
+    path, entry = _bundle_entry(name, checkpoint_path)
+    if entry is None:
+        return None
+
+    file_path = os.path.join(path, entry["file"])
+    if os.path.getsize(file_path) != entry["bytes"]:
+        raise ValueError(f"{file_path} does not match its manifest (run: python xray_artifacts.py verify).")
+    return torch.load(file_path, map_location="cpu", mmap=True, weights_only=True)
+
+
+# (name, checkpoint_path) -> weights identity, resolved once per process like the weights themselves
+_identities = {}
+_identities_lock = threading.Lock()
+
+
+def weights_identity(name, checkpoint_path=None):
+    """
+    Content identity of the weights a model is loaded from: the SHA-256 of its bundled file
+    (see load_bundled_state_dict) or else of the checkpoint, e.g. 'sha256:1f0c...'.
+
+    Args:
+        name (str): Model name (e.g. 'efficientnet_b0').
+        checkpoint_path (str): Fine-tuned checkpoint (None for the hub weights).
+
+    Returns:
+        str: The identity, or None for weights downloaded from the hub (no bundle entry, no checkpoint).
+    """
+    key = (name, checkpoint_path)
+    with _identities_lock:
+        if key not in _identities:
+            _, entry = _bundle_entry(name, checkpoint_path)
+            if entry is not None:
+                identity = f"sha256:{entry['sha256'][:16]}"
+            elif checkpoint_path:
+                identity = f"sha256:{file_sha256(checkpoint_path)[:16]}"
+            else:
+                identity = None
+            _identities[key] = identity
+        return _identities[key]
+
+
+def _bundle_app_models(checkpoint_path=None):
+    # Builds the app's models from the hub (and the fine-tuned classifier checkpoint) with the usual loaders
+    import xray_classifier
+    import xray_embedder
+
+    if checkpoint_path is None:
+        checkpoint_path = xray_classifier.model_checkpoint_path
+    classifier = xray_classifier.load_model(checkpoint_path=checkpoint_path, use_bundle=False)
+    encoder = xray_embedder.load_vision_model(use_bundle=False)
+    return {
+        "efficientnet_b0": (classifier.state_dict(), {"checkpoint_path": checkpoint_path,
+                                                      "source": checkpoint_path or "timm:efficientnet_b0"}),
+        xray_embedder.EMBEDDING_MODEL_VERSION: (encoder.state_dict(), {"checkpoint_path": None,
+                                                                       "source": f"timm:{xray_embedder.EMBEDDING_MODEL_VERSION}"}),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the local model artifact store.")
+    parser.add_argument("command", choices=["bundle", "verify", "show"],
+                        help="bundle: fetch the weights and write a bundle; verify: check its checksums; show: print its manifest.")
+    parser.add_argument("--store", default=None, help="Store directory (default RAISO_MODEL_STORE or 'model_store').")
+    parser.add_argument("--checkpoint", default=None, help="Fine-tuned classifier checkpoint (default xray_classifier.model_checkpoint_path).")
+    parser.add_argument("--version", default=None, help="Bundle to verify or show (default: the current one).")
+    args = parser.parse_args()
+
+    if args.command == "bundle":
+        path = write_bundle(_bundle_app_models(args.checkpoint), store=args.store)
+        print(f"> Wrote bundle {path}")
+    else:
+        path = bundle_dir(args.store, args.version)
+        if path is None:
+            raise SystemExit("> No bundle found, run: python xray_artifacts.py bundle")
+        if args.command == "verify":
+            results = verify_bundle(path)
+            for name, ok in results.items():
+                print(f"> {name}: {'OK' if ok else 'CHECKSUM MISMATCH'}")
+            if not all(results.values()):
+                raise SystemExit(1)
+        else:
+            print(json.dumps(read_manifest(path), indent=2))
@@ -0,0 +1,241 @@
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import numpy as np
+
+
+def list_studies(source):
+    """DICOM paths of a directory (searched recursively for *.dcm) or of a worklist file (one path per line)."""
+    if os.path.isdir(source):
+        return sorted(glob(os.path.join(source, "**", "*.dcm"), recursive=True))
+    with open(source, "r") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def _init_worker():
+    # Each worker decodes one study at a time: one torch thread per process avoids oversubscribing the cores
+    import torch
+    torch.set_num_threads(1)
+
+
+def prepare_study(task):
+    """
+    Decode, de-identify and preprocess one DICOM (runs in a worker process).
+
+    Args:
+        task (tuple): (path, rules_path, de-identified output path or None).
+
+    Returns:
+        dict: path, ok, error, the de-identified output path and the float32 model input of shape (3, 224, 224).
+    """
+    import pydicom
+    from xray_dicom_deidentify import apply_plan, load_plan
+    from xray_study import XrayStudy
+
+    path, rules_path, output_path = task
+    try:
+        ds = pydicom.dcmread(path)
+        apply_plan(ds, load_plan(rules_path))
+        study = XrayStudy(ds)
+        tensor = study.tensor.numpy()
+        if output_path:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            with open(output_path, "wb") as f:
+                f.write(study.dicom_bytes)
+        return {"path": path, "ok": True, "error": None, "deidentified_path": output_path, "tensor": tensor}
+    except Exception as e:
+        return {"path": path, "ok": False, "error": f"{type(e).__name__}: {e}", "deidentified_path": None, "tensor": None}
+
+
+def _prepared_studies(paths, rules_path, deid_output_dir, input_root, workers, max_in_flight):
+    # Ordered results of prepare_study with at most max_in_flight studies decoded ahead of the consumer
+    def task(path):
+        output_path = None
+        if deid_output_dir:
+            relative_path = os.path.relpath(path, input_root) if input_root else os.path.basename(path)
+            output_path = os.path.join(deid_output_dir, relative_path)
+        return path, rules_path, output_path
+
+    if workers == 0:
+        for path in paths:
+            yield prepare_study(task(path))
+        return
+
+    # spawn: forking a process that already runs torch thread pools can deadlock
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker) as executor:
+        pending = deque()
+        paths = iter(paths)
+        for path in paths:
+            pending.append(executor.submit(prepare_study, task(path)))
+            if len(pending) >= max_in_flight:
+                break
+        while pending:
+            yield pending.popleft().result()
+            for path in paths:
+                pending.append(executor.submit(prepare_study, task(path)))
+                break
+
+
+def _infer_batch(studies, embed, similar_k):
+    # One batched forward pass (two with the ViT embedder) for the decoded studies of a batch
+    import torch
+    from xray_classifier import CLASS_NAMES, classify_and_embed_batch, classify_xray_batch
+    from xray_embedder import embed_xray_batch, embedding_backbone
+
+    tensors = [torch.from_numpy(study["tensor"]) for study in studies]
+    embeddings = None
+    if (embed or similar_k) and embedding_backbone() == "classifier":
+        probs, embeddings = classify_and_embed_batch(tensors)
+    else:
+        probs = classify_xray_batch(tensors)
+        if embed or similar_k:
+            embeddings = embed_xray_batch(tensors)
+
+    similar = [None] * len(studies)
+    if similar_k:
+        from xray_search_backends import get_search_backend
+        backend = get_search_backend()
+        # Similar X-rays carrying the top predicted label, as the app shows them per label
+        similar = [backend.search(embedding, max(p, key=p.get), similar_k) for embedding, p in zip(embeddings, probs)]
+
+    rows = []
+    for i, study in enumerate(studies):
+        row = {"path": study["path"], "ok": True, "error": "", "deidentified_path": study["deidentified_path"] or ""}
+        row.update({label: probs[i][label] for label in CLASS_NAMES})
+        row["top_label"] = max(probs[i], key=probs[i].get)
+        if similar_k:
+            row["similar"] = ";".join(similar[i])
+        rows.append(row)
+    return rows, embeddings
+
+
+def _failed_row(study):
+    return {"path": study["path"], "ok": False, "error": study["error"], "deidentified_path": ""}
+
+
+def write_results(rows, output_path):
+    """Write result rows to CSV, or to Parquet when output_path ends with .parquet."""
+    from xray_classifier import CLASS_NAMES
+
+    columns = ["path", "ok", "error", "deidentified_path"] + list(CLASS_NAMES) + ["top_label"]
+    if any("similar" in row for row in rows):
+        columns.append("similar")
+    if output_path.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        pq.write_table(pa.table({column: [row.get(column) for row in rows] for column in columns}), output_path)
+    else:
+        with open(output_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def run_batch(source, output_path, batch_size=32, workers=None, embed=False, similar_k=0,
+              embeddings_path=None, deid_output_dir=None, rules_path=None):
+    """
+    Classify every study of a directory or worklist.
+
+    Studies are decoded, de-identified and preprocessed in a process pool, at most a few
+    batches ahead of inference, while the main process classifies (and optionally embeds)
+    them in batches. Results are written as one row per study.
+
+    Args:
+        source (str): Directory of DICOMs, or worklist file with one DICOM path per line.
+        output_path (str): Results file (.csv or .parquet).
+        batch_size (int): Studies per forward pass.
+        workers (int): Decoding processes (0 decodes in the main process). Defaults to the CPU count - 1.
+        embed (bool): Also compute embeddings (written to embeddings_path).
+        similar_k (int): Also look up the top-k similar X-rays of the top predicted label (0 to skip).
+        embeddings_path (str): .npy file for the (N, dim) embeddings of the successful studies, in row order.
+        deid_output_dir (str): Also write the de-identified DICOMs there.
+        rules_path (str): De-identification rules. Defaults to the app's rules.
+
+    Returns:
+        dict: Counts and throughput.
+    """
+    from xray_dicom_deidentify import DEFAULT_RULES_PATH, load_plan
+    from xray_inference_service import InferenceService
+
+    rules_path = rules_path or DEFAULT_RULES_PATH
+    load_plan(rules_path)  # invalid rules fail before any work is started
+    if output_path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow), or use a .csv output.") from None
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 2) - 1)
+    paths = list_studies(source)
+    input_root = source if os.path.isdir(source) else None
+    print(f"> {len(paths)} studies, {workers} decoding workers, batches of {batch_size}")
+
+    InferenceService().warm_up()
+    rows, embeddings, batch = [], [], []
+    start = time.perf_counter()
+
+    def flush():
+        batch_rows, batch_embeddings = _infer_batch(batch, embed, similar_k)
+        rows.extend(batch_rows)
+        if embed and batch_embeddings is not None:
+            embeddings.append(np.asarray(batch_embeddings, dtype=np.float32))
+        batch.clear()
+
+    n_done = 0
+    for study in _prepared_studies(paths, rules_path, deid_output_dir, input_root, workers,
+                                   max_in_flight=max(2 * batch_size, 4 * max(workers, 1))):
+        if study["ok"]:
+            batch.append(study)
+            if len(batch) == batch_size:
+                flush()
+        else:
+            rows.append(_failed_row(study))
+        n_done += 1
+        if n_done % batch_size == 0 or n_done == len(paths):
+            elapsed = time.perf_counter() - start
+            sys.stdout.write(f"\r> {n_done}/{len(paths)} studies ({60.0 * n_done / elapsed:.0f} studies/min)")
+            sys.stdout.flush()
+    if batch:
+        flush()
+    elapsed = time.perf_counter() - start
+    print()
+
+    # Keep the worklist order (failed studies were appended as soon as they came back)
+    order = {path: i for i, path in enumerate(paths)}
+    rows.sort(key=lambda row: order[row["path"]])
+    write_results(rows, output_path)
+    if embed and embeddings_path:
+        np.save(embeddings_path, np.concatenate(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32))
+
+    n_failed = sum(1 for row in rows if not row["ok"])
+    summary = {"studies": len(rows), "failed": n_failed, "seconds": elapsed,
+               "studies_per_minute": 60.0 * len(rows) / elapsed if elapsed > 0 else 0.0}
+    print(f"> {len(rows)} studies in {elapsed:.1f}s ({summary['studies_per_minute']:.0f} studies/min), "
+          f"{n_failed} failed, results in {output_path}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify a directory or worklist of DICOM X-rays offline.")
+    parser.add_argument("source", help="Directory of .dcm files, or worklist file with one DICOM path per line.")
+    parser.add_argument("--output", default="raiso_results.csv", help="Results file (.csv or .parquet).")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=None, help="Decoding processes (default: CPU count - 1, 0 = no pool).")
+    parser.add_argument("--embed", action="store_true", help="Also compute embeddings (see --embeddings).")
+    parser.add_argument("--embeddings", default=None, help=".npy file for the embeddings of the successful studies.")
+    parser.add_argument("--similar", type=int, default=0, help="Top-k similar X-rays of the top predicted label (0 to skip).")
+    parser.add_argument("--deid-output-dir", default=None, help="Also write the de-identified DICOMs to this directory.")
+    parser.add_argument("--rules", default=None, help="De-identification rules file.")
+    args = parser.parse_args()
+
+    run_batch(args.source, args.output, batch_size=args.batch_size, workers=args.workers, embed=args.embed or bool(args.embeddings),
+              similar_k=args.similar, embeddings_path=args.embeddings, deid_output_dir=args.deid_output_dir,
+              rules_path=args.rules)
@@ -0,0 +1,339 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import numpy as np
+
+
+def synthetic_dicom(rows=2048, columns=2048, bits_stored=12, seed=0):
+    """
+    Build a DICOM X-ray with random content, the same way to_reproduce/png_to_dcm.py builds
+    its files (explicit VR little endian, MONOCHROME2), plus the header fields de-identification rewrites.
+
+    Args:
+        rows (int): Image height.
+        columns (int): Image width.
+        bits_stored (int): 8 for uint8 pixels, up to 16 for uint16 pixels.
+        seed (int): Seed of the random image.
+
+    Returns:
+        pydicom.Dataset: The dataset, ready for save_as.
+    """
+    import pydicom
+    from pydicom.dataset import FileDataset
+
+    rng = np.random.default_rng(seed)
+    # Smooth background + noise: compresses and windows like an image rather than like a constant
+    y, x = np.mgrid[0:rows, 0:columns]
+    image = 0.5 + 0.25 * np.sin(x / (columns / 6.0)) * np.cos(y / (rows / 4.0)) + 0.1 * rng.standard_normal((rows, columns))
+    max_value = (1 << bits_stored) - 1
+    dtype = np.uint8 if bits_stored <= 8 else np.uint16
+    pixels = (np.clip(image, 0.0, 1.0) * max_value).astype(dtype)
+
+    file_meta = pydicom.Dataset()
+    file_meta.MediaStorageSOPClassUID = pydicom.uid.SecondaryCaptureImageStorage
+    file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    file_meta.ImplementationClassUID = pydicom.uid.PYDICOM_IMPLEMENTATION_UID
+    file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+
+    dt = datetime.datetime.now()
+    ds = FileDataset(f"synthetic_{seed}.dcm", {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.PatientName = f"Test^Patient{seed}"
+    ds.PatientID = f"{seed:06d}"
+    ds.PatientBirthDate = "19700101"
+    ds.InstitutionName = "Benchmark Hospital"
+    ds.ReferringPhysicianName = "Doe^John"
+    ds.AccessionNumber = f"ACC{seed:06d}"
+    ds.Modality = "CR"
+    ds.StudyInstanceUID = pydicom.uid.generate_uid()
+    ds.SeriesInstanceUID = pydicom.uid.generate_uid()
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.StudyDate = dt.strftime('%Y%m%d')
+    ds.StudyTime = dt.strftime('%H%M%S')
+
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.PixelRepresentation = 0
+    ds.BitsAllocated = 8 if dtype == np.uint8 else 16
+    ds.BitsStored = bits_stored
+    ds.HighBit = bits_stored - 1
+    ds.PixelData = pixels.tobytes()
+    return ds
+
+
+def synthetic_dicom_bytes(**kwargs):
+    buffer = BytesIO()
+    synthetic_dicom(**kwargs).save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+def latency_stats(seconds, items_per_call=1):
+    """p50/p95/mean latency in ms and throughput (items/s) of a list of call durations."""
+    seconds = np.asarray(seconds, dtype=np.float64)
+    return {
+        "iterations": int(len(seconds)),
+        "p50_ms": float(np.percentile(seconds, 50) * 1000.0),
+        "p95_ms": float(np.percentile(seconds, 95) * 1000.0),
+        "mean_ms": float(seconds.mean() * 1000.0),
+        "throughput_per_s": float(items_per_call * len(seconds) / seconds.sum()) if seconds.sum() > 0 else 0.0,
+    }
+
+
+def measure(fn, iterations, warmup=1, items_per_call=1, setup=None):
+    """
+    Time repeated calls of fn.
+
+    Args:
+        fn (callable): Called as fn() or, with setup, fn(setup()). Only the call itself is timed.
+        iterations (int): Timed calls.
+        warmup (int): Untimed calls first.
+        items_per_call (int): Items processed per call (e.g. the batch size), for the throughput.
+        setup (callable): Builds a fresh input for each call (e.g. a dataset de-identification modifies).
+
+    Returns:
+        dict: See latency_stats.
+    """
+    for _ in range(warmup):
+        fn(setup()) if setup else fn()
+    durations = []
+    for _ in range(iterations):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg) if setup else fn()
+        durations.append(time.perf_counter() - start)
+    return latency_stats(durations, items_per_call)
+
+
+# ===== Benchmarks: each runs in a fresh process and returns {case: stats} =====
+
+def bench_preprocess(options):
+    import pydicom
+    from xray_preprocessing import to_input_batch, to_input_tensor
+
+    ds = pydicom.dcmread(BytesIO(synthetic_dicom_bytes(rows=options["rows"], columns=options["columns"])))
+    pixels = ds.pixel_array
+    batch_size = options["batch_size"]
+    return {
+        "to_input_tensor": measure(lambda: to_input_tensor(pixels, ds), options["iterations"]),
+        f"to_input_batch_{batch_size}": measure(lambda: to_input_batch([pixels] * batch_size, [ds] * batch_size),
+                                                max(1, options["iterations"] // batch_size), items_per_call=batch_size),
+    }
+
+
+def bench_deidentify(options):
+    import pydicom
+    from xray_dicom_deidentify import DEFAULT_RULES_PATH, anonymize_dataset, compile_rules, load_rules
+
+    data = synthetic_dicom_bytes(rows=options["rows"], columns=options["columns"])
+    rules = load_rules(DEFAULT_RULES_PATH)
+    plan = compile_rules(rules)
+    # Each call gets a freshly read dataset, since de-identification modifies it in place
+    read = lambda: pydicom.dcmread(BytesIO(data))
+    return {
+        "dcmread": measure(lambda: read().pixel_array, options["iterations"]),
+        "anonymize_dataset": measure(lambda ds: anonymize_dataset(ds, plan), options["iterations"], setup=read),
+        "anonymize_dataset_uncompiled_rules": measure(lambda ds: anonymize_dataset(ds, rules), options["iterations"],
+                                                      setup=read),
+    }
+
+
+def _model_inputs(options, n):
+    # Preprocessed inputs of n synthetic studies, so model benchmarks time the models only
+    import pydicom
+    from xray_preprocessing import to_input_tensor
+
+    inputs = []
+    for seed in range(n):
+        ds = pydicom.dcmread(BytesIO(synthetic_dicom_bytes(rows=512, columns=512, seed=seed)))
+        inputs.append(to_input_tensor(ds.pixel_array, ds))
+    return inputs
+
+
+def bench_classify(options):
+    from xray_classifier import TTA_VIEWS, classify_xray, classify_xray_batch, classify_xray_tta
+
+    batch_size = options["batch_size"]
+    inputs = _model_inputs(options, batch_size)
+    # Cold: first call of the process, including the model load and warm-up
+    start = time.perf_counter()
+    classify_xray(inputs[0])
+    cold_seconds = time.perf_counter() - start
+    return {
+        "cold": latency_stats([cold_seconds]),
+        "warm_batch_1": measure(lambda: classify_xray(inputs[0]), options["iterations"]),
+        f"warm_batch_{batch_size}": measure(lambda: classify_xray_batch(inputs), max(1, options["iterations"] // 2),
+                                            items_per_call=batch_size),
+        # Every view run (no fast path): compare with warm_batch_1 for the added latency
+        f"tta_{len(TTA_VIEWS)}_views": measure(lambda: classify_xray_tta(inputs[0], fast_path_margin=0),
+                                               options["iterations"]),
+    }
+
+
+def bench_gradcam(options):
+    import pydicom
+    from grad_cam import get_gradcam
+    from xray_classifier import CLASS_NAMES
+    from xray_heatmap_render import STREAM_MAX_SIZE, render_overlays
+
+    tensor = _model_inputs(options, 1)[0].unsqueeze(0)
+    gradcam = get_gradcam()
+    # Overlays on the raw synthetic image: windowing, upsampling and blending at full bit depth
+    ds = pydicom.dcmread(BytesIO(synthetic_dicom_bytes(rows=options["rows"], columns=options["columns"])))
+    pixels = ds.pixel_array
+    heatmaps = gradcam.generate(tensor, list(range(3)))[0]
+    return {
+        "generate_1_class": measure(lambda: gradcam.generate(tensor, 0), options["iterations"]),
+        "generate_all_classes": measure(lambda: gradcam.generate(tensor, list(range(len(CLASS_NAMES)))), options["iterations"]),
+        "overlay_native": measure(lambda: render_overlays(heatmaps[0], pixels, ds), options["iterations"]),
+        "overlay_native_3_labels": measure(lambda: render_overlays(heatmaps, pixels, ds), options["iterations"],
+                                           items_per_call=3),
+        f"overlay_{STREAM_MAX_SIZE}": measure(lambda: render_overlays(heatmaps[0], pixels, ds, max_size=STREAM_MAX_SIZE),
+                                              options["iterations"]),
+    }
+
+
+def bench_embed(options):
+    from xray_embedder import embed_xray, embed_xray_batch
+
+    batch_size = options["batch_size"]
+    inputs = _model_inputs(options, batch_size)
+    start = time.perf_counter()
+    embed_xray(inputs[0])
+    cold_seconds = time.perf_counter() - start
+    return {
+        "cold": latency_stats([cold_seconds]),
+        "warm_batch_1": measure(lambda: embed_xray(inputs[0]), options["iterations"]),
+        f"warm_batch_{batch_size}": measure(lambda: embed_xray_batch(inputs), max(1, options["iterations"] // 2),
+                                            items_per_call=batch_size),
+    }
+
+
+def bench_search(options):
+    from xray_labels import CLASS_NAMES  # keeps torch out of the peak RSS of the search benchmark
+    from xray_search_backends import LocalVectorIndex
+
+    rng = np.random.default_rng(0)
+    dim = options["dim"]
+    queries = rng.standard_normal((options["iterations"] + 1, dim)).astype(np.float32)
+    results = {}
+    for size in options["corpus_sizes"]:
+        vectors = rng.standard_normal((size, dim)).astype(np.float32)
+        # 1-3 labels per vector, as in the NIH dataset
+        labels = [list(rng.choice(CLASS_NAMES, size=rng.integers(1, 4), replace=False)) for _ in range(size)]
+        index = LocalVectorIndex(vectors, [f"img{i}.png" for i in range(size)], labels)
+        queries_iter = iter(queries)
+        results[f"local_{size}"] = measure(lambda: index.search(next(queries_iter), CLASS_NAMES[0], 3),
+                                           options["iterations"])
+    return results
+
+
+BENCHMARKS = {
+    "preprocess": bench_preprocess,
+    "deidentify": bench_deidentify,
+    "classify": bench_classify,
+    "gradcam": bench_gradcam,
+    "embed": bench_embed,
+    "search": bench_search,
+}
+
+
+def _run_benchmark(name, options):
+    # Runs in a fresh process: cold timings and peak RSS belong to this benchmark only
+    results = BENCHMARKS[name](options)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # KiB on Linux
+    return {"cases": results, "peak_rss_mb": peak_rss_mb}
+
+
+def run_benchmarks(names, options):
+    """
+    Run benchmarks, each in its own spawned process.
+
+    Args:
+        names (list): Keys of BENCHMARKS.
+        options (dict): iterations, batch_size, rows, columns, dim and corpus_sizes.
+
+    Returns:
+        dict: name -> {"cases": {case: latency stats}, "peak_rss_mb": ...}.
+    """
+    results = {}
+    for name in names:
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results[name] = executor.submit(_run_benchmark, name, options).result()
+        print(f"> {name}: {time.perf_counter() - start:.1f}s, peak RSS {results[name]['peak_rss_mb']:.0f} MB")
+        for case, stats in results[name]["cases"].items():
+            print(f"  {case}: p50 {stats['p50_ms']:.2f} ms, p95 {stats['p95_ms']:.2f} ms, "
+                  f"{stats['throughput_per_s']:.1f}/s")
+    return results
+
+
+def environment():
+    """What the numbers depend on: commit, versions, CPU and the settings that change the models."""
+    import torch
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit or None,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "settings": {key: value for key, value in os.environ.items() if key.startswith("RAISO_")},
+    }
+
+
+def compare(report, baseline):
+    """Print the p50 change of every case present in both reports."""
+    print(f"> Compared with {baseline['environment'].get('commit')} ({baseline['environment'].get('date')}):")
+    for name, result in report["benchmarks"].items():
+        for case, stats in result["cases"].items():
+            before = baseline["benchmarks"].get(name, {}).get("cases", {}).get(case)
+            if before and before["p50_ms"] > 0:
+                change = 100.0 * (stats["p50_ms"] - before["p50_ms"]) / before["p50_ms"]
+                print(f"  {name}/{case}: p50 {before['p50_ms']:.2f} -> {stats['p50_ms']:.2f} ms ({change:+.1f}%)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the inference, de-identification and search hot paths.")
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS), help=f"Any of {', '.join(BENCHMARKS)} (default: all).")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--size", type=int, nargs=2, default=(2048, 2048), metavar=("ROWS", "COLUMNS"),
+                        help="Synthetic DICOM size for the preprocessing and de-identification benchmarks.")
+    parser.add_argument("--corpus-sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--dim", type=int, default=768, help="Embedding dimension of the search benchmark.")
+    parser.add_argument("--json", default=None, help="Write the report to this file.")
+    parser.add_argument("--compare", default=None, help="Earlier report to compare p50 latencies with.")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Unknown benchmarks {unknown}. Use any of {list(BENCHMARKS)}.")
+    options = {"iterations": args.iterations, "batch_size": args.batch_size, "rows": args.size[0],
+               "columns": args.size[1], "dim": args.dim, "corpus_sizes": args.corpus_sizes}
+    report = {"environment": environment(), "options": options,
+              "benchmarks": run_benchmarks(args.benchmarks, options)}
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"> Report written to {args.json}")
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(report, json.load(f))
@@ -1,57 +1,266 @@
+import numpy as np
 import torch
 import torch.nn as nn
-from torchvision import transforms
+import torch.nn.functional as F
 from PIL import Image
-import numpy as np
-import timm
+import threading
+import time
+import uuid
 
+from xray_artifacts import load_bundled_state_dict, weights_identity
+from xray_labels import CLASS_NAMES, CLASSIFICATION_THRESHOLD
+from xray_model_registry import registry
+from xray_micro_batcher import MicroBatcher
+from xray_optimize import engine_version, get_inference_model as get_optimized_model
+from xray_preprocessing import IMAGENET_MEAN, IMAGENET_STD, INPUT_SIZE, to_input_batch
+from xray_tracing import span
 
-# Define CheXpert or ChestX-ray14 labels (example)
-CLASS_NAMES = [
-    'Atelectasis', 'Cardiomegaly', 'Consolidation', 'Edema', 'Effusion',
-    'Emphysema', 'Fibrosis', 'Hernia', 'Infiltration', 'Mass',
-    'Nodule', 'Pleural_Thickening', 'Pneumonia', 'Pneumothorax'
-]
 
 model_checkpoint_path = None # 'path_to_your_trained_model.pth'
 
-# Image preprocessing
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),  # EfficientNetB0 size
-    transforms.ToTensor(),
-    transforms.Normalize([0.485, 0.456, 0.406],  # Imagenet mean
-                         [0.229, 0.224, 0.225])  # Imagenet std
-])
-
 # Load EfficientNet B0 model from timm
-def load_model(num_classes=len(CLASS_NAMES), checkpoint_path=None):
-    model = timm.create_model('efficientnet_b0', pretrained=True)
-    model.classifier = nn.Sequential(
-        nn.Dropout(0.3),
-        nn.Linear(model.classifier.in_features, num_classes)
-    )
-    if checkpoint_path:
+# Weights come from the local artifact store when it holds them (see xray_artifacts), else from the hub
+def load_model(num_classes=len(CLASS_NAMES), checkpoint_path=None, use_bundle=True):
+    import timm  # imported on first model load: timm import is slow and most app reruns never need it
+
+    state_dict = load_bundled_state_dict('efficientnet_b0', checkpoint_path) if use_bundle else None
+    # With bundled weights, build on the meta device (no init, no download) and adopt the memory-mapped tensors
+    with torch.device('meta' if state_dict is not None else 'cpu'):
+        model = timm.create_model('efficientnet_b0', pretrained=state_dict is None)
+        model.classifier = nn.Sequential(
+            nn.Dropout(0.3),
+            nn.Linear(model.classifier.in_features, num_classes)
+        )
+    if state_dict is not None:
+        model.load_state_dict(state_dict, assign=True)
+    elif checkpoint_path:
         model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
     model.eval()
     return model
 
+# Engine serving get_inference_model (see xray_optimize.resolve_engine), e.g. 'eager' or 'onnx-int8'
+def inference_engine():
+    return engine_version('efficientnet_b0', model_checkpoint_path)
+
+# Without a checkpoint or bundled weights the classifier head is initialized randomly in each process
+_random_head_token = uuid.uuid4().hex[:16]
+
+# Content identity of the classifier weights (see xray_artifacts.weights_identity)
+def weights_version():
+    return weights_identity('efficientnet_b0', model_checkpoint_path) or f"random-head:{_random_head_token}"
+
+# Identifies the weights and the engine behind cached results (see xray_result_cache):
+# optimized and quantized engines give (slightly) different probabilities than the eager model
+def model_version(engine=None):
+    return f"efficientnet_b0:{weights_version()}:{engine or inference_engine()}"
+
+# Shared, already loaded and warmed up model for this process
+def get_model(checkpoint_path=None):
+    if checkpoint_path is None:
+        checkpoint_path = model_checkpoint_path
+    return registry.get('efficientnet_b0', load_model, checkpoint_path=checkpoint_path)
+
+# Model of the selected inference engine (see xray_optimize), for predictions without activations.
+# Grad-CAM and classify_xray_explainable keep using the eager model.
+def get_inference_model(checkpoint_path=None):
+    if checkpoint_path is None:
+        checkpoint_path = model_checkpoint_path
+    return get_optimized_model('efficientnet_b0', load_model, checkpoint_path=checkpoint_path)
+
+# Micro-batching: set use_micro_batching = True to gather concurrent classify_xray calls
+# (e.g. from several Streamlit sessions) into shared forward passes
+use_micro_batching = False
+micro_batch_max_size = 8
+micro_batch_max_wait_ms = 5.0
+_micro_batcher = None
+_micro_batcher_lock = threading.Lock()
+
+def get_micro_batcher():
+    global _micro_batcher
+    with _micro_batcher_lock:
+        if _micro_batcher is None:
+            _micro_batcher = MicroBatcher(classify_xray_batch, max_batch_size=micro_batch_max_size,
+                                          max_wait_ms=micro_batch_max_wait_ms)
+        return _micro_batcher
+
+# Forward pass that also returns the conv_head output (the Grad-CAM target layer).
+# Runs the EfficientNet stages explicitly instead of using hooks, so it is safe on the shared model.
+def forward_with_activations(model, input_tensor, return_features=False):
+    x = model.conv_stem(input_tensor)
+    x = model.bn1(x)
+    x = model.blocks(x)
+    activations = model.conv_head(x)
+    # Pooled features (input of the classifier head), also usable as similarity embeddings
+    features = model.forward_head(model.bn2(activations), pre_logits=True)
+    outputs = model.classifier(features)
+    if return_features:
+        return outputs, activations, features
+    return outputs, activations
+
+# Batched inference function: one forward pass for all images
+def classify_xray_batch(images, return_activations=False):
+    if len(images) == 0:
+        return ([], None) if return_activations else []
+    # Images can be pixel arrays, PIL Images or tensors already preprocessed by xray_preprocessing
+    input_tensor = to_input_batch(images)
+    # Shared model (use your own checkpoint if available through model_checkpoint_path),
+    # fetched first so a first-call model load is not timed as a forward pass
+    model = get_model() if return_activations else get_inference_model()
+    with torch.no_grad(), span("classifier_forward"):
+        if return_activations:
+            outputs, activations = forward_with_activations(model, input_tensor)
+        else:
+            outputs = model(input_tensor)
+        probs = torch.sigmoid(outputs).numpy()  # multi-label sigmoid, shape (N, len(CLASS_NAMES))
+    results = [
+        {label: float(prob) for label, prob in zip(CLASS_NAMES, image_probs)}
+        for image_probs in probs
+    ]
+    if return_activations:
+        return results, activations
+    return results
+
 # Inference function
 def classify_xray(image: Image.Image):#, model: torch.nn.Module
-    # Convert DICOM pixel ndarray to PIL Image
-    if isinstance(image, np.ndarray):
-        image = Image.fromarray(image)
-    elif not isinstance(image, Image.Image):
-        raise ValueError("Input must be a PIL Image or a NumPy array.")
-    # Preprocess image
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
-    input_tensor = transform(image).unsqueeze(0)  # Add batch dimension
+    if use_micro_batching:
+        return get_micro_batcher().submit(image)
+    return classify_xray_batch([image])[0]
+
+# Explain-capable inference: also returns the conv_head activations of the same forward pass,
+# which grad_cam.gradcam_from_activations turns into heatmaps without another forward pass
+def classify_xray_explainable(image):
+    results, activations = classify_xray_batch([image], return_activations=True)
+    return results[0], activations
+
+# Test-time augmentation (classify_xray_tta): the views averaged (or max-reduced) for one prediction.
+# 'crop:f' is a center crop of a fraction f resized back to 224x224, 'contrast:f' scales around the mean
+# intensity and 'gamma:g' applies a gamma curve.
+TTA_VIEWS = ('identity', 'hflip', 'crop:0.9', 'crop:0.8', 'contrast:1.2', 'gamma:0.8')
+TTA_REDUCTIONS = ('mean', 'max')
+tta_reduce = 'mean'
+# Fast path: skip TTA when every base probability is farther than this from CLASSIFICATION_THRESHOLD (0 disables it)
+tta_fast_path_margin = 0.15
+
+def tta_views(input_tensor, views=TTA_VIEWS):
+    """
+    Augmented copies of one preprocessed image, as one batch.
+
+    Args:
+        input_tensor (torch.Tensor): Normalized model input of shape (3, 224, 224).
+        views (tuple): View specs, see TTA_VIEWS.
+
+    Returns:
+        torch.Tensor: Normalized batch of shape (len(views), 3, 224, 224).
+    """
+    image = input_tensor * IMAGENET_STD + IMAGENET_MEAN  # back to [0, 1] intensities
+    batch = []
+    for view in views:
+        name, _, arg = view.partition(':')
+        if name == 'identity':
+            batch.append(image)
+        elif name == 'hflip':
+            batch.append(image.flip(-1))
+        elif name == 'crop':
+            size = round(INPUT_SIZE[0] * float(arg))
+            top = (INPUT_SIZE[0] - size) // 2
+            left = (INPUT_SIZE[1] - size) // 2
+            crop = image[None, :, top:top + size, left:left + size]
+            batch.append(F.interpolate(crop, size=INPUT_SIZE, mode='bilinear', align_corners=False, antialias=True)[0])
+        elif name == 'contrast':
+            mean = image.mean()
+            batch.append(((image - mean) * float(arg) + mean).clamp(0.0, 1.0))
+        elif name == 'gamma':
+            batch.append(image.clamp(0.0, 1.0).pow(float(arg)))
+        else:
+            raise ValueError(f"Unknown TTA view '{view}'.")
+    # Normalize all views in one op
+    return (torch.stack(batch) - IMAGENET_MEAN) / IMAGENET_STD
+
+def _reduce_views(probs, reduce):
+    # probs: (V, num_classes) tensor -> (num_classes,) NumPy array
+    if callable(reduce):
+        return np.asarray(reduce(probs.numpy()), dtype=np.float64)
+    if reduce == 'mean':
+        return probs.mean(dim=0).numpy()
+    if reduce == 'max':
+        return probs.amax(dim=0).numpy()
+    raise ValueError(f"Unknown TTA reduction '{reduce}'. Use one of {TTA_REDUCTIONS} or a callable.")
+
+def classify_xray_tta(image, views=None, reduce=None, fast_path_margin=None):
+    """
+    Test-time augmentation: classify augmented views of an image in one batched forward pass
+    and reduce their probabilities to one prediction.
+
+    With a fast path margin, the plain image is classified first and the augmented views are
+    only run when a label is within the margin of CLASSIFICATION_THRESHOLD, i.e. when they can
+    change a finding.
+
+    Args:
+        image: Pixel array, PIL Image or preprocessed tensor, as for classify_xray.
+        views (tuple): View specs. Defaults to TTA_VIEWS.
+        reduce (str | callable): 'mean', 'max', or a function mapping the (V, num_classes)
+            probabilities to num_classes values. Defaults to tta_reduce.
+        fast_path_margin (float): Defaults to tta_fast_path_margin (0 always runs every view).
+
+    Returns:
+        tuple: (label -> probability dict, info dict with the number of views run, whether TTA
+        ran, and the seconds spent in the base pass and in the augmented pass).
+    """
+    views = TTA_VIEWS if views is None else tuple(views)
+    reduce = tta_reduce if reduce is None else reduce
+    margin = tta_fast_path_margin if fast_path_margin is None else fast_path_margin
+    input_tensor = to_input_batch([image])[0]
+    model = get_inference_model()
+    info = {"tta": True, "views": len(views), "base_seconds": None, "tta_seconds": None}
+
+    base_probs = None
     with torch.no_grad():
-        # Load model (use your own checkpoint if available)
-        model = load_model(checkpoint_path=model_checkpoint_path)
-        outputs = model(input_tensor)
-        probs = torch.sigmoid(outputs).squeeze().numpy()  # multi-label sigmoid
-    results = {
-        label: float(prob) for label, prob in zip(CLASS_NAMES, probs)
-    }
-    return results
\ No newline at end of file
+        if margin:
+            start = time.perf_counter()
+            with span("classifier_forward"):
+                base_probs = torch.sigmoid(model(input_tensor[None]))
+            info["base_seconds"] = time.perf_counter() - start
+            if ((base_probs[0] - CLASSIFICATION_THRESHOLD).abs() > margin).all():
+                info.update(tta=False, views=1)
+                return {label: float(prob) for label, prob in zip(CLASS_NAMES, base_probs[0])}, info
+            views = tuple(view for view in views if view != 'identity')  # already classified
+
+        probs = base_probs if base_probs is not None else torch.empty((0, len(CLASS_NAMES)))
+        if views:
+            start = time.perf_counter()
+            with span("classifier_tta_forward"):
+                probs = torch.cat([probs, torch.sigmoid(model(tta_views(input_tensor, views)))])
+            info["tta_seconds"] = time.perf_counter() - start
+    reduced = _reduce_views(probs, reduce)
+    return {label: float(prob) for label, prob in zip(CLASS_NAMES, reduced)}, info
+
+# Identifies the pooled classifier features used as embeddings (see xray_embedder)
+def feature_embedding_version():
+    return f"{model_version('eager')}:pooled"  # classify_and_embed_batch always runs the eager model
+
+# One forward pass for both outputs: probabilities and the pooled classifier features (1280-d)
+# used as similarity embeddings when RAISO_EMBEDDING_BACKBONE is 'classifier'
+def classify_and_embed_batch(images, return_activations=False):
+    if len(images) == 0:
+        embeddings = np.empty((0, get_model().num_features), dtype=np.float32)
+        return ([], embeddings, None) if return_activations else ([], embeddings)
+    input_tensor = to_input_batch(images)
+    model = get_model()
+    with torch.no_grad(), span("classifier_forward"):
+        outputs, activations, features = forward_with_activations(model, input_tensor, return_features=True)
+        probs = torch.sigmoid(outputs).numpy()
+    results = [
+        {label: float(prob) for label, prob in zip(CLASS_NAMES, image_probs)}
+        for image_probs in probs
+    ]
+    if return_activations:
+        return results, features.numpy(), activations
+    return results, features.numpy()
+
+def classify_and_embed(image, return_activations=False):
+    outputs = classify_and_embed_batch([image], return_activations=return_activations)
+    if return_activations:
+        results, embeddings, activations = outputs
+        return results[0], embeddings[0], activations
+    results, embeddings = outputs
+    return results[0], embeddings[0]
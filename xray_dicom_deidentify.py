@@ -1,74 +1,255 @@
 import os
 from io import BytesIO
 import json
+import shutil
+import struct
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+from glob import glob
 import requests
-import streamlit as st
+import pydicom
+from pydicom.datadict import dictionary_VR
 from pydicom.uid import generate_uid
 from pydicom.tag import Tag
 from pydicom.dataelem import DataElement
 
+from xray_tracing import traced
+
+
+DEFAULT_RULES_PATH = os.path.join("config", "xray_deidentification_rules.json")
+
+# Replacement value that generates a fresh UID each time the plan is applied
+AUTO_UID = "auto"
+
+# Compiled rules: Tag objects and VRs resolved once, immutable so one plan is safely shared
+DeidPlan = namedtuple("DeidPlan", ["remove_tags", "replacements"])
+Replacement = namedtuple("Replacement", ["tag", "vr", "value"])
+DeidResult = namedtuple("DeidResult", ["path", "output_path", "ok", "seconds", "error"])
+
 
 def load_rules(rules_path):
     with open(rules_path, 'r') as f:
         return json.load(f)
 
-def anonymize_dataset(ds, rules):
-    # Remove tags
-    for tag_str in rules.get("remove", {}).get("tags", []):
-        try:
-            # if isinstance(tag_str, str) and "," in tag_str:
-            tag_tuple = tuple(int(x.strip(), 16) for x in tag_str.strip("()").split(","))
-            #print("tage:", tag_str, " - tag_tuple:", tag_tuple)
-            tag = Tag(tag_tuple)
+def parse_tag(tag_str):
+    # "(0010,0020)" -> Tag(0x0010, 0x0020)
+    try:
+        return Tag(tuple(int(x.strip(), 16) for x in tag_str.strip().strip("()").split(",")))
+    except Exception as e:
+        raise ValueError(f"Invalid tag {tag_str!r} in de-identification rules: {e}")
 
-            if tag in ds:
-                del ds[tag]
-        except Exception as e:
-            print(f"Could not remove tag {tag_str}: {e}")
+def compile_rules(rules):
+    """
+    Compile de-identification rules into a DeidPlan.
 
-    # Replace values
-    for tag, value in rules.get("replace", {}).get("tags", {}).items():
+    Tag strings are parsed once and the VR of every replacement is taken from the DICOM
+    dictionary (private or unknown tags fall back to 'LO', Long String).
+
+    Raises:
+        ValueError: If a tag of the rules cannot be parsed.
+    """
+    remove_tags = tuple(parse_tag(tag_str) for tag_str in rules.get("remove", {}).get("tags", []))
+
+    replacements = []
+    for tag_str, value in rules.get("replace", {}).get("tags", {}).items():
+        tag = parse_tag(tag_str)
         try:
+            vr = dictionary_VR(tag)
+        except KeyError:
+            vr = 'LO'
+        replacements.append(Replacement(tag, vr, value))
 
-            #if isinstance(tag, str) and "," in tag:
-            tag_tuple = tuple(int(x.strip(), 16) for x in tag.strip("()").split(","))
-            tag = Tag(tag_tuple)
+    return DeidPlan(remove_tags, tuple(replacements))
 
-            # Determine value
-            if value == "auto":
-                new_value = generate_uid()
-            elif value == "ANON":
-                new_value = "ANON"
-            else:
-                new_value = value # Keep it as it's
+@lru_cache(maxsize=None)
+def load_plan(rules_path=DEFAULT_RULES_PATH):
+    """Load and compile a rules file once per process."""
+    return compile_rules(load_rules(rules_path))
 
-            # Determine VR (Value Representation) from existing tag if possible
-            if tag in ds:
-                vr = ds[tag].VR
-            else:
-                # Fallback: use 'LO' (Long String) for general text
-                vr = 'LO'
+@traced("deidentify")
+def apply_plan(ds, plan):
+    # Remove tags
+    for tag in plan.remove_tags:
+        if tag in ds:
+            del ds[tag]
 
-            # Create proper DataElement
-            ds[tag] = DataElement(tag, vr, new_value)
+    # Replace values
+    for tag, vr, value in plan.replacements:
+        new_value = generate_uid() if value == AUTO_UID else value
+        # Ambiguous dictionary VRs (e.g. 'US or SS') are resolved from the existing element
+        if " or " in vr:
+            vr = ds[tag].VR if tag in ds else vr.split(" or ")[0]
+        ds[tag] = DataElement(tag, vr, new_value)
 
-        except Exception as e:
-            print(f"Could not replace tag {tag}: {e}")
+    # The file meta header repeats the instance UID (0002,0003): keep it in sync, never the source UID
+    file_meta = getattr(ds, "file_meta", None)
+    if file_meta is not None and "MediaStorageSOPInstanceUID" in file_meta:
+        file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID if "SOPInstanceUID" in ds else generate_uid()
 
     return ds
 
-def de_id_dcm_on_premise(dicom_data):
+def anonymize_dataset(ds, rules):
+    # rules can be the JSON rules dict or an already compiled DeidPlan
+    plan = rules if isinstance(rules, DeidPlan) else compile_rules(rules)
+    return apply_plan(ds, plan)
 
-    # Load rules
-    rules = load_rules(os.path.join("config", "xray_deidentification_rules.json"))
+def de_id_dcm_on_premise(dicom_data):
 
-    # Apply anonymization
-    deidentified_ds = anonymize_dataset(dicom_data, rules)
+    # Apply anonymization with the compiled (cached) rules
+    deidentified_ds = apply_plan(dicom_data, load_plan())
 
     return deidentified_ds
 
+# Explicit VRs a pixel data element can have
+_PIXEL_VRS = (b'OB', b'OW', b'OF', b'OD', b'OL', b'OV', b'UN')
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+
+def _read_element_header(fp):
+    # Little endian element header at the current position: (tag, VR or None if implicit, value length)
+    raw = fp.read(8)
+    if len(raw) < 8:
+        return None
+    group, element = struct.unpack('<HH', raw[:4])
+    if raw[4:6] in _PIXEL_VRS:
+        # Explicit VR: 2 reserved bytes, then a 4-byte length
+        length = struct.unpack('<I', fp.read(4))[0]
+        return Tag(group, element), raw[4:6], length
+    return Tag(group, element), None, struct.unpack('<I', raw[4:8])[0]
+
+def _copy_bytes(src, dst, n_bytes, chunk_size):
+    while n_bytes > 0:
+        chunk = src.read(min(chunk_size, n_bytes))
+        if not chunk:
+            raise ValueError("Unexpected end of file while copying pixel data.")
+        dst.write(chunk)
+        n_bytes -= len(chunk)
+
+def deidentify_stream(input_path, output_path, plan=None, chunk_size=1024 * 1024):
+    """
+    De-identify a DICOM file without loading or decoding its pixel data.
+
+    Only the header is parsed (large header values are read lazily), the compiled plan is
+    applied to it, and the pixel data element is copied from the input file to the output in
+    chunks, so peak memory does not depend on the image size.
+
+    Args:
+        input_path (str): Input DICOM file (little endian transfer syntax).
+        output_path (str): Output DICOM file.
+        plan (DeidPlan): Compiled rules. Defaults to load_plan().
+        chunk_size (int): Bytes copied per read.
+
+    Returns:
+        pydicom.Dataset: The de-identified header (without pixel data).
+    """
+    if plan is None:
+        plan = load_plan()
+    with open(input_path, 'rb') as src:
+        ds = pydicom.dcmread(src, stop_before_pixels=True, defer_size="64 KB")
+        pixel_offset = src.tell()  # pydicom rewinds to the start of the pixel data element
+
+        transfer_syntax = ds.file_meta.TransferSyntaxUID
+        if not transfer_syntax.is_little_endian:
+            raise NotImplementedError("Streaming de-identification needs a little endian transfer syntax.")
+
+        apply_plan(ds, plan)
+        # Accessing every element converts raw elements, resolving VRs missing from implicit VR data before writing
+        for _ in ds:
+            pass
+
+        with open(output_path, 'wb') as dst:
+            implicit_vr = transfer_syntax.is_implicit_VR
+            pydicom.dcmwrite(dst, ds, implicit_vr=implicit_vr, little_endian=True)
+
+            src.seek(pixel_offset)
+            header = _read_element_header(src)
+            if header is None:
+                return ds
+            tag, vr, length = header
+            source_implicit = vr is None
+
+            if length == _UNDEFINED_LENGTH or source_implicit == implicit_vr:
+                # Same encoding (always the case for encapsulated data): copy the rest of the file as is
+                src.seek(pixel_offset)
+                shutil.copyfileobj(src, dst, chunk_size)
+            else:
+                # Re-encode only the element header, then copy the pixel bytes (trailing padding elements are dropped)
+                if vr is None:
+                    vr = b'OW' if ds.get("BitsAllocated", 8) > 8 else b'OB'
+                dst.write(struct.pack('<HH', tag.group, tag.element))
+                if implicit_vr:
+                    dst.write(struct.pack('<I', length))
+                else:
+                    dst.write(vr + b'\0\0' + struct.pack('<I', length))
+                _copy_bytes(src, dst, length, chunk_size)
+    return ds
+
+def _output_path(input_path, output_dir, input_root):
+    relative_path = os.path.relpath(input_path, input_root) if input_root else os.path.basename(input_path)
+    return os.path.join(output_dir, relative_path)
+
+def _deidentify_full(input_path, output_path, plan):
+    ds = pydicom.dcmread(input_path)
+    apply_plan(ds, plan)
+    # Accessing every element converts raw elements, resolving VRs missing from implicit VR data before writing
+    for _ in ds:
+        pass
+    ds.save_as(output_path)
+
+def _deidentify_file(task):
+    # Runs in a worker process; the plan is compiled once per worker by load_plan's cache
+    input_path, output_path, rules_path, streaming = task
+    start = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        plan = load_plan(rules_path)
+        if streaming:
+            try:
+                deidentify_stream(input_path, output_path, plan)
+            except NotImplementedError:
+                # Big endian (retired) transfer syntaxes go through the full read
+                _deidentify_full(input_path, output_path, plan)
+        else:
+            _deidentify_full(input_path, output_path, plan)
+        return DeidResult(input_path, output_path, True, time.perf_counter() - start, None)
+    except Exception as e:
+        return DeidResult(input_path, output_path, False, time.perf_counter() - start, f"{type(e).__name__}: {e}")
+
+def deidentify_many(paths, output_dir, workers=None, rules_path=DEFAULT_RULES_PATH, streaming=False):
+    """
+    De-identify many DICOM files in parallel with the compiled rules.
+
+    Args:
+        paths (str | list): A directory (searched recursively for *.dcm) or a list of DICOM paths.
+        output_dir (str): Where de-identified files are written (mirroring the input directory layout).
+        workers (int): Number of worker processes. Defaults to the number of CPUs.
+        rules_path (str): De-identification rules file.
+        streaming (bool): Use deidentify_stream (header only, pixel data copied without decoding).
+
+    Returns:
+        list: One DeidResult(path, output_path, ok, seconds, error) per input file, in input order.
+    """
+    # Compile in the parent first so invalid rules fail fast
+    load_plan(rules_path)
+
+    input_root = None
+    if isinstance(paths, str) and os.path.isdir(paths):
+        input_root = paths
+        paths = sorted(glob(os.path.join(paths, "**", "*.dcm"), recursive=True))
+    tasks = [(p, _output_path(p, output_dir, input_root), rules_path, streaming) for p in paths]
+    if not tasks:
+        return []
+
+    if workers == 1:
+        return [_deidentify_file(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_deidentify_file, tasks, chunksize=max(1, len(tasks) // (4 * (workers or os.cpu_count() or 1)))))
+
 def de_id_dcm(dicom_data):
+    # Imported here so batch de-identification workers don't pay for Streamlit
+    import streamlit as st
 
     # Deidentify DICOM using on-premise de-identification (for on-premises use)
     with st.spinner("🔐 De-identifying DICOM metadata before uploading for advanced de-identification on the cloud.."):
@@ -1,24 +1,72 @@
 import torch
 from PIL import Image
-from torchvision import transforms
-import timm
+
+from xray_classifier import classify_and_embed, classify_and_embed_batch, feature_embedding_version
+from xray_artifacts import load_bundled_state_dict
+from xray_optimize import engine_version, get_inference_model
+from xray_preprocessing import to_input_tensor, to_input_batch
+from xray_settings import get_setting
+from xray_tracing import span
+
+# timm (and model registry) name of the encoder
+EMBEDDING_MODEL_VERSION = 'vit_base_patch16_224'
+
+# Networks the similarity embeddings can come from: the ViT encoder, or the pooled features
+# of the EfficientNet classifier (one forward pass per study for labels and embedding)
+EMBEDDING_BACKBONES = ('vit', 'classifier')
+
+def embedding_backbone(backbone=None):
+    backbone = backbone or get_setting("RAISO_EMBEDDING_BACKBONE", "vit")
+    if backbone not in EMBEDDING_BACKBONES:
+        raise ValueError(f"Unknown embedding backbone '{backbone}'. Use one of {EMBEDDING_BACKBONES}.")
+    return backbone
+
+# Version of the embeddings of a backbone: vectors of different versions must not be compared
+def embedding_model_version(backbone=None):
+    if embedding_backbone(backbone) == 'classifier':
+        return feature_embedding_version()
+    # The engine is part of it: an int8 encoder gives other vectors than the eager one
+    return f"{EMBEDDING_MODEL_VERSION}:{engine_version(EMBEDDING_MODEL_VERSION)}"
 
 # Load vision encoder (ViT-base used in MedCLIP)
-vision_model = timm.create_model('vit_base_patch16_224', pretrained=True, num_classes=0)
-vision_model.eval()
-
-# Preprocessing for MedCLIP (224x224, normalization)
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize(
-        mean=[0.485, 0.456, 0.406],  # ImageNet
-        std=[0.229, 0.224, 0.225]
-    )
-])
-
-def embed_xray(img: Image):
-    tensor = transform(img).unsqueeze(0)  # Add batch dimension
-    with torch.no_grad():
-        embedding = vision_model(tensor).squeeze().numpy()
-    return embedding.tolist()  # Convert NumPy array to list
+def load_vision_model(checkpoint_path=None, use_bundle=True):
+    import timm
+
+    # Memory-mapped weights from the local artifact store when available (see xray_artifacts)
+    state_dict = load_bundled_state_dict(EMBEDDING_MODEL_VERSION, checkpoint_path) if use_bundle else None
+    with torch.device('meta' if state_dict is not None else 'cpu'):
+        model = timm.create_model(EMBEDDING_MODEL_VERSION, pretrained=state_dict is None, num_classes=0)
+    if state_dict is not None:
+        model.load_state_dict(state_dict, assign=True)
+    elif checkpoint_path:
+        model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+    model.eval()
+    return model
+
+# Shared encoder of the selected inference engine (eager, or a TorchScript/ONNX artifact, see xray_optimize),
+# built on first use rather than at import
+def get_vision_model():
+    return get_inference_model(EMBEDDING_MODEL_VERSION, load_vision_model)
+
+def embed_xray_array(img: Image, backbone=None):
+    # Same preprocessing as the classifier (224x224, ImageNet normalization); accepts a preprocessed tensor too
+    if embedding_backbone(backbone) == 'classifier':
+        return classify_and_embed(img)[1]
+    tensor = to_input_tensor(img).unsqueeze(0)  # Add batch dimension
+    model = get_vision_model()
+    with torch.no_grad(), span("embedding_forward"):
+        embedding = model(tensor)[0].numpy()
+    return embedding  # float32 NumPy array of shape (embedding_dim,)
+
+def embed_xray(img: Image, backbone=None):
+    return embed_xray_array(img, backbone).tolist()  # Convert NumPy array to list (e.g. for JSON / Azure AI Search)
+
+def embed_xray_batch(images, backbone=None):
+    # Batched variant: one forward pass, returns a NumPy array of shape (N, embedding_dim)
+    if embedding_backbone(backbone) == 'classifier':
+        return classify_and_embed_batch(images)[1]
+    tensor = to_input_batch(images)
+    model = get_vision_model()
+    with torch.no_grad(), span("embedding_forward"):
+        embeddings = model(tensor).numpy()
+    return embeddings
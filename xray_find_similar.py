@@ -1,51 +1,39 @@
-import streamlit as st
-from azure.search.documents import SearchClient
-from azure.core.credentials import AzureKeyCredential
-from xray_embedder import embed_xray
+from xray_embedder import embed_xray_array
+from xray_search_backends import get_search_backend
+from xray_tracing import span
 
-def find_similar_xrays(label: str, img, k:int=3):
+def find_similar_xrays(label: str, img, k:int=3, embedding=None):
     """
-    Find similar X-ray images based on the provided label and DICOM pixel array using Azure AI Search.
+    Find similar X-ray images based on the provided label and DICOM pixel array.
+
+    The search runs on the backend selected by the RAISO_SEARCH_BACKEND setting:
+    Azure AI Search ('azure', default) or the in-process vector index ('local').
 
     Args:
         label (str): The label of the X-ray image.
-        img (Image): The Image that represents the pixel array of the DICOM image.
+        img (Image | np.ndarray | torch.Tensor): The image (or the tensor preprocessed by xray_preprocessing) of the DICOM image.
         k (int): The number of similar images to retrieve. Default is 3.
+        embedding (np.ndarray): Precomputed embedding of img (e.g. from the result cache). Computed if None.
 
     Returns:
         list: A list of filenames of top similar X-ray images.
     """
 
     # Embed X-ray
-    embedding_vector = embed_xray(img)
-
-    # Connect to Azure Search AI using SDK
-    client = SearchClient(
-        endpoint = st.secrets["AZURE_AI_SEARCH_ENDPOINT"],
-        index_name = st.secrets["AZURE_AI_SEARCH_INDEX_NAME"],
-        credential = AzureKeyCredential(st.secrets["AZURE_API_KEY"])
-    )
-
-    
-    results = client.search(
-        search_text = "",  # Required, even if you're only using vector search
-        vector_queries = [
-            {
-                "vector": embedding_vector,
-                "fields": "embedding",
-                "k": k,
-                "kind": "vector"
-            }
-        ],
-        filter = f"labels/any(t: t eq '{label}')", # filter for documents where labels field contains the label
-        select=["filename"]
-    )
-
-    print("FUFU")
-    print(results)
-
-    filenames = [doc['filename'] for doc in results]
+    embedding_vector = embedding if embedding is not None else embed_xray_array(img)
+
+    with span("similarity_search"):
+        filenames = get_search_backend().search(embedding_vector, label, k)
     return filenames
 
+def find_similar_xrays_many(labels, img, k:int=3, embedding=None):
+    """
+    find_similar_xrays for several labels with one embedding and, on Azure AI Search, one query.
 
+    Returns:
+        dict: label -> list of filenames of top similar X-ray images.
+    """
+    embedding_vector = embedding if embedding is not None else embed_xray_array(img)
 
+    with span("similarity_search"):
+        return get_search_backend().search_many(embedding_vector, labels, k)
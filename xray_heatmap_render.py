@@ -0,0 +1,248 @@
+import argparse
+import datetime
+import os
+from functools import lru_cache
+from io import BytesIO
+
+import numpy as np
+import pydicom
+from PIL import Image
+
+from xray_tracing import span, traced
+
+
+# Longest side of the overlays streamed to the browser (the app and the inference server);
+# full-resolution exports pass max_size=None
+STREAM_MAX_SIZE = 1024
+
+DEFAULT_ALPHA = 0.4
+
+SECONDARY_CAPTURE_SOP_CLASS_UID = "1.2.840.10008.5.1.4.1.1.7"
+
+# Patient and study attributes copied from the source image, so an exported overlay files under the same study
+_SOURCE_ATTRIBUTES = ("PatientName", "PatientID", "PatientBirthDate", "PatientSex", "StudyInstanceUID",
+                      "StudyDate", "StudyTime", "StudyID", "AccessionNumber", "ReferringPhysicianName",
+                      "StudyDescription")
+
+
+def _jet_lut():
+    # JET colormap (blue -> cyan -> yellow -> red) as 256 RGB entries
+    x = np.linspace(0.0, 1.0, 256)
+    channels = [np.clip(1.5 - np.abs(4.0 * x - center), 0.0, 1.0) for center in (3.0, 2.0, 1.0)]
+    return np.round(np.stack(channels, axis=-1) * 255.0).astype(np.uint8)
+
+
+JET_LUT = _jet_lut()
+
+
+@lru_cache(maxsize=8)
+def blend_table(alpha=DEFAULT_ALPHA):
+    """
+    Precomputed overlay colors: table[gray, heat] is the RGB blend of gray level `gray` with
+    JET_LUT[heat] at opacity alpha, so blending a full-resolution image is one table lookup.
+
+    Returns:
+        np.ndarray: uint8 table of shape (256, 256, 3).
+    """
+    gray = np.arange(256, dtype=np.float32)[:, None, None]
+    table = (1.0 - alpha) * gray + alpha * JET_LUT[None].astype(np.float32)
+    table = np.round(table).astype(np.uint8)
+    table.flags.writeable = False
+    return table
+
+
+@lru_cache(maxsize=32)
+def _linear_weights(source, target):
+    # (target, source) bilinear interpolation matrix, pixel centers aligned (align_corners=False)
+    x = np.clip((np.arange(target) + 0.5) * (source / target) - 0.5, 0.0, source - 1)
+    low = np.floor(x).astype(np.int64)
+    high = np.minimum(low + 1, source - 1)
+    weights = np.zeros((target, source), dtype=np.float32)
+    rows = np.arange(target)
+    np.add.at(weights, (rows, low), (1.0 - (x - low)).astype(np.float32))
+    np.add.at(weights, (rows, high), (x - low).astype(np.float32))
+    weights.flags.writeable = False
+    return weights
+
+
+def upsample_heatmaps(heatmaps, shape):
+    """
+    Bilinear upsampling of low-resolution heatmaps to an image size, all maps in one pass.
+
+    The interpolation is separable: two matrix products per map, (H, h) @ (h, w) @ (w, W),
+    so the cost stays small even at the native resolution of a radiograph.
+
+    Args:
+        heatmaps (np.ndarray): Heatmaps of shape (K, h, w) (or (h, w)), in [0, 1].
+        shape (tuple): Target (H, W).
+
+    Returns:
+        np.ndarray: float32 array of shape (K, H, W) (or (H, W)).
+    """
+    heatmaps = np.asarray(heatmaps, dtype=np.float32)
+    rows = _linear_weights(heatmaps.shape[-2], shape[0])
+    columns = _linear_weights(heatmaps.shape[-1], shape[1])
+    return rows @ heatmaps @ columns.T
+
+
+def display_image(image, ds=None, max_size=None):
+    """
+    Grayscale (or RGB) uint8 image to draw overlays on.
+
+    Pixels with their dataset, and 12/16-bit or float pixels, are windowed first (Modality
+    LUT, VOI LUT / WindowCenter-Width and MONOCHROME1 with a dataset, min-max otherwise), never
+    cast to uint8 directly. uint8 images without a dataset (e.g. XrayStudy.preview) are used
+    as they are.
+
+    Args:
+        image (np.ndarray): Image of shape (H, W) or (H, W, 3).
+        ds (pydicom.Dataset): Dataset of raw DICOM pixels.
+        max_size (int): Downscale so that the longest side is at most max_size (None: keep the size).
+
+    Returns:
+        np.ndarray: uint8 image.
+    """
+    image = np.asarray(image)
+    if image.ndim == 3 and image.shape[-1] == 1:
+        image = image[..., 0]
+    elif image.ndim == 3:
+        image = image[..., :3]
+    if image.dtype != np.uint8 or ds is not None:
+        from xray_preprocessing import window_pixel_array
+        image = np.round(window_pixel_array(image, ds) * 255.0).astype(np.uint8)
+    if max_size and max(image.shape[:2]) > max_size:
+        scale = max_size / max(image.shape[:2])
+        size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+        image = np.asarray(Image.fromarray(image).resize(size, Image.BILINEAR, reducing_gap=2.0))
+    return image
+
+
+@traced("heatmap_overlay")
+def render_overlays(heatmaps, image, ds=None, alpha=DEFAULT_ALPHA, max_size=None):
+    """
+    JET Grad-CAM overlays of several heatmaps on one image, at the image resolution.
+
+    The image is windowed (and downscaled to max_size) once, the heatmaps are upsampled to it
+    together and each overlay is a lookup in blend_table(alpha).
+
+    Args:
+        heatmaps (np.ndarray): Heatmaps of shape (K, h, w) (or (h, w)), in [0, 1].
+        image (np.ndarray): The X-ray: windowed uint8, or raw pixels with their dataset.
+        ds (pydicom.Dataset): Dataset of raw DICOM pixels.
+        alpha (float): Heatmap opacity.
+        max_size (int): Longest side of the overlays (None: native resolution).
+
+    Returns:
+        np.ndarray: RGB uint8 overlays of shape (K, H, W, 3) (or (H, W, 3)).
+    """
+    base = display_image(image, ds, max_size)
+    with span("heatmap_upsample"):
+        # Scaled to LUT indices at the low resolution; the bilinear weights keep them in [0, 255]
+        heat = upsample_heatmaps(np.asarray(heatmaps, dtype=np.float32) * 255.0, base.shape[:2])
+        heat += 0.5
+        heat = heat.astype(np.uint8)
+    table = blend_table(float(alpha))
+    if base.ndim == 2:
+        # One gather per pixel from the flattened (gray, heat) table
+        index = (base.astype(np.uint16) << 8) | heat
+        return np.take(table.reshape(-1, 3), index, axis=0)
+    # RGB base: blend each channel with its own column of the table
+    return table[base, heat[..., None], np.arange(3)]
+
+
+def encode_png(image, compress_level=6):
+    """PNG file bytes of an RGB or grayscale uint8 image (compress_level 0-9: size vs. encoding time)."""
+    buffer = BytesIO()
+    Image.fromarray(np.asarray(image)).save(buffer, format="PNG", compress_level=compress_level)
+    return buffer.getvalue()
+
+
+def to_secondary_capture(overlay, source=None, description="Grad-CAM"):
+    """
+    Wrap an RGB overlay as a DICOM Secondary Capture image.
+
+    The patient and study attributes of the source dataset are copied, so the overlay is
+    filed with the study it explains; it gets its own series and instance UIDs.
+
+    Args:
+        overlay (np.ndarray): RGB uint8 image of shape (H, W, 3).
+        source (pydicom.Dataset): Dataset of the explained image.
+        description (str): SeriesDescription, e.g. "Grad-CAM Effusion".
+
+    Returns:
+        pydicom.Dataset: The Secondary Capture dataset (save_as writes it).
+    """
+    from pydicom.uid import generate_uid
+
+    ds = pydicom.Dataset()
+    if source is not None:
+        for keyword in _SOURCE_ATTRIBUTES:
+            if keyword in source:
+                setattr(ds, keyword, source.data_element(keyword).value)
+        if "SOPInstanceUID" in source:
+            reference = pydicom.Dataset()
+            reference.ReferencedSOPClassUID = source.get("SOPClassUID", "")
+            reference.ReferencedSOPInstanceUID = source.SOPInstanceUID
+            ds.SourceImageSequence = [reference]
+    if "StudyInstanceUID" not in ds:
+        ds.StudyInstanceUID = generate_uid()
+    now = datetime.datetime.now()
+    ds.SOPClassUID = SECONDARY_CAPTURE_SOP_CLASS_UID
+    ds.SOPInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.Modality = "OT"
+    ds.ConversionType = "WSD"
+    ds.ImageType = ["DERIVED", "SECONDARY"]
+    ds.SeriesDescription = description
+    ds.DerivationDescription = description
+    ds.BurnedInAnnotation = "NO"
+    ds.SeriesNumber = 999
+    ds.InstanceNumber = 1
+    ds.ContentDate = now.strftime("%Y%m%d")
+    ds.ContentTime = now.strftime("%H%M%S")
+    ds.set_pixel_data(np.ascontiguousarray(overlay, dtype=np.uint8), "RGB", 8)
+    ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    return ds
+
+
+def secondary_capture_bytes(overlay, source=None, description="Grad-CAM"):
+    """DICOM file bytes of to_secondary_capture(overlay, source, description)."""
+    buffer = BytesIO()
+    to_secondary_capture(overlay, source, description).save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export Grad-CAM overlays of a DICOM X-ray at full resolution.")
+    parser.add_argument("dicom", help="DICOM file.")
+    parser.add_argument("--labels", default=None, help="Comma-separated labels (default: every label above the threshold).")
+    parser.add_argument("--method", choices=("gradcam", "gradcam++"), default="gradcam")
+    parser.add_argument("--format", choices=("png", "dicom"), default="png", help="PNG files or DICOM Secondary Captures.")
+    parser.add_argument("--max-size", type=int, default=0, help="Longest side of the overlays (default: native resolution).")
+    parser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA)
+    parser.add_argument("--output-dir", default=".")
+    args = parser.parse_args()
+
+    from grad_cam import gradcam_from_activations
+    from xray_classifier import CLASSIFICATION_THRESHOLD, classify_xray_explainable
+    from xray_study import XrayStudy
+
+    study = XrayStudy.from_file(args.dicom)
+    probs, activations = classify_xray_explainable(study.tensor)
+    labels = args.labels.split(",") if args.labels else [label for label, p in probs.items() if p >= CLASSIFICATION_THRESHOLD]
+    if not labels:
+        labels = [max(probs, key=probs.get)]
+    # One backward pass for every label, then every overlay from one windowed image
+    heatmaps = gradcam_from_activations(activations, labels, method=args.method)[0]
+    overlays = render_overlays(heatmaps, study.pixels, study.ds, alpha=args.alpha, max_size=args.max_size or None)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(args.dicom))[0]
+    for label, overlay in zip(labels, overlays):
+        extension = "png" if args.format == "png" else "dcm"
+        path = os.path.join(args.output_dir, f"{name}_{label}.{extension}")
+        data = encode_png(overlay) if args.format == "png" else secondary_capture_bytes(overlay, study.ds, f"Grad-CAM {label}")
+        with open(path, "wb") as f:
+            f.write(data)
+        print(f"> {label} ({probs[label]:.2f}): {path} {overlay.shape[1]}x{overlay.shape[0]}")
@@ -0,0 +1,144 @@
+import threading
+from io import BytesIO
+
+import numpy as np
+import requests
+from PIL import Image
+
+from xray_heatmap_render import STREAM_MAX_SIZE
+from xray_settings import get_setting
+
+
+# Upload formats accepted by the inference server
+DICOM_CONTENT_TYPE = "application/dicom"
+NPY_CONTENT_TYPE = "application/x-npy"
+# Encoding of the overlays streamed by /explain
+PNG_CONTENT_TYPE = "image/png"
+
+
+def array_to_npy(array):
+    buffer = BytesIO()
+    np.save(buffer, np.asarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def npy_to_array(data):
+    return np.load(BytesIO(data), allow_pickle=False)
+
+
+class LocalInferenceClient:
+    """Runs the inference operations in-process (no server needed, e.g. for tests and local development)."""
+
+    def __init__(self, service=None):
+        self._service = service
+        self._service_lock = threading.Lock()
+
+    @property
+    def service(self):
+        # Created on first use: importing the service imports torch and the model modules
+        with self._service_lock:
+            if self._service is None:
+                from xray_inference_service import InferenceService
+                self._service = InferenceService()
+            return self._service
+
+    def warm_up(self):
+        self.service.warm_up()
+
+    def classify(self, study, tta=False):
+        return self.service.classify(study, tta)
+
+    def explain(self, study, label, method="gradcam", max_size=STREAM_MAX_SIZE):
+        return self.service.explain(study, label, method, max_size)
+
+    def embed(self, study):
+        return self.service.embed(study)
+
+    def similar(self, study, label, k=3):
+        return self.service.similar(study, label, k)
+
+    def similar_many(self, study, labels, k=3):
+        return self.service.similar_many(study, labels, k)
+
+
+class HttpInferenceClient:
+    """Client of xray_inference_server; same methods as LocalInferenceClient."""
+
+    def __init__(self, base_url, timeout=60.0):
+        """
+        Args:
+            base_url (str): Server URL, e.g. http://localhost:8080.
+            timeout (float): Seconds to wait for a response.
+        """
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._session = requests.Session()  # keeps the connection to the server alive across calls
+
+    def _post(self, endpoint, study, params=None):
+        # Upload the DICOM when there is one (the server applies the DICOM windowing), else the raw pixels
+        if study.ds is not None:
+            body, content_type = study.dicom_bytes, DICOM_CONTENT_TYPE
+        else:
+            body, content_type = array_to_npy(study.pixels), NPY_CONTENT_TYPE
+        response = self._session.post(f"{self.base_url}/{endpoint}", data=body, params=params,
+                                      headers={"Content-Type": content_type}, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def classify(self, study, tta=False):
+        return self._post("classify", study, {"tta": 1} if tta else None).json()["probs"]
+
+    def explain(self, study, label, method="gradcam", max_size=STREAM_MAX_SIZE):
+        # PNG: a fraction of the raw array size for a full-resolution overlay
+        response = self._post("explain", study, {"label": label, "method": method, "size": max_size or 0, "format": "png"})
+        return np.asarray(Image.open(BytesIO(response.content)).convert("RGB"))
+
+    def embed(self, study):
+        return npy_to_array(self._post("embed", study).content)
+
+    def similar(self, study, label, k=3):
+        return self._post("similar", study, {"label": label, "k": k}).json()["filenames"]
+
+    def similar_many(self, study, labels, k=3):
+        return self._post("similar_many", study, {"labels": ",".join(labels), "k": k}).json()["filenames"]
+
+    def health(self):
+        response = self._session.get(f"{self.base_url}/health", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_inference_client():
+    """
+    Process-wide inference client: an HttpInferenceClient when the RAISO_INFERENCE_URL setting
+    is set, otherwise a LocalInferenceClient running the models in this process.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            url = get_setting("RAISO_INFERENCE_URL")
+            _client = HttpInferenceClient(url) if url else LocalInferenceClient()
+        return _client
+
+
+def start_background_warmup():
+    """
+    Import and load the in-process models in a daemon thread, so the first request does not
+    pay for them. Does nothing when inference runs on a server (RAISO_INFERENCE_URL) or when
+    the RAISO_BACKGROUND_WARMUP setting is off.
+
+    Returns:
+        threading.Thread: The warm-up thread, or None.
+    """
+    if str(get_setting("RAISO_BACKGROUND_WARMUP", "1")).lower() in ("0", "false", "no"):
+        return None
+    client = get_inference_client()
+    if not isinstance(client, LocalInferenceClient):
+        return None
+    thread = threading.Thread(target=client.warm_up, name="model-warmup", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from xray_classifier import CLASS_NAMES
+from xray_heatmap_render import STREAM_MAX_SIZE, encode_png, secondary_capture_bytes
+from xray_inference_client import array_to_npy, DICOM_CONTENT_TYPE, NPY_CONTENT_TYPE, PNG_CONTENT_TYPE
+from xray_inference_service import InferenceService, study_from_payload
+from xray_search_backends import get_search_backend
+from xray_settings import get_setting
+from xray_tracing import PROMETHEUS_CONTENT_TYPE, configure_tracing, profile_request, span, tracer
+
+
+class InferenceServer:
+    """
+    asyncio HTTP front end of InferenceService.
+
+    Endpoints (POST bodies are a DICOM file, Content-Type application/dicom, or a .npy pixel
+    array, Content-Type application/x-npy):
+
+        POST /classify?tta=1                -> {"probs": {label: probability}} (tta=1: test-time augmentation)
+        POST /explain?label=L&method=M      -> Grad-CAM overlay (H, W, 3) uint8 (.npy, PNG or DICOM)
+        POST /embed                         -> .npy embedding vector
+        POST /similar?label=L&k=3           -> {"filenames": [...]}
+        POST /similar_many?labels=A,B&k=3   -> {"filenames": {label: [...]}}
+        GET  /health                        -> {"status": "ok", "pending": n, ...}
+        GET  /metrics[?format=json]         -> per-stage latency histograms (Prometheus text or JSON)
+
+    /explain renders the overlay at the image resolution, its longest side capped at size=n
+    (default 1024, 0 for the native size), and returns it as format=npy (default), png or
+    dicom (a Secondary Capture in the study of the upload).
+
+    frame=i selects a frame of a multi-frame DICOM (default: the first). Adding profile=1
+    to a POST query captures a torch profiler trace of that request; the
+    trace file is named in the X-Raiso-Profile response header.
+
+    Decoding and torch work run in a bounded thread pool, so the event loop only does I/O.
+    At most max_pending requests are admitted at a time; beyond that the server answers
+    503 with Retry-After instead of queueing without bound. Similarity queries are awaited on
+    the event loop (asyncio search client), so a worker is free while a query is in flight.
+    """
+
+    def __init__(self, service=None, workers=2, max_pending=16):
+        """
+        Args:
+            service (InferenceService): The inference operations. Defaults to a new InferenceService.
+            workers (int): Threads running CPU-bound work (decoding, forward/backward passes).
+            max_pending (int): Requests admitted at once (running or waiting for a worker).
+        """
+        self.service = service if service is not None else InferenceService()
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+        self._backend = None
+
+    async def _run(self, fn, *args):
+        # The counter is only touched on the event loop thread, so no lock is needed
+        if self.pending >= self.max_pending:
+            raise web.HTTPServiceUnavailable(text="Inference server busy, retry later.", headers={"Retry-After": "1"})
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def _with_study(self, request, fn):
+        data = await request.read()
+        if not data:
+            raise web.HTTPBadRequest(text="Empty body: upload a DICOM file or a .npy pixel array.")
+        content_type = request.content_type
+        frame_index = self._int_query(request, "frame", None)
+        profile = request.query.get("profile") == "1"
+
+        def work():
+            # Decode in the worker too: pixel decoding is CPU-bound
+            with span(f"worker:{request.path}"):
+                return fn(study_from_payload(data, content_type, frame_index))
+
+        def run():
+            if not profile:
+                return work()
+            with profile_request(name=request.path.strip("/")) as captured:
+                result = work()
+            request["profile_path"] = captured["path"]
+            return result
+
+        try:
+            return await self._run(run)
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+    @staticmethod
+    def _int_query(request, name, default, minimum=0):
+        # Integer query parameter, 400 when malformed or below minimum
+        value = request.query.get(name)
+        if value is None:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            raise web.HTTPBadRequest(text=f"Query parameter '{name}' must be an integer.") from None
+        if value < minimum:
+            raise web.HTTPBadRequest(text=f"Query parameter '{name}' must be at least {minimum}.")
+        return value
+
+    @staticmethod
+    def _label(request):
+        label = request.query.get("label")
+        if label not in CLASS_NAMES:
+            raise web.HTTPBadRequest(text=f"Query parameter 'label' must be one of {CLASS_NAMES}.")
+        return label
+
+    async def classify(self, request):
+        tta = request.query.get("tta") == "1"
+        probs = await self._with_study(request, lambda study: self.service.classify(study, tta))
+        return web.json_response({"probs": probs})
+
+    async def explain(self, request):
+        label = self._label(request)
+        method = request.query.get("method", "gradcam")
+        max_size = self._int_query(request, "size", STREAM_MAX_SIZE) or None
+        output = request.query.get("format", "npy")
+        if output not in ("npy", "png", "dicom"):
+            raise web.HTTPBadRequest(text="Query parameter 'format' must be npy, png or dicom.")
+
+        def explain(study):
+            # Encoded in the worker too: PNG compression is CPU-bound
+            overlay = self.service.explain(study, label, method, max_size)
+            if output == "png":
+                return encode_png(overlay)
+            if output == "dicom":
+                return secondary_capture_bytes(overlay, study.ds, f"Grad-CAM {label}")
+            return array_to_npy(overlay)
+
+        body = await self._with_study(request, explain)
+        content_type = {"npy": NPY_CONTENT_TYPE, "png": PNG_CONTENT_TYPE, "dicom": DICOM_CONTENT_TYPE}[output]
+        return web.Response(body=body, content_type=content_type)
+
+    async def embed(self, request):
+        embedding = await self._with_study(request, self.service.embed)
+        return web.Response(body=array_to_npy(embedding), content_type=NPY_CONTENT_TYPE)
+
+    async def _search_backend(self):
+        # Created in a worker: a local index reads its files when loaded
+        if self._backend is None:
+            self._backend = await asyncio.get_running_loop().run_in_executor(self._executor, get_search_backend)
+        return self._backend
+
+    async def similar(self, request):
+        label = self._label(request)
+        k = self._int_query(request, "k", 3, minimum=1)
+        embedding = await self._with_study(request, self.service.embed)
+        backend = await self._search_backend()
+        with span("similarity_search"):
+            filenames = await backend.search_async(embedding, label, k)
+        return web.json_response({"filenames": filenames})
+
+    async def similar_many(self, request):
+        labels = [label for label in request.query.get("labels", "").split(",") if label]
+        if not labels or any(label not in CLASS_NAMES for label in labels):
+            raise web.HTTPBadRequest(text=f"Query parameter 'labels' must be a comma-separated list of {CLASS_NAMES}.")
+        k = self._int_query(request, "k", 3, minimum=1)
+        embedding = await self._with_study(request, self.service.embed)
+        backend = await self._search_backend()
+        with span("similarity_search"):
+            filenames = await backend.search_many_async(embedding, labels, k)
+        return web.json_response({"filenames": filenames})
+
+    async def health(self, request):
+        return web.json_response({"status": "ok", "pending": self.pending, "max_pending": self.max_pending,
+                                  "workers": self.workers})
+
+    async def metrics(self, request):
+        if request.query.get("format") == "json":
+            return web.json_response(tracer.to_json())
+        return web.Response(text=tracer.to_prometheus(), headers={"Content-Type": PROMETHEUS_CONTENT_TYPE})
+
+    @web.middleware
+    async def _trace_requests(self, request, handler):
+        # End-to-end latency per endpoint (queueing and upload included); the worker records the stages
+        resource = request.match_info.route.resource
+        if resource is None or resource.canonical in ("/metrics", "/health"):
+            return await handler(request)
+        with span(f"http:{resource.canonical}"):
+            response = await handler(request)
+        if "profile_path" in request:
+            response.headers["X-Raiso-Profile"] = request["profile_path"]
+        return response
+
+    async def _shutdown(self, app):
+        if hasattr(self._backend, "aclose"):
+            await self._backend.aclose()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def make_app(self, client_max_size=8 * 1024 * 1024):
+        app = web.Application(client_max_size=client_max_size, middlewares=[self._trace_requests])
+        app.add_routes([
+            web.post("/classify", self.classify),
+            web.post("/explain", self.explain),
+            web.post("/embed", self.embed),
+            web.post("/similar", self.similar),
+            web.post("/similar_many", self.similar_many),
+            web.get("/health", self.health),
+            web.get("/metrics", self.metrics),
+        ])
+        app.on_cleanup.append(self._shutdown)
+        return app
+
+
+def create_app(workers=None, max_pending=None):
+    """aiohttp application configured by RAISO_INFERENCE_WORKERS (default 2) and RAISO_INFERENCE_MAX_PENDING (default 16)."""
+    if workers is None:
+        workers = int(get_setting("RAISO_INFERENCE_WORKERS", 2))
+    if max_pending is None:
+        max_pending = int(get_setting("RAISO_INFERENCE_MAX_PENDING", 16))
+    configure_tracing()
+    return InferenceServer(workers=workers, max_pending=max_pending).make_app()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the RAISO X-ray inference server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=None, help="Inference threads (default RAISO_INFERENCE_WORKERS or 2).")
+    parser.add_argument("--max-pending", type=int, default=None,
+                        help="Requests admitted at once before answering 503 (default RAISO_INFERENCE_MAX_PENDING or 16).")
+    args = parser.parse_args()
+
+    web.run_app(create_app(args.workers, args.max_pending), host=args.host, port=args.port)
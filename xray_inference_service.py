@@ -0,0 +1,163 @@
+from pydicom.errors import InvalidDicomError
+
+import xray_classifier
+from xray_classifier import CLASS_NAMES, classify_and_embed, classify_xray_batch, classify_xray_explainable, classify_xray_tta, get_model, model_version
+from xray_embedder import embed_xray_array, embedding_backbone, embedding_model_version, get_vision_model
+from xray_result_cache import get_result_cache, result_key
+from xray_find_similar import find_similar_xrays, find_similar_xrays_many
+from xray_heatmap_render import STREAM_MAX_SIZE
+from xray_inference_client import DICOM_CONTENT_TYPE, NPY_CONTENT_TYPE, npy_to_array
+from xray_study import XrayStudy
+from xray_tracing import traced
+
+
+def study_from_payload(data, content_type, frame_index=None):
+    """
+    Build an XrayStudy from an uploaded body.
+
+    Args:
+        data (bytes): A DICOM file, or a .npy file holding the raw pixel array.
+        content_type (str): DICOM_CONTENT_TYPE or NPY_CONTENT_TYPE.
+        frame_index (int): Frame of a multi-frame DICOM to use (None: the first).
+
+    Returns:
+        XrayStudy: The study.
+    """
+    if content_type not in (DICOM_CONTENT_TYPE, NPY_CONTENT_TYPE):
+        raise ValueError(f"Unsupported content type '{content_type}'. Use {DICOM_CONTENT_TYPE} or {NPY_CONTENT_TYPE}.")
+    try:
+        if content_type == DICOM_CONTENT_TYPE:
+            study = XrayStudy.from_bytes(data, frame_index=frame_index)
+        else:
+            study = XrayStudy(pixels=npy_to_array(data))
+        if frame_index is not None and not 0 <= frame_index < study.n_frames:
+            raise ValueError(f"Frame {frame_index} out of range: the image has {study.n_frames} frame(s).")
+        # Decode now: every operation needs the pixels, and a bad upload must fail here, as a ValueError
+        study.pixels
+    except ValueError:
+        raise
+    except (InvalidDicomError, AttributeError, KeyError, NotImplementedError, RuntimeError, OSError, EOFError, TypeError) as e:
+        # Not a DICOM / .npy file, truncated, no PixelData, or a transfer syntax without a decoder
+        raise ValueError(f"Cannot read the uploaded image: {type(e).__name__}: {e}") from e
+    return study
+
+
+class InferenceService:
+    """
+    Blocking inference operations on one study, shared by the HTTP server (which runs them in
+    its worker pool) and the in-process client. Results are stored in the process result
+    cache under the study's pixel digest, so e.g. explain reuses the activations of classify.
+    """
+
+    def __init__(self, result_cache=None):
+        self.result_cache = result_cache if result_cache is not None else get_result_cache()
+
+    def warm_up(self):
+        """Load and warm up the models used by classify and embed (concurrent requests wait for them)."""
+        if embedding_backbone() == "classifier":
+            get_model()  # single forward pass on the eager model (see _classification)
+        else:
+            xray_classifier.get_inference_model()
+        if embedding_backbone() == "vit":
+            get_vision_model()
+
+    def _classification(self, study):
+        # (probabilities, conv_head activations or None) of one forward pass
+        single_pass = embedding_backbone() == "classifier"
+        key = result_key(study.digest, "probs", model_version("eager" if single_pass else None))
+        classification = self.result_cache.get(key)
+        if classification is None:
+            if single_pass:
+                # The same (eager) pass yields the embedding: cache it for similarity search
+                probs, embedding, activations = classify_and_embed(study.tensor, return_activations=True)
+                self.result_cache.put(result_key(study.digest, "embedding", embedding_model_version()), embedding)
+                classification = (probs, activations)
+            elif xray_classifier.inference_engine() == "eager":
+                classification = classify_xray_explainable(study.tensor)
+            else:
+                # Optimized engine (RAISO_INFERENCE_ENGINE): no activations, explain runs the eager model
+                classification = (classify_xray_batch([study.tensor])[0], None)
+            self.result_cache.put(key, classification)
+        return classification
+
+    def _activations(self, study):
+        # conv_head activations of the eager model, for Grad-CAM
+        activations = self._classification(study)[1]
+        if activations is not None:
+            return activations
+        return self.result_cache.get_or_compute(result_key(study.digest, "activations", model_version("eager")),
+                                                lambda: classify_xray_explainable(study.tensor)[1])
+
+    @traced("service:classify")
+    def classify(self, study, tta=False):
+        """Label -> probability dict. With tta, the test-time augmentation prediction (see classify_xray_tta)."""
+        if not tta:
+            return self._classification(study)[0]
+        reduce = xray_classifier.tta_reduce
+        # The configuration is part of the key: other views or another reduction give other probabilities
+        kind = (f"probs_tta:{','.join(xray_classifier.TTA_VIEWS)}:{getattr(reduce, '__name__', reduce)}"
+                f":{xray_classifier.tta_fast_path_margin}")
+        return self.result_cache.get_or_compute(result_key(study.digest, kind, model_version()),
+                                                lambda: classify_xray_tta(study.tensor)[0])
+
+    @traced("service:explain")
+    def explain(self, study, label, method="gradcam", max_size=STREAM_MAX_SIZE):
+        """
+        Grad-CAM overlay (RGB uint8) of label on the windowed study image, at the study's
+        resolution downscaled to max_size on its longest side (None: native resolution).
+        """
+        return self.explain_many(study, [label], method, max_size)[label]
+
+    @traced("service:explain_many")
+    def explain_many(self, study, labels, method="gradcam", max_size=STREAM_MAX_SIZE):
+        """
+        Grad-CAM overlays of several labels: one backward pass for the labels that are not
+        cached yet, and one windowing and upsampling pass for all of their overlays.
+
+        Returns:
+            dict: label -> RGB uint8 overlay.
+        """
+        from grad_cam import gradcam_from_activations
+        from xray_heatmap_render import render_overlays
+
+        unknown = [label for label in labels if label not in CLASS_NAMES]
+        if unknown:
+            raise ValueError(f"Unknown label '{unknown[0]}'.")
+        # Grad-CAM always runs on the eager model, whatever the inference engine
+        keys = {label: result_key(study.digest, f"{method}:{label}:{max_size or 'native'}", model_version("eager"))
+                for label in labels}
+        overlays = {label: self.result_cache.get(key) for label, key in keys.items()}
+        missing = [label for label, overlay in overlays.items() if overlay is None]
+        if missing:
+            heatmaps = gradcam_from_activations(self._activations(study), missing, method=method)[0]
+            # The raw pixels with their dataset: windowed at full bit depth, not from the 8-bit preview
+            rendered = render_overlays(heatmaps, study.pixels, study.ds, max_size=max_size)
+            for label, overlay in zip(missing, rendered):
+                # Cache each overlay on its own, not as a view that keeps the whole batch alive
+                overlay = overlay.copy() if len(missing) > 1 else overlay
+                self.result_cache.put(keys[label], overlay)
+                overlays[label] = overlay
+        return overlays
+
+    @traced("service:embed")
+    def embed(self, study):
+        """Embedding vector (np.ndarray) of the study."""
+        key = result_key(study.digest, "embedding", embedding_model_version())
+        embedding = self.result_cache.get(key)
+        if embedding is None and embedding_backbone() == "classifier":
+            self._classification(study)  # stores the embedding of its forward pass
+            embedding = self.result_cache.get(key)
+        if embedding is None:
+            embedding = embed_xray_array(study.tensor)
+            self.result_cache.put(key, embedding)
+        return embedding
+
+    @traced("service:similar")
+    def similar(self, study, label, k=3):
+        """Filenames of the k most similar X-rays carrying label."""
+        return find_similar_xrays(label, study.tensor, k=k, embedding=self.embed(study))
+
+    @traced("service:similar_many")
+    def similar_many(self, study, labels, k=3):
+        """label -> filenames of the k most similar X-rays carrying it, for several labels at once."""
+        return find_similar_xrays_many(labels, study.tensor, k=k, embedding=self.embed(study))
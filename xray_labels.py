@@ -0,0 +1,11 @@
+# Labels of the classifier and the decision threshold, importable without torch (e.g. by the Streamlit app)
+
+# Define CheXpert or ChestX-ray14 labels (example)
+CLASS_NAMES = [
+    'Atelectasis', 'Cardiomegaly', 'Consolidation', 'Edema', 'Effusion',
+    'Emphysema', 'Fibrosis', 'Hernia', 'Infiltration', 'Mass',
+    'Nodule', 'Pleural_Thickening', 'Pneumonia', 'Pneumothorax'
+]
+
+# Labels with a probability at or above this threshold are reported as findings
+CLASSIFICATION_THRESHOLD = 0.55
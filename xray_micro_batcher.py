@@ -0,0 +1,70 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Gather concurrent single-item requests into batches for one batched call.
+
+    Callers block in submit() while a background thread waits up to max_wait_ms
+    for more requests (or until max_batch_size is reached), runs batch_fn once on
+    the whole batch and hands each caller its own result.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=5.0):
+        """
+        Args:
+            batch_fn (callable): Takes a list of items and returns a list of results in the same order.
+            max_batch_size (int): Maximum number of items per batch.
+            max_wait_ms (float): Maximum time to wait for more items after the first one arrives.
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be >= 1")
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit_async(self, item):
+        """Queue an item and return a Future for its result."""
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def submit(self, item, timeout=None):
+        """Queue an item and block until its result is ready."""
+        return self.submit_async(item).result(timeout=timeout)
+
+    def _collect(self):
+        # Block for the first item, then gather more until the batch is full or the wait expires
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                results = self.batch_fn(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"batch_fn returned {len(results)} results for {len(items)} items")
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
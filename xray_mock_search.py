@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import re
+
+import numpy as np
+from aiohttp import web
+
+from xray_search_backends import LocalVectorIndex
+from xray_settings import get_setting
+
+
+# REST route the azure-search-documents SDK posts vector queries to
+_SEARCH_PATH = re.compile(r"^/indexes\('([^']+)'\)/docs/search\.post\.search$")
+_EQ_FILTER = re.compile(r"^labels/any\(t: t eq '((?:[^']|'')*)'\)$")
+_IN_FILTER = re.compile(r"^labels/any\(t: search\.in\(t, '((?:[^']|'')*)', '(.)'\)\)$")
+
+
+def parse_label_filter(expression):
+    """
+    Labels of the filters AzureSearchBackend sends: labels/any(t: t eq 'A') and
+    labels/any(t: search.in(t, 'A|B', '|')). None for no filter.
+    """
+    if not expression:
+        return None
+    match = _EQ_FILTER.match(expression)
+    if match:
+        return [match.group(1).replace("''", "'")]
+    match = _IN_FILTER.match(expression)
+    if match:
+        return match.group(1).replace("''", "'").split(match.group(2))
+    raise ValueError(f"Unsupported filter: {expression}")
+
+
+class MockSearchService:
+    """
+    Local stand-in for the Azure AI Search query API, backed by a LocalVectorIndex.
+
+    It answers the vector queries of the azure-search-documents SDK (sync and asyncio
+    clients), so AzureSearchBackend can be exercised without a search service: point
+    AZURE_AI_SEARCH_ENDPOINT to it. Added latency and periodic 503 answers reproduce a slow or
+    flaky service to check timeouts and retries.
+    """
+
+    def __init__(self, index, index_name="xray-index", api_key=None, latency_ms=0.0, fail_every=0):
+        """
+        Args:
+            index (LocalVectorIndex): Documents to search.
+            index_name (str): Index name expected in the request path.
+            api_key (str): Expected api-key header (None accepts any key).
+            latency_ms (float): Delay added to every answer.
+            fail_every (int): Answer 503 to every n-th request (0 never fails).
+        """
+        self.index = index
+        self.index_name = index_name
+        self.api_key = api_key
+        self.latency_ms = latency_ms
+        self.fail_every = fail_every
+        self.requests = 0
+        # Labels of each row, returned with the documents
+        self.row_labels = [[] for _ in index.filenames]
+        for label, rows in index.label_rows.items():
+            for row in rows:
+                self.row_labels[row].append(label)
+
+    async def search(self, request):
+        match = _SEARCH_PATH.match(request.path)
+        if match is None or match.group(1) != self.index_name:
+            raise web.HTTPNotFound(text=f"No index at {request.path}.")
+        if self.api_key is not None and request.headers.get("api-key") != self.api_key:
+            raise web.HTTPForbidden(text="Invalid api-key.")
+        self.requests += 1
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000.0)
+        if self.fail_every and self.requests % self.fail_every == 0:
+            raise web.HTTPServiceUnavailable(text="Simulated failure.")
+
+        body = await request.json()
+        try:
+            labels = parse_label_filter(body.get("filter"))
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        if labels is None:
+            rows = np.arange(len(self.index.filenames))
+        else:
+            rows = np.unique(np.concatenate([self.index.label_rows.get(label, np.empty(0, dtype=np.int64))
+                                             for label in labels]))
+        vector_query = body["vectorQueries"][0]
+        k = min(int(vector_query.get("k", 50)), int(body.get("top", 50)))
+        if len(rows) == 0 or k <= 0:
+            return web.json_response({"value": []})
+
+        top_rows, scores = self.index.top_rows(vector_query["vector"], rows, k)
+        return web.json_response({"value": [
+            {"@search.score": float(score), "filename": self.index.filenames[row], "labels": self.row_labels[row]}
+            for row, score in zip(top_rows, scores)
+        ]})
+
+    def make_app(self):
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post("/{path:indexes.*}", self.search)
+        return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a local mock of the Azure AI Search vector query API.")
+    parser.add_argument("--vectors", default=None,
+                        help="Vector store directory or .jsonl file (default RAISO_LOCAL_VECTORS_PATH or 'medclip_xray_vectors').")
+    parser.add_argument("--index-name", default=None, help="Index name (default AZURE_AI_SEARCH_INDEX_NAME or 'xray-index').")
+    parser.add_argument("--api-key", default=None, help="Required api-key header (default: any key).")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Delay added to every answer.")
+    parser.add_argument("--fail-every", type=int, default=0, help="Answer 503 to every n-th request.")
+    args = parser.parse_args()
+
+    index = LocalVectorIndex.load(args.vectors or get_setting("RAISO_LOCAL_VECTORS_PATH", "medclip_xray_vectors"))
+    service = MockSearchService(index, args.index_name or get_setting("AZURE_AI_SEARCH_INDEX_NAME", "xray-index"),
+                                api_key=args.api_key, latency_ms=args.latency_ms, fail_every=args.fail_every)
+    print(f"> Mock search service for {len(index.filenames)} documents: "
+          f"AZURE_AI_SEARCH_ENDPOINT=http://{args.host}:{args.port} AZURE_AI_SEARCH_INDEX_NAME={service.index_name}")
+    web.run_app(service.make_app(), host=args.host, port=args.port, print=None)
@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+
+import torch
+
+from xray_tracing import span
+
+
+def _read_rss_bytes():
+    """Return the current resident set size of this process in bytes (0 if unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+
+def _model_size_bytes(model):
+    """Return the bytes held by the parameters and buffers of a model (0 for non-torch runtimes)."""
+    if not isinstance(model, torch.nn.Module):
+        return 0
+    n_bytes = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        n_bytes += tensor.numel() * tensor.element_size()
+    return n_bytes
+
+
+class ModelRegistry:
+    """
+    Process-wide, thread-safe store of loaded models.
+
+    Each (name, checkpoint_path) pair is built once by its loader, put in eval mode,
+    warmed up with a dummy forward pass and then shared by every consumer.
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _key_lock(self, key):
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    def get(self, name, loader, checkpoint_path=None, warmup_shape=(1, 3, 224, 224)):
+        """
+        Return the shared instance of a model, loading it on first use.
+
+        Args:
+            name (str): Architecture name (e.g. 'efficientnet_b0').
+            loader (callable): Called as loader(checkpoint_path=...) to build the model.
+            checkpoint_path (str): Optional checkpoint the model is built from.
+            warmup_shape (tuple): Input shape of the warm-up pass. None to skip warm-up.
+
+        Returns:
+            torch.nn.Module: The shared eval-mode model.
+        """
+        key = (name, checkpoint_path)
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        # Only one thread builds a given model, others wait for it
+        with self._key_lock(key):
+            model = self._models.get(key)
+            if model is not None:
+                return model
+
+            rss_before = _read_rss_bytes()
+            start = time.perf_counter()
+            with span(f"model_load:{name}"):
+                model = loader(checkpoint_path=checkpoint_path)
+                model.eval()
+            load_seconds = time.perf_counter() - start
+
+            warmup_seconds = 0.0
+            if warmup_shape is not None:
+                start = time.perf_counter()
+                with torch.no_grad(), span(f"model_warmup:{name}"):
+                    model(torch.zeros(warmup_shape))
+                warmup_seconds = time.perf_counter() - start
+
+            self._stats[key] = {
+                "name": name,
+                "checkpoint_path": checkpoint_path,
+                "load_seconds": load_seconds,
+                "warmup_seconds": warmup_seconds,
+                "param_bytes": _model_size_bytes(model),
+                "rss_delta_bytes": max(_read_rss_bytes() - rss_before, 0),
+            }
+            self._models[key] = model
+            return model
+
+    def stats(self):
+        """Return load time and memory figures for every loaded model."""
+        with self._lock:
+            return [dict(s) for s in self._stats.values()]
+
+    def clear(self):
+        """Drop all loaded models (mainly useful to free memory or force a reload)."""
+        with self._lock:
+            self._models.clear()
+            self._stats.clear()
+            self._key_locks.clear()
+
+
+# Shared registry for the whole process
+registry = ModelRegistry()
@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+from collections import OrderedDict
+from glob import glob
+
+import numpy as np
+import pydicom
+
+from xray_study import XrayStudy
+
+
+# Study-level probability of a label from the probabilities of its images:
+# max - positive if any view shows it, mean - average over the views
+REDUCTIONS = {
+    "max": lambda probs: probs.max(axis=0),
+    "mean": lambda probs: probs.mean(axis=0),
+}
+
+
+class MultiImageStudy:
+    """
+    All images of one study: its DICOM files (e.g. PA and lateral views, several series) and
+    every frame of its multi-frame files.
+
+    Nothing is decoded up front. images() opens the files one after the other and decodes
+    one frame at a time: frames of files on disk are streamed from the file
+    (pydicom.pixels.iter_pixels), so a large multi-frame object is never held in memory as a whole.
+    """
+
+    def __init__(self, sources, study_uid=None):
+        """
+        Args:
+            sources (list): DICOM file paths and/or pydicom Datasets.
+            study_uid (str): StudyInstanceUID of the sources, if known.
+        """
+        self.sources = list(sources)
+        self.study_uid = study_uid
+
+    @classmethod
+    def group_files(cls, paths):
+        """
+        Group DICOM files by study, reading their headers only.
+
+        Files are ordered by SeriesNumber then InstanceNumber within a study.
+
+        Returns:
+            list: One MultiImageStudy per StudyInstanceUID, in order of first appearance.
+        """
+        studies = OrderedDict()
+        for path in paths:
+            header = pydicom.dcmread(path, stop_before_pixels=True)
+            order = (int(header.get("SeriesNumber") or 0), int(header.get("InstanceNumber") or 0))
+            studies.setdefault(str(header.get("StudyInstanceUID", path)), []).append((order, path))
+        return [cls([path for _, path in sorted(files, key=lambda f: f[0])], study_uid)
+                for study_uid, files in studies.items()]
+
+    @classmethod
+    def from_directory(cls, directory):
+        """Studies of every *.dcm file under directory."""
+        return cls.group_files(sorted(glob(os.path.join(directory, "**", "*.dcm"), recursive=True)))
+
+    def images(self):
+        """
+        Yield every image of the study, lazily.
+
+        Yields:
+            tuple: (source index, frame index, XrayStudy of that frame).
+        """
+        for source_index, source in enumerate(self.sources):
+            if isinstance(source, pydicom.Dataset):
+                for frame_index, study in enumerate(XrayStudy(source).frames()):
+                    yield source_index, frame_index, study
+                continue
+
+            header = pydicom.dcmread(source, stop_before_pixels=True)
+            if int(header.get("NumberOfFrames") or 1) == 1:
+                yield source_index, 0, XrayStudy.from_file(source)
+                continue
+            from pydicom.pixels import iter_pixels
+            # The header keeps the windowing attributes; each frame is read from the file when reached
+            for frame_index, frame in enumerate(iter_pixels(source)):
+                yield source_index, frame_index, XrayStudy(header, pixels=frame, frame_index=frame_index)
+
+
+def _infer(tensors, embed):
+    # One forward pass per model for a batch of preprocessed images
+    from xray_classifier import classify_and_embed_batch, classify_xray_batch
+    from xray_embedder import embed_xray_batch, embedding_backbone
+
+    if embed and embedding_backbone() == "classifier":
+        probs, embeddings = classify_and_embed_batch(tensors)
+    else:
+        probs = classify_xray_batch(tensors)
+        embeddings = embed_xray_batch(tensors) if embed else None
+    return probs, embeddings
+
+
+def classify_study(study, batch_size=16, reduce="max", embed=False):
+    """
+    Classify every image of a study and aggregate the label probabilities per study.
+
+    Images are preprocessed as they are decoded and run through the models in batches of up
+    to batch_size, so memory is bounded by one batch of model inputs whatever the number of
+    frames.
+
+    Args:
+        study (MultiImageStudy): The study.
+        batch_size (int): Images per forward pass.
+        reduce (str): Aggregation of the image probabilities, a key of REDUCTIONS.
+        embed (bool): Also compute a study embedding (mean of the L2-normalized image embeddings).
+
+    Returns:
+        dict: "probs" (label -> study probability), "images" (one {"source", "frame", "probs"}
+        entry per image) and, with embed, "embedding".
+    """
+    from xray_classifier import CLASS_NAMES
+
+    if reduce not in REDUCTIONS:
+        raise ValueError(f"Unknown reduction '{reduce}'. Use one of {list(REDUCTIONS)}.")
+    images, batch, batch_ids = [], [], []
+    embedding_sum = None
+
+    def flush():
+        nonlocal embedding_sum
+        probs, embeddings = _infer(batch, embed)
+        for (source, frame), image_probs in zip(batch_ids, probs):
+            images.append({"source": source, "frame": frame, "probs": image_probs})
+        if embeddings is not None:
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            normalized = (embeddings / np.where(norms > 0, norms, 1.0)).sum(axis=0)
+            embedding_sum = normalized if embedding_sum is None else embedding_sum + normalized
+        batch.clear()
+        batch_ids.clear()
+
+    for source_index, frame_index, image in study.images():
+        batch.append(image.tensor)  # the decoded frame is dropped with the image, only the model input is kept
+        source = study.sources[source_index]
+        batch_ids.append((source if isinstance(source, str) else source_index, frame_index))
+        if len(batch) == batch_size:
+            flush()
+    if batch:
+        flush()
+    if not images:
+        raise ValueError("The study has no images.")
+
+    probs = np.array([[image["probs"][label] for label in CLASS_NAMES] for image in images])
+    result = {"probs": dict(zip(CLASS_NAMES, REDUCTIONS[reduce](probs).tolist())), "images": images}
+    if embed:
+        result["embedding"] = embedding_sum / len(images)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify DICOM studies with several images (views, series, multi-frame files).")
+    parser.add_argument("sources", nargs="+", help="DICOM files or directories; files are grouped by StudyInstanceUID.")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--reduce", choices=list(REDUCTIONS), default="max")
+    parser.add_argument("--json", default=None, help="Write the per-study and per-image results to this file.")
+    args = parser.parse_args()
+
+    paths = []
+    for source in args.sources:
+        paths.extend(sorted(glob(os.path.join(source, "**", "*.dcm"), recursive=True)) if os.path.isdir(source) else [source])
+    report = []
+    for study in MultiImageStudy.group_files(paths):
+        result = classify_study(study, batch_size=args.batch_size, reduce=args.reduce)
+        top = sorted(result["probs"].items(), key=lambda item: -item[1])[:3]
+        print(f"> {study.study_uid}: {len(study.sources)} files, {len(result['images'])} images | "
+              + ", ".join(f"{label} {prob:.2f}" for label, prob in top))
+        report.append({"study_uid": study.study_uid, "files": study.sources, **result})
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,367 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from xray_artifacts import weights_identity
+from xray_model_registry import registry
+from xray_settings import get_setting
+
+
+# Inference engines: eager timm models, or artifacts exported by this module
+ENGINES = ("eager", "torchscript", "onnx")
+DEFAULT_ARTIFACTS_DIR = "optimized_models"
+EXAMPLE_INPUT_SHAPE = (1, 3, 224, 224)
+
+_threads_lock = threading.Lock()
+_threads_configured = False
+
+
+def _thread_settings():
+    intra_op = get_setting("RAISO_TORCH_THREADS")
+    inter_op = get_setting("RAISO_TORCH_INTEROP_THREADS")
+    return (int(intra_op) if intra_op else None), (int(inter_op) if inter_op else None)
+
+
+def configure_threads(intra_op=None, inter_op=None):
+    """
+    Set the torch intra-op and inter-op thread pools, once per process.
+
+    Args:
+        intra_op (int): Threads used inside one op. Defaults to the RAISO_TORCH_THREADS setting (torch default if unset).
+        inter_op (int): Threads running independent ops. Defaults to RAISO_TORCH_INTEROP_THREADS (torch default if unset).
+    """
+    global _threads_configured
+    with _threads_lock:
+        if _threads_configured:
+            return
+        _threads_configured = True
+        default_intra_op, default_inter_op = _thread_settings()
+        intra_op = intra_op or default_intra_op
+        inter_op = inter_op or default_inter_op
+        if intra_op:
+            torch.set_num_threads(intra_op)
+        if inter_op:
+            try:
+                torch.set_num_interop_threads(inter_op)
+            except RuntimeError:
+                # Only allowed before the first inter-op parallel work of the process
+                print(f"> Could not set inter-op threads, keeping {torch.get_num_interop_threads()}")
+
+
+def selected_engine():
+    """Engine named by the RAISO_INFERENCE_ENGINE setting ('eager' by default)."""
+    engine = get_setting("RAISO_INFERENCE_ENGINE", "eager")
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown inference engine '{engine}'. Use one of {ENGINES}.")
+    return engine
+
+
+def artifacts_dir():
+    return get_setting("RAISO_OPTIMIZED_MODELS_DIR", DEFAULT_ARTIFACTS_DIR)
+
+
+def _artifact_path(directory, name, engine):
+    return os.path.join(directory, f"{name}.{'pt' if engine == 'torchscript' else 'onnx'}")
+
+
+def _manifest_path(directory, name, engine):
+    return os.path.join(directory, f"{name}.{engine}.json")
+
+
+class _ChannelsLast(nn.Module):
+    # Converts the input to channels-last so every convolution runs on NHWC tensors
+    def __init__(self, model):
+        super().__init__()
+        self.model = model.to(memory_format=torch.channels_last)
+
+    def forward(self, x):
+        return self.model(x.contiguous(memory_format=torch.channels_last))
+
+
+def optimize_module(model, quantize=False, channels_last=False):
+    """
+    Eager-mode CPU optimizations.
+
+    Args:
+        model (torch.nn.Module): Eval-mode model.
+        quantize (bool): Dynamic int8 quantization of the nn.Linear layers (most of the ViT, the classifier head of EfficientNet).
+        channels_last (bool): NHWC memory layout (speeds up convolutions, no effect on the ViT blocks).
+
+    Returns:
+        torch.nn.Module: The optimized model.
+    """
+    model = model.eval()
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    if channels_last:
+        model = _ChannelsLast(model).eval()
+    return model
+
+
+class OnnxModel:
+    """ONNX Runtime session called like a torch model: a (N, 3, H, W) tensor in, a tensor out."""
+
+    def __init__(self, path, intra_op=None, inter_op=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op:
+            options.intra_op_num_threads = intra_op
+        if inter_op:
+            options.inter_op_num_threads = inter_op
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_tensor):
+        inputs = np.ascontiguousarray(input_tensor.detach().cpu().numpy(), dtype=np.float32)
+        return torch.from_numpy(self.session.run(None, {self.input_name: inputs})[0])
+
+
+def export_model(name, model, directory=DEFAULT_ARTIFACTS_DIR, engine="torchscript", quantize=False,
+                 channels_last=False, checkpoint_path=None):
+    """
+    Export an eager model as an optimized inference artifact.
+
+    TorchScript artifacts are traced from optimize_module(model, ...), then frozen and
+    optimized for inference. ONNX artifacts are exported in fp32 and optionally quantized to
+    int8 by ONNX Runtime (ONNX Runtime picks its own memory layout, so channels_last is ignored).
+
+    Args:
+        name (str): Registry name of the model (e.g. 'efficientnet_b0').
+        model (torch.nn.Module): The eager eval-mode model.
+        directory (str): Output directory.
+        engine (str): 'torchscript' or 'onnx'.
+        quantize (bool): Dynamic int8 quantization.
+        channels_last (bool): NHWC layout (TorchScript only).
+        checkpoint_path (str): Checkpoint the model was built from. Its path and the identity of the weights
+            (see xray_artifacts.weights_identity) are recorded so stale artifacts are not loaded.
+
+    Returns:
+        str: Path of the artifact.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = _artifact_path(directory, name, engine)
+    example = torch.zeros(EXAMPLE_INPUT_SHAPE)
+
+    if engine == "torchscript":
+        module = optimize_module(model, quantize=quantize, channels_last=channels_last)
+        with torch.no_grad():
+            # Frozen graph only: optimize_for_inference (conv-bn folding, MKLDNN prepacking) is applied at load time,
+            # its output cannot be serialized
+            traced = torch.jit.freeze(torch.jit.trace(module, example))
+        traced.save(path)
+    elif engine == "onnx":
+        channels_last = False
+        fp32_path = path + ".fp32" if quantize else path
+        torch.onnx.export(model.eval(), example, fp32_path, input_names=["input"], output_names=["output"],
+                          dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}}, opset_version=17, dynamo=False)
+        if quantize:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+            os.remove(fp32_path)
+    else:
+        raise ValueError(f"Cannot export to engine '{engine}'. Use 'torchscript' or 'onnx'.")
+
+    with open(_manifest_path(directory, name, engine), "w") as f:
+        json.dump({"name": name, "engine": engine, "quantized": quantize, "channels_last": channels_last,
+                   "checkpoint_path": checkpoint_path, "weights": weights_identity(name, checkpoint_path),
+                   "torch_version": torch.__version__}, f, indent=2)
+    return path
+
+
+def _read_manifest(name, engine, directory, checkpoint_path):
+    # Manifest of the artifact, None if missing or exported from other weights (another checkpoint path or content)
+    manifest_path = _manifest_path(directory, name, engine)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("checkpoint_path") != checkpoint_path or manifest.get("weights") != weights_identity(name, checkpoint_path):
+        return None
+    return manifest
+
+
+def has_artifact(name, engine, directory=DEFAULT_ARTIFACTS_DIR, checkpoint_path=None):
+    """Whether an artifact of this model and engine, exported from the current weights of checkpoint_path, exists."""
+    return _read_manifest(name, engine, directory, checkpoint_path) is not None
+
+
+def load_artifact(name, engine, directory=DEFAULT_ARTIFACTS_DIR, checkpoint_path=None):
+    """
+    Load an exported artifact.
+
+    Returns:
+        Callable model (torch.jit.ScriptModule or OnnxModel), or None if there is no artifact
+        for this model, engine and checkpoint.
+    """
+    manifest = _read_manifest(name, engine, directory, checkpoint_path)
+    if manifest is None:
+        return None
+
+    path = _artifact_path(directory, name, engine)
+    if engine == "torchscript":
+        module = torch.jit.load(path, map_location="cpu")
+        if manifest["quantized"]:
+            return module  # the inference passes do not support the quantized ops
+        return torch.jit.optimize_for_inference(module)
+    intra_op, inter_op = _thread_settings()
+    return OnnxModel(path, intra_op=intra_op or torch.get_num_threads(), inter_op=inter_op)
+
+
+# (name, checkpoint_path) -> (engine, manifest) of the model actually used, resolved once per process
+_resolved_engines = {}
+_resolve_lock = threading.Lock()
+
+
+def resolve_engine(name, checkpoint_path=None):
+    """
+    Engine serving a model in this process: the RAISO_INFERENCE_ENGINE setting if an artifact
+    of the current weights of checkpoint_path exists, else 'eager'. Resolved once per model
+    and checkpoint, so the setting and the artifact manifest are not read on every call.
+
+    Returns:
+        tuple: (engine, manifest of the artifact or None for the eager model).
+    """
+    key = (name, checkpoint_path)
+    resolved = _resolved_engines.get(key)
+    if resolved is not None:
+        return resolved
+    with _resolve_lock:
+        if key not in _resolved_engines:
+            engine, manifest = selected_engine(), None
+            if engine != "eager":
+                manifest = _read_manifest(name, engine, artifacts_dir(), checkpoint_path)
+                if manifest is None:
+                    print(f"> No {engine} artifact of {name} in {artifacts_dir()}, using the eager model")
+                    engine = "eager"
+            _resolved_engines[key] = (engine, manifest)
+        return _resolved_engines[key]
+
+
+def engine_version(name, checkpoint_path=None):
+    """Engine part of a model version for cache keys, e.g. 'eager', 'torchscript' or 'onnx-int8'."""
+    engine, manifest = resolve_engine(name, checkpoint_path)
+    return f"{engine}-int8" if manifest is not None and manifest.get("quantized") else engine
+
+
+def get_inference_model(name, loader, checkpoint_path=None):
+    """
+    Shared inference model of the engine selected by RAISO_INFERENCE_ENGINE.
+
+    Optimized engines load the artifact exported to RAISO_OPTIMIZED_MODELS_DIR (default
+    'optimized_models'); if it is missing or was exported from other weights, the eager
+    model is used (see resolve_engine). Models needing intermediate activations (Grad-CAM)
+    must use the eager model.
+
+    Args:
+        name (str): Registry name of the model.
+        loader (callable): Eager model loader, called as loader(checkpoint_path=...).
+        checkpoint_path (str): Checkpoint of the weights.
+
+    Returns:
+        Callable model, shared through the model registry.
+    """
+    configure_threads()
+    engine, _ = resolve_engine(name, checkpoint_path)
+    if engine == "eager":
+        return registry.get(name, loader, checkpoint_path=checkpoint_path)
+    directory = artifacts_dir()
+    return registry.get(f"{name}:{engine}", lambda checkpoint_path: load_artifact(name, engine, directory, checkpoint_path),
+                        checkpoint_path=checkpoint_path)
+
+
+def check_parity(reference, candidate, inputs, probabilities=False):
+    """
+    Compare an optimized model with the eager reference on the same inputs.
+
+    Args:
+        reference (callable): Eager model.
+        candidate (callable): Optimized model.
+        inputs (torch.Tensor): Batch of preprocessed inputs (N, 3, 224, 224).
+        probabilities (bool): Compare sigmoid outputs (classifier) instead of raw outputs (embedder).
+
+    Returns:
+        dict: max_abs_diff, min_cosine (per row) and the mean latency in ms of both models.
+    """
+    timings = {}
+    outputs = {}
+    for key, model in (("reference", reference), ("candidate", candidate)):
+        with torch.no_grad():
+            model(inputs[:1])  # warm-up
+            start = time.perf_counter()
+            output = model(inputs)
+            timings[key] = (time.perf_counter() - start) * 1000.0 / len(inputs)
+        outputs[key] = torch.sigmoid(output) if probabilities else output
+
+    reference_out, candidate_out = outputs["reference"].float(), outputs["candidate"].float()
+    cosine = torch.nn.functional.cosine_similarity(reference_out, candidate_out, dim=1)
+    return {
+        "max_abs_diff": float((reference_out - candidate_out).abs().max()),
+        "min_cosine": float(cosine.min()),
+        "reference_ms_per_image": timings["reference"],
+        "candidate_ms_per_image": timings["candidate"],
+    }
+
+
+def _model_spec(model):
+    # (registry name, eager loader, checkpoint path, compare probabilities) of the app's models
+    if model == "classifier":
+        import xray_classifier
+        return "efficientnet_b0", xray_classifier.load_model, xray_classifier.model_checkpoint_path, True
+    if model == "embedder":
+        import xray_embedder
+        return xray_embedder.EMBEDDING_MODEL_VERSION, xray_embedder.load_vision_model, None, False
+    raise ValueError(f"Unknown model '{model}'. Use 'classifier' or 'embedder'.")
+
+
+def _parity_inputs(dicom_paths, n_random=8):
+    # Real studies when available, plus random inputs in the normalized value range
+    from xray_preprocessing import to_input_batch
+    from xray_study import XrayStudy
+
+    tensors = [XrayStudy.from_file(p).tensor for p in dicom_paths]
+    generator = torch.Generator().manual_seed(0)
+    random_inputs = torch.randn((n_random,) + EXAMPLE_INPUT_SHAPE[1:], generator=generator)
+    return torch.cat([to_input_batch(tensors), random_inputs]) if tensors else random_inputs
+
+
+if __name__ == "__main__":
+    from glob import glob
+
+    parser = argparse.ArgumentParser(description="Export the app's models as optimized CPU inference artifacts.")
+    parser.add_argument("command", choices=["export", "parity"])
+    parser.add_argument("--model", default="all", choices=["classifier", "embedder", "all"])
+    parser.add_argument("--engine", default="torchscript", choices=["torchscript", "onnx"])
+    parser.add_argument("--quantize", action="store_true", help="Dynamic int8 quantization.")
+    parser.add_argument("--channels-last", action="store_true", help="NHWC layout (TorchScript only).")
+    parser.add_argument("--output-dir", default=None, help="Artifacts directory (default RAISO_OPTIMIZED_MODELS_DIR).")
+    parser.add_argument("--parity-dicoms", default=os.path.join("example_dicoms", "*.dcm"),
+                        help="Glob of DICOMs used for the parity check (besides random inputs).")
+    args = parser.parse_args()
+
+    configure_threads()
+    directory = args.output_dir or artifacts_dir()
+    inputs = _parity_inputs(sorted(glob(args.parity_dicoms)))
+    for model_kind in (["classifier", "embedder"] if args.model == "all" else [args.model]):
+        name, loader, checkpoint_path, probabilities = _model_spec(model_kind)
+        eager_model = loader(checkpoint_path=checkpoint_path).eval()
+        if args.command == "export":
+            path = export_model(name, eager_model, directory, args.engine, quantize=args.quantize,
+                                channels_last=args.channels_last, checkpoint_path=checkpoint_path)
+            print(f"> Exported {name} to {path}")
+        optimized = load_artifact(name, args.engine, directory, checkpoint_path)
+        if optimized is None:
+            print(f"> No {args.engine} artifact of {name} in {directory}")
+            continue
+        report = check_parity(eager_model, optimized, inputs, probabilities=probabilities)
+        print(f"> {name} ({args.engine}) parity on {len(inputs)} inputs: " + json.dumps(report))
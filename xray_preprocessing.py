@@ -0,0 +1,143 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from xray_tracing import span, traced
+
+
+# Model input size shared by EfficientNetB0 and ViT-B/16
+INPUT_SIZE = (224, 224)
+
+# ImageNet stats, shaped to broadcast over (..., 3, H, W)
+IMAGENET_MEAN = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+IMAGENET_STD = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+
+
+def _has_windowing(ds):
+    # A Modality LUT (other than the identity rescale) or a VOI LUT / window changes the stored values
+    if any(keyword in ds for keyword in ("ModalityLUTSequence", "VOILUTSequence", "WindowCenter")):
+        return True
+    return float(ds.get("RescaleSlope", 1) or 1) != 1.0 or float(ds.get("RescaleIntercept", 0) or 0) != 0.0
+
+
+def window_pixel_array(pixels, ds=None):
+    """
+    Map a DICOM pixel array (8/12/16-bit or float) to float32 values in [0, 1].
+
+    With a dataset, the Modality LUT (RescaleSlope/RescaleIntercept) and the VOI LUT or
+    WindowCenter/WindowWidth are applied first and MONOCHROME1 images are inverted.
+    8-bit data without such attributes is scaled by 1/255 (same as ToTensor, as for the
+    indexed PNGs), anything else is min-max scaled.
+
+    Args:
+        pixels (np.ndarray): Pixel array of shape (H, W) or (H, W, 3).
+        ds (pydicom.Dataset): Optional dataset the pixels come from.
+
+    Returns:
+        np.ndarray: float32 array with the same shape as pixels.
+    """
+    pixels = np.asarray(pixels)
+
+    windowed = False
+    if ds is not None and pixels.ndim == 2:
+        from pydicom.pixels import apply_modality_lut, apply_voi_lut
+
+        if _has_windowing(ds):
+            pixels = apply_modality_lut(pixels, ds)
+            if "VOILUTSequence" in ds or "WindowCenter" in ds:
+                pixels = apply_voi_lut(pixels, ds)
+            windowed = True
+    if not windowed and pixels.dtype == np.uint8:
+        # Plain 8-bit data is scaled like the PNGs of the search index (ToTensor), not stretched
+        pixels = pixels.astype(np.float32) * (1.0 / 255.0)
+        if ds is not None and ds.get("PhotometricInterpretation") == "MONOCHROME1":
+            pixels = 1.0 - pixels
+        return pixels
+
+    pixels = pixels.astype(np.float32, copy=False)
+    low, high = float(pixels.min()), float(pixels.max())
+    if high > low:
+        pixels = (pixels - low) * (1.0 / (high - low))
+    else:
+        pixels = np.zeros_like(pixels)
+
+    if ds is not None and ds.get("PhotometricInterpretation") == "MONOCHROME1":
+        pixels = 1.0 - pixels
+    return pixels
+
+
+def _resize(image, ds=None):
+    # Window and resize an image without normalizing: returns (C, 224, 224) with C = 1 or 3
+    if isinstance(image, Image.Image):
+        image = np.asarray(image)
+    elif not isinstance(image, np.ndarray):
+        raise ValueError("Input must be a PIL Image, a NumPy array or a preprocessed torch.Tensor.")
+
+    if image.ndim == 3 and image.shape[-1] == 1:
+        image = image[..., 0]
+    if image.ndim == 2:
+        tensor = torch.from_numpy(window_pixel_array(image, ds))[None, None]  # (1, 1, H, W), single channel
+    elif image.ndim == 3 and image.shape[-1] in (3, 4):
+        tensor = torch.from_numpy(window_pixel_array(image[..., :3], ds)).permute(2, 0, 1)[None]  # (1, 3, H, W)
+    else:
+        raise ValueError(f"Unsupported image shape {image.shape}.")
+
+    if tuple(tensor.shape[-2:]) != INPUT_SIZE:
+        tensor = F.interpolate(tensor, size=INPUT_SIZE, mode="bilinear", align_corners=False, antialias=True)
+    return tensor[0]
+
+
+def _is_preprocessed(image):
+    return isinstance(image, torch.Tensor) and tuple(image.shape[-3:]) == (3,) + INPUT_SIZE
+
+
+def to_input_tensor(image, ds=None):
+    """
+    Turn an X-ray into the normalized model input tensor of shape (3, 224, 224).
+
+    Resizing happens once on the single grayscale channel; the expansion to 3 channels is a
+    zero-copy view, and the per-channel ImageNet normalization writes the (small) output tensor.
+    An already preprocessed tensor ((3, 224, 224) or (1, 3, 224, 224)) is returned as is.
+
+    Args:
+        image (np.ndarray | PIL.Image.Image | torch.Tensor): DICOM pixel array, image or preprocessed tensor.
+        ds (pydicom.Dataset): Optional dataset used for DICOM windowing.
+
+    Returns:
+        torch.Tensor: Normalized tensor of shape (3, 224, 224).
+    """
+    if _is_preprocessed(image):
+        return image.reshape((3,) + INPUT_SIZE)
+    with span("preprocess"):
+        tensor = _resize(image, ds)
+        return (tensor.expand((3,) + INPUT_SIZE) - IMAGENET_MEAN) / IMAGENET_STD
+
+
+@traced("preprocess_batch")
+def to_input_batch(images, datasets=None):
+    """
+    Batched variant of to_input_tensor.
+
+    Args:
+        images (list): Pixel arrays, images or preprocessed tensors.
+        datasets (list): Optional datasets (or None entries), aligned with images.
+
+    Returns:
+        torch.Tensor: Normalized tensor of shape (N, 3, 224, 224).
+    """
+    if datasets is None:
+        datasets = [None] * len(images)
+    batch = torch.empty((len(images), 3) + INPUT_SIZE)
+    preprocessed = torch.zeros(len(images), dtype=torch.bool)
+    for i, (image, ds) in enumerate(zip(images, datasets)):
+        if _is_preprocessed(image):
+            batch[i] = image.reshape((3,) + INPUT_SIZE)
+            preprocessed[i] = True
+        else:
+            batch[i] = _resize(image, ds)  # broadcasts a single channel to 3
+    # Normalize all raw images in one op
+    raw = ~preprocessed
+    if raw.any():
+        batch[raw] = (batch[raw] - IMAGENET_MEAN) / IMAGENET_STD
+    return batch
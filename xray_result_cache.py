@@ -0,0 +1,231 @@
+import hashlib
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from xray_settings import get_setting
+
+
+# Header attributes that change what the model sees for the same stored pixels (see
+# xray_preprocessing.window_pixel_array)
+WINDOWING_KEYWORDS = ("PhotometricInterpretation", "BitsStored", "PixelRepresentation", "RescaleSlope",
+                      "RescaleIntercept", "ModalityLUTSequence", "WindowCenter", "WindowWidth",
+                      "VOILUTFunction", "VOILUTSequence")
+
+
+def _update_with_element(digest, element):
+    # Hash a data element, LUT sequences included (their LUTData as raw bytes)
+    if element.VR == "SQ":
+        digest.update(f"{element.tag}:[".encode())
+        for item in element.value:
+            for sub_element in item:
+                _update_with_element(digest, sub_element)
+            digest.update(b"|")
+        digest.update(b"]")
+    elif isinstance(element.value, (bytes, bytearray)):
+        digest.update(f"{element.tag}:{len(element.value)}:".encode())
+        digest.update(element.value)
+    else:
+        digest.update(f"{element.tag}={element.value!r};".encode())
+
+
+def pixel_digest(pixels, ds=None, frame_index=None):
+    """
+    SHA-256 of a (de-identified) pixel array, including its dtype and shape, and of what else
+    decides the model input: the windowing attributes of the dataset (or the absence of a
+    dataset, e.g. for a PNG upload) and the frame index.
+    """
+    if hasattr(pixels, "detach"):  # torch.Tensor, without importing torch
+        pixels = pixels.detach().cpu().numpy()
+    pixels = np.ascontiguousarray(pixels)
+    digest = hashlib.sha256()
+    digest.update(f"{pixels.dtype.str}:{pixels.shape}:".encode())
+    digest.update(memoryview(pixels).cast("B"))
+    if ds is None:
+        digest.update(b":pixels")
+    else:
+        digest.update(b":dicom")
+        for keyword in WINDOWING_KEYWORDS:
+            if keyword in ds:
+                _update_with_element(digest, ds.data_element(keyword))
+    if frame_index is not None:
+        digest.update(f":frame={frame_index}".encode())
+    return digest.hexdigest()
+
+
+def result_key(digest, kind, model_version):
+    """Cache key of one result kind (e.g. 'probs', 'embedding', 'gradcam:Edema') for one study and model."""
+    return f"{digest}:{kind}:{model_version}"
+
+
+def _size_of(value):
+    # Approximate memory held by a cached value
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, "element_size"):  # torch.Tensor
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_size_of(k) + _size_of(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_size_of(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+    """
+    Thread-safe, content-addressed LRU cache shared by all sessions of the process.
+
+    The in-memory tier evicts least recently used entries above max_bytes. The optional
+    on-disk tier (disk_dir) keeps entries as pickle files, so results survive restarts
+    and memory evictions; it evicts least recently used files above max_disk_bytes.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, disk_dir=None, max_disk_bytes=2 * 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._files = OrderedDict()  # disk path -> size, least recently used first
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_evictions": 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    def _scan_disk(self):
+        # Files left by earlier runs, oldest access first
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if name.endswith(".pkl"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self._files[path] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def _evict_disk(self):
+        # Caller holds the lock (or is the constructor)
+        while self._disk_bytes > self.max_disk_bytes and self._files:
+            path, size = self._files.popitem(last=False)
+            self._disk_bytes -= size
+            self._counters["disk_evictions"] += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # already removed, e.g. by another process sharing the directory
+
+    def _disk_path(self, key):
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.disk_dir, name[:2], name + ".pkl")
+
+    def _put_memory(self, key, value):
+        # Caller holds the lock
+        size = _size_of(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self._counters["evictions"] += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return self._entries[key][0]
+
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), "rb") as f:
+                    value = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                value = None
+            if value is not None:
+                path = self._disk_path(key)
+                try:
+                    os.utime(path)  # recently used: keep the file across restarts too
+                except OSError:
+                    pass
+                with self._lock:
+                    self._counters["disk_hits"] += 1
+                    if path in self._files:
+                        self._files.move_to_end(path)
+                    self._put_memory(key, value)
+                return value
+
+        with self._lock:
+            self._counters["misses"] += 1
+        return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._put_memory(key, value)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(tmp_path)
+            if size > self.max_disk_bytes:
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._disk_bytes += size - self._files.pop(path, 0)
+                self._files[path] = size
+                self._evict_disk()
+
+    def get_or_compute(self, key, compute):
+        """Return the cached value of key, or compute, store and return it."""
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        """Hit/miss/eviction counters and current memory usage."""
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes,
+                        disk_files=len(self._files), disk_bytes=self._disk_bytes, max_disk_bytes=self.max_disk_bytes)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """
+    Process-wide cache configured by RAISO_CACHE_MAX_MB (default 256), RAISO_CACHE_DIR
+    (on-disk tier, disabled by default) and RAISO_CACHE_DISK_MAX_MB (default 2048).
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(max_bytes=int(float(get_setting("RAISO_CACHE_MAX_MB", 256)) * 1024 * 1024),
+                                 disk_dir=get_setting("RAISO_CACHE_DIR") or None,
+                                 max_disk_bytes=int(float(get_setting("RAISO_CACHE_DISK_MAX_MB", 2048)) * 1024 * 1024))
+        return _cache
@@ -0,0 +1,307 @@
+import asyncio
+import json
+import os
+import threading
+
+import numpy as np
+
+from xray_settings import get_setting
+
+
+class SimilaritySearchBackend:
+    """Interface of the similarity search backends used by find_similar_xrays."""
+
+    def search(self, vector, label, k=3):
+        """
+        Args:
+            vector (list | np.ndarray): Query embedding.
+            label (str): Only images carrying this label are considered (None searches all images).
+            k (int): Number of results.
+
+        Returns:
+            list: Filenames of the top-k most similar images, most similar first.
+        """
+        raise NotImplementedError
+
+    def search_many(self, vector, labels, k=3):
+        """
+        Top-k similar images for several labels (e.g. every positive label of a study).
+
+        Returns:
+            dict: label -> filenames, as search would return them.
+        """
+        return {label: self.search(vector, label, k) for label in labels}
+
+    async def search_async(self, vector, label, k=3):
+        """search for event loops: in-process backends run in a thread, remote ones await their I/O."""
+        return await asyncio.to_thread(self.search, vector, label, k)
+
+    async def search_many_async(self, vector, labels, k=3):
+        return await asyncio.to_thread(self.search_many, vector, labels, k)
+
+
+def label_filter(labels):
+    # OData filter on the 'labels' collection field; quotes in values are doubled
+    quoted = [label.replace("'", "''") for label in labels]
+    if len(quoted) == 1:
+        return f"labels/any(t: t eq '{quoted[0]}')"
+    return f"labels/any(t: search.in(t, '{'|'.join(quoted)}', '|'))"
+
+
+def _group_by_label(docs, labels, k):
+    # Top-k filenames per label from results sorted by score. Exact for a label once k of its
+    # documents are in the results: every missing document of it scored lower than those.
+    grouped = {label: [] for label in labels}
+    for doc in docs:
+        for label in doc.get("labels") or []:
+            if label in grouped and len(grouped[label]) < k:
+                grouped[label].append(doc["filename"])
+    return grouped
+
+
+class AzureSearchBackend(SimilaritySearchBackend):
+    """
+    Vector query against an Azure AI Search index with a 'labels' collection field.
+
+    One SearchClient is created per backend and reused, so its HTTP session keeps the TLS
+    connections to the service alive across queries. Every call has connection/read timeouts
+    and a bounded number of retries (the SDK retries 408/429/5xx and connection errors with
+    exponential backoff). The async methods use the asyncio client of the SDK, so an event loop
+    (e.g. the inference server) can run other work while a query is in flight.
+    """
+
+    def __init__(self, endpoint, index_name, api_key, timeout=10.0, retries=2):
+        """
+        Args:
+            endpoint (str): Service URL, e.g. https://<service>.search.windows.net.
+            index_name (str): Index holding 'filename', 'labels' and 'embedding' fields.
+            api_key (str): Query key.
+            timeout (float): Connection and read timeout of one attempt, in seconds.
+            retries (int): Retries after a failed attempt.
+        """
+        self.endpoint = endpoint
+        self.index_name = index_name
+        self.api_key = api_key
+        self.timeout = timeout
+        self.retries = retries
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._async_clients = {}  # event loop -> asyncio SearchClient (its session is bound to the loop)
+
+    def _client_options(self):
+        from azure.core.credentials import AzureKeyCredential
+        return dict(endpoint=self.endpoint, index_name=self.index_name, credential=AzureKeyCredential(self.api_key),
+                    connection_timeout=self.timeout, read_timeout=self.timeout,
+                    retry_total=self.retries, retry_backoff_factor=0.2, retry_backoff_max=2)
+
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                from azure.search.documents import SearchClient
+                self._client = SearchClient(**self._client_options())
+            return self._client
+
+    def async_client(self):
+        # Only called from a running event loop
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            from azure.search.documents.aio import SearchClient
+            client = self._async_clients[loop] = SearchClient(**self._client_options())
+        return client
+
+    async def aclose(self):
+        """Close the asyncio client of the running loop (e.g. on server shutdown)."""
+        client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+    def _query(self, vector, labels, k):
+        return dict(
+            search_text = "",  # Required, even if you're only using vector search
+            vector_queries = [
+                {
+                    "vector": np.asarray(vector, dtype=np.float32).tolist(),
+                    "fields": "embedding",
+                    "k": k,
+                    "kind": "vector"
+                }
+            ],
+            filter = label_filter(labels), # filter for documents where labels field contains the label(s)
+            select = ["filename", "labels"] if len(labels) > 1 else ["filename"],
+            top = k
+        )
+
+    def search(self, vector, label, k=3):
+        return [doc['filename'] for doc in self.client().search(**self._query(vector, [label], k))]
+
+    def search_many(self, vector, labels, k=3):
+        # One query over the union of the labels, top k per label picked from its results;
+        # labels that got fewer than k documents there are queried on their own
+        labels = list(labels)
+        if len(labels) <= 1:
+            return {label: self.search(vector, label, k) for label in labels}
+        grouped = _group_by_label(self.client().search(**self._query(vector, labels, k * len(labels))), labels, k)
+        for label in labels:
+            if len(grouped[label]) < k:
+                grouped[label] = self.search(vector, label, k)
+        return grouped
+
+    async def _search_docs_async(self, vector, labels, k):
+        results = await self.async_client().search(**self._query(vector, labels, k))
+        return [doc async for doc in results]
+
+    async def search_async(self, vector, label, k=3):
+        return [doc['filename'] for doc in await self._search_docs_async(vector, [label], k)]
+
+    async def search_many_async(self, vector, labels, k=3):
+        labels = list(labels)
+        if len(labels) <= 1:
+            return {label: await self.search_async(vector, label, k) for label in labels}
+        grouped = _group_by_label(await self._search_docs_async(vector, labels, k * len(labels)), labels, k)
+        missing = [label for label in labels if len(grouped[label]) < k]
+        # Follow-up queries run concurrently
+        for label, filenames in zip(missing, await asyncio.gather(*(self.search_async(vector, label, k) for label in missing))):
+            grouped[label] = filenames
+        return grouped
+
+
+class LocalVectorIndex(SimilaritySearchBackend):
+    """
+    In-process exact cosine search.
+
+    Vectors are kept as one contiguous matrix (a float32 array, or the float16/float32 memmap of
+    a VectorStore) with precomputed inverse norms, so cosine similarity is a dot product and a
+    scale. A per-label inverted index (label -> row indices) makes a label-filtered query one
+    matrix-vector product over the matching rows only.
+    """
+
+    def __init__(self, vectors, filenames, labels=None, norms=None, label_rows=None):
+        """
+        Args:
+            vectors (np.ndarray): Embeddings of shape (N, D) (may be a memmap).
+            filenames (list): N filenames, row-aligned with vectors.
+            labels (list): N lists of labels, row-aligned with vectors. Not needed if label_rows is given.
+            norms (np.ndarray): Optional precomputed L2 norms of the vectors.
+            label_rows (dict): Optional precomputed label -> row indices.
+        """
+        if vectors.dtype not in (np.float16, np.float32):
+            vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(filenames):
+            raise ValueError("vectors and filenames must be row-aligned and vectors 2-D.")
+        if norms is None:
+            norms = np.linalg.norm(np.asarray(vectors, dtype=np.float32), axis=1)
+        norms = np.array(norms, dtype=np.float32)
+        norms[norms == 0] = 1.0
+        self.vectors = vectors
+        self.inv_norms = 1.0 / norms
+        self.filenames = list(filenames)
+
+        if label_rows is None:
+            if labels is None or len(labels) != len(filenames):
+                raise ValueError("labels must be row-aligned with filenames.")
+            label_rows = {}
+            for row, row_labels in enumerate(labels):
+                for label in row_labels:
+                    label_rows.setdefault(label, []).append(row)
+        self.label_rows = {label: np.asarray(rows, dtype=np.int64) for label, rows in label_rows.items()}
+
+    @classmethod
+    def from_store(cls, store_dir):
+        """Memory-map a binary vector store written by to_reproduce/img_embedder.py."""
+        from xray_vector_store import VectorStore
+        store = VectorStore(store_dir)
+        label_rows = {label: store.rows_with_label(label) for label in store.class_names}
+        return cls(store.vectors, store.filenames, norms=store.norms, label_rows=label_rows)
+
+    @classmethod
+    def from_jsonl(cls, jsonl_path):
+        """Load a medclip_xray_vectors.jsonl file (JSON float lists, as ingested by Azure AI Search)."""
+        vectors, filenames, labels = [], [], []
+        with open(jsonl_path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                vectors.append(record["embedding"])
+                filenames.append(record["filename"])
+                labels.append(record["labels"])
+        return cls(np.asarray(vectors, dtype=np.float32), filenames, labels)
+
+    @classmethod
+    def load(cls, vectors_path):
+        """Load a binary store directory, or a .jsonl file."""
+        if os.path.isdir(vectors_path):
+            return cls.from_store(vectors_path)
+        return cls.from_jsonl(vectors_path)
+
+    def search(self, vector, label, k=3):
+        rows = np.arange(len(self.filenames)) if label is None else self.label_rows.get(label)
+        if rows is None or len(rows) == 0 or k <= 0:
+            return []
+        top_rows, _ = self.top_rows(vector, rows, k)
+        return [self.filenames[row] for row in top_rows]
+
+    def top_rows(self, vector, rows, k):
+        """
+        Exact cosine top-k among some rows.
+
+        Returns:
+            tuple: (row indices, cosine similarities), most similar first.
+        """
+        query = np.asarray(vector, dtype=np.float32)
+        if query.shape != (self.vectors.shape[1],):
+            raise ValueError(f"Query has shape {query.shape}, the index holds {self.vectors.shape[1]}-d vectors "
+                             "(was it built with another embedding backbone?).")
+        query_norm = np.linalg.norm(query)
+        if query_norm > 0:
+            query = query / query_norm
+
+        scores = (np.asarray(self.vectors[rows], dtype=np.float32) @ query) * self.inv_norms[rows]
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return rows[top], scores[top]
+
+
+# One backend per process, selected by the RAISO_SEARCH_BACKEND setting
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def create_search_backend(name=None):
+    """
+    Build the similarity search backend named in the config.
+
+    Args:
+        name (str): 'azure', 'local' or 'ivf'. Defaults to the RAISO_SEARCH_BACKEND setting ('azure').
+
+    Returns:
+        SimilaritySearchBackend: The configured backend.
+    """
+    if name is None:
+        name = get_setting("RAISO_SEARCH_BACKEND", "azure")
+    if name == "azure":
+        return AzureSearchBackend(
+            endpoint = get_setting("AZURE_AI_SEARCH_ENDPOINT"),
+            index_name = get_setting("AZURE_AI_SEARCH_INDEX_NAME"),
+            api_key = get_setting("AZURE_API_KEY"),
+            timeout = float(get_setting("RAISO_SEARCH_TIMEOUT", 10.0)),
+            retries = int(get_setting("RAISO_SEARCH_RETRIES", 2))
+        )
+    if name == "local":
+        return LocalVectorIndex.load(get_setting("RAISO_LOCAL_VECTORS_PATH", "medclip_xray_vectors"))
+    if name == "ivf":
+        from xray_ann_index import IVFIndex
+        return IVFIndex(get_setting("RAISO_ANN_INDEX_DIR", "xray_ann_index"),
+                        nprobe=int(get_setting("RAISO_ANN_NPROBE", 8)))
+    raise ValueError(f"Unknown similarity search backend '{name}'. Use 'azure', 'local' or 'ivf'.")
+
+
+def get_search_backend():
+    """Return the process-wide similarity search backend, creating it on first use."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_search_backend()
+        return _backend
@@ -0,0 +1,32 @@
+import os
+import sys
+
+
+def get_setting(name, default=None):
+    """
+    Read a deployment setting from the environment first, then from Streamlit secrets.
+
+    Secrets are only read inside a running Streamlit script: other processes (batch CLI,
+    inference server, benchmarks, worker processes) never import Streamlit for a setting.
+
+    Args:
+        name (str): Setting name, e.g. 'RAISO_SEARCH_BACKEND'.
+        default: Value returned when the setting is not defined anywhere.
+
+    Returns:
+        The setting value (strings from the environment, any TOML type from secrets) or default.
+    """
+    value = os.environ.get(name)
+    if value is not None:
+        return value
+    if "streamlit" not in sys.modules:
+        return default
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        if get_script_run_ctx() is None:
+            return default
+        import streamlit as st
+        return st.secrets[name]
+    except Exception:
+        # No secrets file, or the key is not in it
+        return default
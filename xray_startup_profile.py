@@ -0,0 +1,95 @@
+import argparse
+import ast
+import json
+import subprocess
+import sys
+import time
+
+
+def app_imports(app_path="app.py"):
+    """Modules imported at the top level of a script: what runs before its first line of UI."""
+    with open(app_path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=app_path)
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            names = [node.module]
+        else:
+            continue
+        modules.extend(name for name in names if name not in modules)
+    return modules
+
+
+def import_profile(modules):
+    """
+    Import modules in a fresh interpreter with -X importtime.
+
+    Args:
+        modules (list): Module names, imported in this order.
+
+    Returns:
+        dict: wall_seconds of the whole interpreter run, and one {"module", "depth", "self_ms",
+        "cumulative_ms"} record per imported module (depth 0: imported by the script itself).
+    """
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + ", ".join(modules)],
+                               capture_output=True, text=True)
+    wall_seconds = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {modules} failed:\n{completed.stderr[-2000:]}")
+
+    records = []
+    for line in completed.stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        records.append({"module": name.strip(), "depth": depth, "self_ms": int(self_us) / 1000.0,
+                        "cumulative_ms": int(cumulative_us) / 1000.0})
+    return {"wall_seconds": wall_seconds, "modules": records}
+
+
+def model_profile():
+    """Load the in-process models as the background warm-up does and return the registry load/warm-up figures."""
+    from xray_inference_service import InferenceService
+    from xray_model_registry import registry
+
+    start = time.perf_counter()
+    InferenceService().warm_up()
+    return {"warmup_seconds": time.perf_counter() - start, "models": registry.stats()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report import-time and model startup costs of the app.")
+    parser.add_argument("--app", default="app.py", help="Script whose top-level imports are profiled.")
+    parser.add_argument("--modules", nargs="*", default=None, help="Profile these modules instead of the app's imports.")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest modules listed.")
+    parser.add_argument("--models", action="store_true", help="Also time model loading and warm-up.")
+    parser.add_argument("--json", default=None, help="Write the full report to this file.")
+    args = parser.parse_args()
+
+    modules = args.modules or app_imports(args.app)
+    report = {"imports": modules, "import_profile": import_profile(modules)}
+    profile = report["import_profile"]
+    top_level = [r for r in profile["modules"] if r["depth"] == 0 and r["module"] in modules]
+
+    print(f"> Importing {', '.join(modules)}")
+    print(f"> Interpreter start + imports: {profile['wall_seconds']:.2f}s, "
+          f"imports: {sum(r['cumulative_ms'] for r in top_level) / 1000.0:.2f}s")
+    print(f"> Slowest {args.top} imports (cumulative ms | self ms | module):")
+    for record in sorted(profile["modules"], key=lambda r: -r["cumulative_ms"])[:args.top]:
+        print(f"{record['cumulative_ms']:10.1f} | {record['self_ms']:8.1f} | {record['module']}")
+
+    if args.models:
+        report["model_profile"] = model_profile()
+        print(f"> Model warm-up: {report['model_profile']['warmup_seconds']:.2f}s")
+        for stats in report["model_profile"]["models"]:
+            print(f"  {stats['name']}: load {stats['load_seconds']:.2f}s, warm-up {stats['warmup_seconds']:.2f}s, "
+                  f"{stats['param_bytes'] / 1e6:.1f} MB parameters")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
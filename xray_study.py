@@ -0,0 +1,134 @@
+from functools import cached_property
+from io import BytesIO
+
+import numpy as np
+import pydicom
+from PIL import Image
+
+from xray_tracing import span
+
+
+
+THUMBNAIL_SIZE = (256, 256)
+
+PIXEL_DATA_TAG = 0x7FE00010
+NUMBER_OF_FRAMES_TAG = 0x00280008
+
+
+class XrayStudy:
+    """
+    Lazy view of one DICOM X-ray.
+
+    PixelData is decoded at most once, on first use, and every derived form (preview,
+    RGB image, model input tensor, thumbnail, content digest) is computed on first access
+    and memoized on the instance. Keep one XrayStudy per dataset (e.g. in st.session_state)
+    so every Streamlit rerun and every consumer shares the same decoded arrays.
+
+    A multi-frame dataset is viewed one frame at a time: the study shows its first frame (or
+    frame_index), and frames() gives a lazy study per frame, each decoding only its own frame.
+    """
+
+    def __init__(self, ds=None, pixels=None, frame_index=None):
+        """
+        Args:
+            ds (pydicom.Dataset): The (de-identified) dataset.
+            pixels (np.ndarray): Raw pixel array, for studies that come without a dataset.
+            frame_index (int): Frame of a multi-frame dataset this study views (None: the first).
+        """
+        if ds is None and pixels is None:
+            raise ValueError("XrayStudy needs a dataset or a pixel array.")
+        self.ds = ds
+        self.frame_index = frame_index
+        if pixels is not None:
+            self.pixels = np.asarray(pixels)
+
+    @classmethod
+    def from_file(cls, dicom_path, frame_index=None):
+        with span("dcmread"):
+            return cls(pydicom.dcmread(dicom_path), frame_index=frame_index)
+
+    @classmethod
+    def from_bytes(cls, data, frame_index=None):
+        """Read a study from DICOM file bytes."""
+        with span("dcmread"):
+            return cls(pydicom.dcmread(BytesIO(data)), frame_index=frame_index)
+
+    @property
+    def n_frames(self):
+        """Number of frames of the dataset (1 for single-frame images and pixel-only studies)."""
+        if self.ds is None:
+            return 1
+        return int(self.ds.get("NumberOfFrames") or 1)
+
+    def frames(self):
+        """Lazy study of each frame, first to last. A single-frame study yields itself."""
+        if self.n_frames == 1:
+            yield self
+            return
+        for index in range(self.n_frames):
+            yield XrayStudy(self.ds, frame_index=index)
+
+    @cached_property
+    def pixels(self):
+        """Decoded pixel array of the image (of one frame for multi-frame datasets), as stored in the file."""
+        with span("decode_pixels"):
+            if self.n_frames > 1:
+                # Decode only the viewed frame, not the whole (possibly very large) multi-frame object
+                from pydicom.pixels import pixel_array
+                return pixel_array(self.ds, index=self.frame_index or 0)
+            return self.ds.pixel_array
+
+    @cached_property
+    def preview(self):
+        """Windowed uint8 grayscale image for display and overlays."""
+        from xray_preprocessing import window_pixel_array
+        return np.round(window_pixel_array(self.pixels, self.ds) * 255.0).astype(np.uint8)
+
+    @cached_property
+    def image(self):
+        """RGB PIL image of the preview."""
+        img = Image.fromarray(self.preview)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        return img
+
+    @cached_property
+    def tensor(self):
+        """Normalized model input of shape (3, 224, 224), shared by classification, Grad-CAM and embedding."""
+        from xray_preprocessing import to_input_tensor  # imports torch, only once inference is needed
+        return to_input_tensor(self.pixels, self.ds)
+
+    @cached_property
+    def thumbnail(self):
+        """RGB PIL image that fits in THUMBNAIL_SIZE."""
+        img = self.image.copy()
+        img.thumbnail(THUMBNAIL_SIZE, Image.BILINEAR)
+        return img
+
+    @cached_property
+    def digest(self):
+        """Content hash of the pixels, windowing attributes and frame, used as the result cache key."""
+        from xray_result_cache import pixel_digest
+        return pixel_digest(self.pixels, self.ds, self.frame_index)
+
+    @cached_property
+    def dicom_bytes(self):
+        """
+        The dataset encoded as a DICOM file, e.g. to upload it to the inference server.
+        A frame of a multi-frame dataset (or pixels read apart from their header) is encoded
+        as a single-frame file holding only these pixels.
+        """
+        # Accessing every element converts raw elements, resolving VRs missing from implicit VR data before writing
+        for _ in self.ds:
+            pass
+        ds = self.ds
+        if self.n_frames > 1 or "PixelData" not in ds:
+            ds = pydicom.Dataset()
+            ds.file_meta = pydicom.dataset.FileMetaDataset(self.ds.file_meta)
+            for element in self.ds:
+                if element.tag not in (PIXEL_DATA_TAG, NUMBER_OF_FRAMES_TAG):
+                    ds.add(element)
+            ds.set_pixel_data(self.pixels, self.ds.PhotometricInterpretation, int(self.ds.BitsStored))
+        buffer = BytesIO()
+        ds.save_as(buffer, enforce_file_format=ds is not self.ds)
+        return buffer.getvalue()
@@ -0,0 +1,227 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from xray_settings import get_setting
+
+
+# Upper bounds (seconds) of the latency histogram buckets, from decoding a header to loading a model
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram (the Prometheus model): count, sum, max and per-bucket counts."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Estimate a quantile by linear interpolation inside its bucket."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = min(self.buckets[i], self.max)
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.max
+
+
+# Stages of the request being traced in this thread / task: list of (stage, seconds, depth)
+_current_trace = contextvars.ContextVar("raiso_trace", default=None)
+
+
+class Tracer:
+    """
+    Process-wide stage timer.
+
+    Every span adds its duration to the histogram of its stage, so the cost of dcmread,
+    de-identification, preprocessing, model loading, forward and backward passes or the
+    search round trip can be read from /metrics. Spans opened inside another span are also
+    recorded in the per-request breakdown of the outermost one, which is logged when the
+    request is slower than slow_threshold_seconds.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self.slow_threshold_seconds = None
+        self.profiling = False
+
+    @contextmanager
+    def span(self, stage):
+        trace = _current_trace.get()
+        root = trace is None
+        if root:
+            trace = []
+            token = _current_trace.set(trace)
+        depth = sum(1 for _, seconds, _ in trace if seconds is None)
+        entry = len(trace)
+        trace.append((stage, None, depth))  # open span
+        record_function = None
+        if self.profiling:
+            # Name the stage in the torch profiler trace of a profiled request
+            from torch.profiler import record_function
+            record_function = record_function(stage)
+            record_function.__enter__()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if record_function is not None:
+                record_function.__exit__(None, None, None)
+            trace[entry] = (stage, seconds, depth)
+            self.observe(stage, seconds)
+            if root:
+                _current_trace.reset(token)
+                if self.slow_threshold_seconds is not None and seconds >= self.slow_threshold_seconds:
+                    print(f"> Slow {stage}: {format_trace(trace)}")
+
+    def traced(self, stage):
+        """Decorator timing every call of a function as stage."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def to_json(self):
+        """stage -> {count, sum_seconds, mean_ms, p50_ms, p95_ms, max_ms}."""
+        with self._lock:
+            return {stage: {"count": h.count, "sum_seconds": h.sum, "mean_ms": 1000.0 * h.sum / h.count,
+                            "p50_ms": 1000.0 * h.quantile(0.5), "p95_ms": 1000.0 * h.quantile(0.95),
+                            "max_ms": 1000.0 * h.max}
+                    for stage, h in sorted(self._histograms.items())}
+
+    def to_prometheus(self):
+        """Prometheus text exposition of the raiso_stage_seconds histogram."""
+        lines = ["# HELP raiso_stage_seconds Duration of the pipeline stages.",
+                 "# TYPE raiso_stage_seconds histogram"]
+        with self._lock:
+            for stage, h in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'raiso_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'raiso_stage_seconds_sum{{stage="{stage}"}} {h.sum}')
+                lines.append(f'raiso_stage_seconds_count{{stage="{stage}"}} {h.count}')
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+def format_trace(trace):
+    # "2.310s | dcmread 0.120s, preprocess 0.050s, ..." with nested stages prefixed by one '>' per level
+    stages = ", ".join(f"{'>' * depth}{stage} {seconds:.3f}s" for stage, seconds, depth in trace[1:])
+    return f"{trace[0][1]:.3f}s" + (f" | {stages}" if stages else "")
+
+
+# Shared tracer for the whole process
+tracer = Tracer()
+span = tracer.span
+traced = tracer.traced
+
+
+def configure_tracing():
+    """Apply the RAISO_TRACE_SLOW_MS setting: log the stage breakdown of requests slower than that."""
+    slow_ms = get_setting("RAISO_TRACE_SLOW_MS")
+    tracer.slow_threshold_seconds = float(slow_ms) / 1000.0 if slow_ms not in (None, "") else None
+
+
+# One torch profiler at a time per process
+_profile_lock = threading.Lock()
+
+
+@contextmanager
+def profile_request(output_dir=None, name="request"):
+    """
+    Capture a torch profiler trace (CPU ops, shapes, stage names) of the code in the block.
+
+    The trace is written as <output_dir>/<name>-<timestamp>.json, viewable in chrome://tracing
+    or Perfetto. Meant for a single request: profiling slows everything it records.
+
+    Args:
+        output_dir (str): Defaults to the RAISO_PROFILE_DIR setting ('profiles').
+        name (str): File name prefix.
+
+    Yields:
+        dict: Filled with "path" once the block exits.
+    """
+    from torch.profiler import ProfilerActivity, profile
+
+    output_dir = output_dir or get_setting("RAISO_PROFILE_DIR", "profiles")
+    os.makedirs(output_dir, exist_ok=True)
+    result = {}
+    with _profile_lock:
+        tracer.profiling = True
+        try:
+            with profile(activities=[ProfilerActivity.CPU], record_shapes=True) as profiler:
+                yield result
+        finally:
+            tracer.profiling = False
+    result["path"] = os.path.join(output_dir, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}.json")
+    profiler.export_chrome_trace(result["path"])
+    print(f"> Profile written to {result['path']}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        if "format=json" in self.path:
+            body, content_type = json.dumps(tracer.to_json()).encode(), "application/json"
+        else:
+            body, content_type = tracer.to_prometheus().encode(), PROMETHEUS_CONTENT_TYPE
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scraped every few seconds: keep the app logs clean
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """Serve GET /metrics (Prometheus text, or JSON with ?format=json) from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="raiso-metrics", daemon=True).start()
+    print(f"> Metrics on http://{host}:{port}/metrics")
+    return server
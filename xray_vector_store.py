@@ -0,0 +1,317 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+
+STORE_FORMAT_VERSION = 2
+
+# Fixed .npy header size, so the row count can be rewritten in place while appending
+_NPY_HEADER_BYTES = 128
+
+
+def _npy_header(shape, dtype):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.dtype(dtype).str, tuple(shape))
+    header = header.ljust(_NPY_HEADER_BYTES - 10 - 1) + "\n"
+    if len(header) != _NPY_HEADER_BYTES - 10:
+        raise ValueError(f"Shape {shape} does not fit in the fixed .npy header.")
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+def _write_json_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def default_class_names():
+    from xray_labels import CLASS_NAMES  # not xray_classifier: a store can be used without torch
+    return list(CLASS_NAMES)
+
+
+def labels_to_mask(labels, class_names):
+    """Encode a list of labels as a bitmask over class_names (unknown labels such as 'No Finding' are ignored)."""
+    mask = 0
+    for label in labels:
+        if label in class_names:
+            mask |= 1 << class_names.index(label)
+    return mask
+
+
+def mask_dtype(class_names):
+    if len(class_names) > 64:
+        raise ValueError("At most 64 labels fit in the label bitmask.")
+    return np.dtype(np.uint16 if len(class_names) <= 16 else np.uint64)
+
+
+class _AppendableNpy:
+    """A .npy file whose rows are appended in place; the header is rewritten on flush()."""
+
+    def __init__(self, path, row_shape, dtype, count=None):
+        self.path = path
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.row_bytes = int(np.prod(self.row_shape, dtype=np.int64)) * self.dtype.itemsize
+        self.count = 0 if count is None else count
+        if count is None:
+            with open(path, "wb") as f:
+                f.write(_npy_header((0,) + self.row_shape, self.dtype))
+        else:
+            # Resume: drop rows written after the last checkpoint
+            with open(path, "r+b") as f:
+                f.truncate(_NPY_HEADER_BYTES + count * self.row_bytes)
+                f.write(_npy_header((count,) + self.row_shape, self.dtype))
+        self._file = open(path, "r+b")
+        self._file.seek(0, os.SEEK_END)
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        if rows.shape[1:] != self.row_shape:
+            raise ValueError(f"Rows of {self.path} must have shape {self.row_shape}, got {rows.shape[1:]}.")
+        self._file.write(rows.tobytes())
+        self.count += len(rows)
+
+    def flush(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        position = self._file.tell()
+        self._file.seek(0)
+        self._file.write(_npy_header((self.count,) + self.row_shape, self.dtype))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.seek(position)
+
+    def close(self):
+        self._file.close()
+
+
+class VectorStoreWriter:
+    """
+    Append-only, resumable writer of an embedding store directory:
+
+        vectors.npy      (N, dim) float16/float32 matrix
+        norms.npy        (N,) float32 L2 norms of the vectors (cosine search without a pass over the data)
+        label_masks.npy  (N,) label bitmask over class_names (bit i = class_names[i])
+        metadata.jsonl   one {"filename", "labels"} record per row
+        manifest.json    dim, dtype, class_names and the committed row count
+
+    Every .npy file is a valid NumPy file, so VectorStore maps it with np.load(mmap_mode='r').
+    Rows are streamed to disk as they are appended; checkpoint() makes them durable and
+    updates the committed count. Reopening an existing store drops any rows written after
+    the last checkpoint, so an interrupted run resumes from a consistent state.
+    """
+
+    def __init__(self, store_dir, dim, dtype="float32", class_names=None, extra_manifest=None):
+        """
+        Args:
+            store_dir (str): Store directory (created if missing, resumed if it exists).
+            dim (int): Embedding dimension.
+            dtype (str): Storage type of the vectors ('float16' or 'float32').
+            class_names (list): Labels encoded in the bitmask. Defaults to xray_labels.CLASS_NAMES.
+            extra_manifest (dict): Extra fields recorded in manifest.json (e.g. the model name).
+        """
+        self.store_dir = store_dir
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.class_names = list(class_names) if class_names is not None else default_class_names()
+        self.extra_manifest = dict(extra_manifest or {})
+        os.makedirs(store_dir, exist_ok=True)
+        self._metadata_path = os.path.join(store_dir, "metadata.jsonl")
+        self._manifest_path = os.path.join(store_dir, "manifest.json")
+
+        count = None
+        self.done_filenames = set()
+        if os.path.exists(self._manifest_path):
+            count = self._resume()
+        else:
+            open(self._metadata_path, "w").close()
+
+        self._vectors = _AppendableNpy(os.path.join(store_dir, "vectors.npy"), (dim,), self.dtype, count)
+        self._norms = _AppendableNpy(os.path.join(store_dir, "norms.npy"), (), np.float32, count)
+        self._label_masks = _AppendableNpy(os.path.join(store_dir, "label_masks.npy"), (),
+                                           mask_dtype(self.class_names), count)
+        self._metadata_file = open(self._metadata_path, "a")
+        if count is None:
+            self.checkpoint_manifest()
+
+    @property
+    def count(self):
+        return self._vectors.count
+
+    def _resume(self):
+        with open(self._manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("format_version") != STORE_FORMAT_VERSION:
+            raise ValueError(f"Store {self.store_dir} has format version {manifest.get('format_version')}.")
+        if manifest["dim"] != self.dim or np.dtype(manifest["dtype"]) != self.dtype:
+            raise ValueError(f"Existing store {self.store_dir} has dim={manifest['dim']} dtype={manifest['dtype']}.")
+        if manifest["class_names"] != self.class_names:
+            raise ValueError(f"Existing store {self.store_dir} uses different class names.")
+        for key, value in self.extra_manifest.items():
+            # e.g. vectors of another embedding model: re-index into a new store directory
+            if key in manifest and manifest[key] != value:
+                raise ValueError(f"Existing store {self.store_dir} has {key}={manifest[key]!r}, not {value!r}.")
+        count = manifest["count"]
+
+        # Drop metadata written after the last checkpoint
+        kept_lines = []
+        with open(self._metadata_path, "r") as f:
+            for line in f:
+                if len(kept_lines) == count:
+                    break
+                kept_lines.append(line)
+        with open(self._metadata_path, "w") as f:
+            f.writelines(kept_lines)
+        self.done_filenames = {json.loads(line)["filename"] for line in kept_lines}
+        return count
+
+    def append(self, vectors, filenames, labels):
+        """
+        Append a batch of rows.
+
+        Args:
+            vectors (np.ndarray): Embeddings of shape (B, dim).
+            filenames (list): B filenames.
+            labels (list): B lists of labels.
+        """
+        vectors = np.asarray(vectors)
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            raise ValueError(f"vectors must have shape (B, {self.dim}).")
+        if len(filenames) != len(vectors) or len(labels) != len(vectors):
+            raise ValueError("vectors, filenames and labels must be row-aligned.")
+        self._vectors.append(vectors)
+        self._norms.append(np.linalg.norm(vectors.astype(np.float32), axis=1))
+        self._label_masks.append(np.array([labels_to_mask(row_labels, self.class_names) for row_labels in labels]))
+        for filename, row_labels in zip(filenames, labels):
+            self._metadata_file.write(json.dumps({"filename": filename, "labels": list(row_labels)}) + "\n")
+        self.done_filenames.update(filenames)
+
+    def checkpoint_manifest(self):
+        _write_json_atomic(self._manifest_path, dict(self.extra_manifest, **{
+            "format_version": STORE_FORMAT_VERSION,
+            "dim": self.dim,
+            "dtype": self.dtype.name,
+            "class_names": self.class_names,
+            "count": self.count,
+        }))
+
+    def checkpoint(self):
+        """Flush appended rows to disk and commit the new row count."""
+        self._metadata_file.flush()
+        os.fsync(self._metadata_file.fileno())
+        for column in (self._vectors, self._norms, self._label_masks):
+            column.flush()
+        self.checkpoint_manifest()
+
+    def close(self):
+        self.checkpoint()
+        for column in (self._vectors, self._norms, self._label_masks):
+            column.close()
+        self._metadata_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class VectorStore:
+    """
+    Read-only view of a store written by VectorStoreWriter.
+
+    Opening memory-maps the .npy files and reads the filenames, so even the whole NIH corpus
+    loads near-instantly and its pages are shared between processes.
+    """
+
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, "manifest.json"), "r") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format_version") != STORE_FORMAT_VERSION:
+            raise ValueError(f"Store {store_dir} has format version {self.manifest.get('format_version')}.")
+        count = self.manifest["count"]
+        self.store_dir = store_dir
+        self.class_names = self.manifest["class_names"]
+        self.vectors = np.load(os.path.join(store_dir, "vectors.npy"), mmap_mode="r")[:count]
+        self.norms = np.load(os.path.join(store_dir, "norms.npy"), mmap_mode="r")[:count]
+        self.label_masks = np.load(os.path.join(store_dir, "label_masks.npy"), mmap_mode="r")[:count]
+        self.filenames = [record["filename"] for record in self.metadata()]
+
+    def __len__(self):
+        return self.manifest["count"]
+
+    def metadata(self):
+        """All {"filename", "labels"} records (labels also include names outside class_names)."""
+        records = []
+        with open(os.path.join(self.store_dir, "metadata.jsonl"), "r") as f:
+            for line in f:
+                if len(records) == len(self):
+                    break
+                records.append(json.loads(line))
+        return records
+
+    def rows_with_label(self, label):
+        """Row indices whose bitmask contains label."""
+        if label not in self.class_names:
+            return np.empty(0, dtype=np.int64)
+        bit = self.label_masks.dtype.type(1 << self.class_names.index(label))
+        return np.flatnonzero(self.label_masks & bit)
+
+    def labels(self, row):
+        """Decode the label bitmask of one row."""
+        mask = int(self.label_masks[row])
+        return [name for i, name in enumerate(self.class_names) if mask & (1 << i)]
+
+
+def open_vector_store(store_dir):
+    """
+    Open a store written by VectorStoreWriter.
+
+    Returns:
+        tuple: (vectors memmap of shape (N, dim), list of {"filename", "labels"} dicts).
+    """
+    store = VectorStore(store_dir)
+    return store.vectors, store.metadata()
+
+
+def import_jsonl(jsonl_path, store_dir, dtype="float16", batch_size=4096):
+    """Convert a medclip_xray_vectors.jsonl file (JSON float lists) into a binary store."""
+    writer = None
+    batch = []
+    with open(jsonl_path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if writer is None:
+                writer = VectorStoreWriter(store_dir, len(record["embedding"]), dtype=dtype)
+            batch.append(record)
+            if len(batch) == batch_size:
+                writer.append(np.array([r["embedding"] for r in batch], dtype=np.float32),
+                              [r["filename"] for r in batch], [r["labels"] for r in batch])
+                batch = []
+    if writer is None:
+        raise ValueError(f"{jsonl_path} holds no records.")
+    if batch:
+        writer.append(np.array([r["embedding"] for r in batch], dtype=np.float32),
+                      [r["filename"] for r in batch], [r["labels"] for r in batch])
+    writer.close()
+    return writer.count
+
+
+def export_jsonl(store_dir, jsonl_path):
+    """Write the store as the JSONL document format used for Azure AI Search ingestion."""
+    vectors, metadata = open_vector_store(store_dir)
+    with open(jsonl_path, "w") as f:
+        for i, record in enumerate(metadata):
+            json.dump({
+                "id": str(i + 1),
+                "filename": record["filename"],
+                "labels": record["labels"],
+                "embedding": np.asarray(vectors[i], dtype=np.float32).tolist()
+            }, f)
+            f.write("\n")